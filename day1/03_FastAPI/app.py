@@ -1,15 +1,32 @@
 import os
+import asyncio
+import contextlib
+import threading
+import uuid
 import torch
-from transformers import pipeline
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList, DynamicCache
 import time
+import json
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import uvicorn
 import nest_asyncio
 from pyngrok import ngrok
+from batching import BatchScheduler, RequestCancelled
+from executor import InferenceExecutor, QueueFullError, DeadlineExceeded
+from cache import ResponseCache, make_cache_key
+from metrics import MetricsRegistry, RequestCountingMiddleware, THROUGHPUT_BUCKETS
+from loader import ModelLoader, LOADING, RETRYING
+from registry import ModelRegistry
+from cpu_inference import CPU_MODES, apply_cpu_mode, convert_model, load_dtype_for_mode
+from speculative import load_draft_model
+from backends import BACKENDS, create_stub_pipeline, create_transformers_pipeline, estimate_transformers_model_bytes
+from sessions import SessionCache, SessionState, common_prefix_length
+from warmup import compile_model, uncompile_model, warmup_pipeline
 
 # --- 設定 ---
 # モデル名を設定
@@ -20,6 +37,61 @@ print(f"モデル名を設定: {MODEL_NAME}")
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # リクエストの model フィールドで指定できるモデル（カンマ区切り）と、読み込み済みモデルのメモリ予算
+        self.AVAILABLE_MODELS = [
+            name.strip()
+            for name in os.environ.get("AVAILABLE_MODELS", f"{model_name},google/gemma-3-1b-it").split(",")
+            if name.strip()
+        ]
+        if model_name not in self.AVAILABLE_MODELS:
+            self.AVAILABLE_MODELS.insert(0, model_name)
+        self.MODEL_MEMORY_BUDGET_GB = float(os.environ.get("MODEL_MEMORY_BUDGET_GB", "16"))
+        # マイクロバッチング設定（環境変数で上書き可能）
+        self.BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+        self.BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "10"))
+        # 推論の同時実行数と待ち行列の上限（超えた分は503で断る）
+        self.INFERENCE_MAX_CONCURRENCY = int(os.environ.get("INFERENCE_MAX_CONCURRENCY", "1"))
+        self.INFERENCE_MAX_QUEUE = int(os.environ.get("INFERENCE_MAX_QUEUE", "32"))
+        # do_sample=False のリクエストに対する応答キャッシュ
+        self.RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+        self.RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "600"))
+        # モデル読み込みの再試行（指数バックオフ）と、読み込み中のリクエストの待機時間（0なら即503）
+        self.MODEL_LOAD_MAX_RETRIES = int(os.environ.get("MODEL_LOAD_MAX_RETRIES", "5"))
+        self.MODEL_LOAD_BACKOFF_BASE = float(os.environ.get("MODEL_LOAD_BACKOFF_BASE", "5"))
+        self.MODEL_LOAD_BACKOFF_MAX = float(os.environ.get("MODEL_LOAD_BACKOFF_MAX", "300"))
+        self.MODEL_WAIT_TIMEOUT = float(os.environ.get("MODEL_WAIT_TIMEOUT", "0"))
+        # /generate/batch で1リクエストに含められるプロンプト数の上限
+        # （待ち行列全体を1リクエストで使い切ると、他のリクエストが来ただけで503になるため、その一部に抑える）
+        self.BATCH_REQUEST_MAX_PROMPTS = int(
+            os.environ.get("BATCH_REQUEST_MAX_PROMPTS", str(max(1, self.INFERENCE_MAX_QUEUE // 4)))
+        )
+        # クライアントの切断を確認する間隔（秒）。切断されたら次のデコードステップで生成を止める
+        self.DISCONNECT_CHECK_INTERVAL = float(os.environ.get("DISCONNECT_CHECK_INTERVAL", "0.25"))
+        # 投機的デコーディング用のドラフトモデル（本体より小さいモデル。空なら無効）と、
+        # リクエストで speculative を省略したときに投機的デコーディングを使うか
+        self.DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")
+        self.SPECULATIVE_DECODING = os.environ.get("SPECULATIVE_DECODING", "0") == "1"
+        # 読み込み後のウォームアップ（完了するまで /health は503を返す）と torch.compile
+        self.WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+        self.WARMUP_ROUNDS = int(os.environ.get("WARMUP_ROUNDS", "3"))
+        self.WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", "16"))
+        self.WARMUP_BATCH_SIZES = [
+            int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", f"1,{self.BATCH_MAX_SIZE}").split(",") if size.strip()
+        ]
+        self.TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "0") == "1"
+        self.TORCH_COMPILE_MODE = os.environ.get("TORCH_COMPILE_MODE", "default")
+        # GPUがない場合の推論モード: bf16 / fp32 / int8（動的量子化）/
+        # auto（起動時に計測して最速を選ぶ。fp32で読み込むため、bf16の約2倍のメモリが必要）
+        self.CPU_INFERENCE_MODE = os.environ.get("CPU_INFERENCE_MODE", "bf16").lower()
+        # 推論バックエンド: transformers（実モデル）/ stub（決定的なトークンを一定間隔で返す。ベンチマーク・CI用）
+        self.INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "transformers").lower()
+        # スタブの1トークンあたりの生成時間、プロンプト1トークンあたりのプレフィル時間、確保するメモリ量
+        self.STUB_TOKEN_DELAY_MS = float(os.environ.get("STUB_TOKEN_DELAY_MS", "20"))
+        self.STUB_PREFILL_DELAY_MS = float(os.environ.get("STUB_PREFILL_DELAY_MS", "0.5"))
+        self.STUB_MEMORY_MB = float(os.environ.get("STUB_MEMORY_MB", "256"))
+        # /chat の会話ごとのKVキャッシュに使うメモリの上限（超えると古い会話から追い出す）
+        self.CHAT_SESSION_CACHE_MB = float(os.environ.get("CHAT_SESSION_CACHE_MB", "512"))
 
 config = Config(MODEL_NAME)
 
@@ -39,41 +111,191 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- メトリクス定義 ---
+# /metrics でPrometheus形式で公開する
+metrics = MetricsRegistry()
+metrics.counter("llm_requests_total", "HTTPリクエスト数（エンドポイント・ステータス別）")
+metrics.histogram("llm_request_duration_seconds", "生成リクエストのエンドツーエンドのレイテンシ（優先度クラス別）")
+metrics.histogram("llm_queue_wait_seconds", "推論の実行開始までの待ち時間（優先度クラス別）")
+metrics.histogram("llm_prefill_seconds", "プロンプトのプレフィル（最初のトークン生成まで）にかかった時間")
+metrics.histogram("llm_decode_seconds", "2トークン目以降のデコードにかかった時間")
+metrics.histogram("llm_tokens_per_second", "デコード時の生成トークン数/秒", buckets=THROUGHPUT_BUCKETS)
+metrics.counter("llm_prompt_tokens_total", "入力プロンプトのトークン数の累計")
+metrics.counter("llm_generated_tokens_total", "生成されたトークン数の累計")
+metrics.counter("llm_deadline_exceeded_total", "実行開始前に期限を過ぎて破棄したリクエスト数")
+metrics.counter("llm_cancelled_requests_total", "クライアントの切断で中止したリクエスト数（実行前/生成中）")
+metrics.counter("llm_draft_tokens_total", "投機的デコーディングでドラフトモデルが提案したトークン数")
+metrics.counter("llm_draft_accepted_tokens_total", "ドラフトモデルの提案のうち本体モデルが採択したトークン数")
+metrics.gauge("llm_speculative_speedup", "投機的デコーディングによるデコード速度の向上率",
+              lambda: draft_model.speedup if draft_model is not None else None)
+metrics.gauge("llm_model_load_seconds", "モデルの読み込みにかかった時間")
+metrics.gauge("llm_warmup_seconds", "読み込み後のウォームアップにかかった時間")
+metrics.counter("llm_chat_reused_tokens_total", "/chat で前のターンのKVキャッシュを再利用してプレフィルを省いたトークン数")
+metrics.gauge("llm_chat_sessions", "KVキャッシュを保持している会話の数", lambda: len(session_cache))
+metrics.gauge("llm_chat_session_cache_bytes", "会話ごとのKVキャッシュが使っているメモリ量", lambda: session_cache.current_bytes)
+metrics.gauge("llm_in_flight_requests", "実行中の推論リクエスト数", lambda: inference_executor.in_flight)
+metrics.gauge("llm_queued_requests", "実行待ちの推論リクエスト数", lambda: inference_executor.queued)
+
+# エンドポイントとステータスコードごとにリクエスト数を数える
+app.add_middleware(RequestCountingMiddleware, registry=metrics)
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
     content: str
 
+# 優先度クラス（値が小さいほど先に実行する）
+PRIORITY_CLASSES = {"interactive": 0, "normal": 1, "batch": 2}
+DEFAULT_PRIORITY = "normal"
+
 # 直接プロンプトを使用した簡略化されたリクエスト
 class SimpleGenerationRequest(BaseModel):
     prompt: str
+    model: Optional[str] = None  # 省略時は既定のモデル
+    priority: Optional[str] = None  # "interactive" / "normal" / "batch"（省略時は normal）
+    deadline_ms: Optional[float] = None  # 受信からこの時間内に実行が始まらなければ破棄する（ミリ秒）
+    speculative: Optional[bool] = None  # 投機的デコーディングを使うか（省略時はサーバーの設定）
     max_new_tokens: Optional[int] = 512
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
 
+# 1件の推論のフェーズごとの所要時間（秒）とトークン数
+class GenerationTimings(BaseModel):
+    queue_wait: float       # 受信から推論スレッドで実行が始まるまで
+    tokenization: float     # チャットテンプレートの適用とトークン化（最初の順伝播まで）
+    prefill: float          # プロンプトの処理（最初のトークンの生成まで）
+    decode: float           # 2トークン目以降の生成
+    extraction: float       # 出力からの応答の抽出
+    prompt_tokens: int
+    generated_tokens: int
+    tokens_per_second: float  # デコードの速度
+
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    timings: Optional[GenerationTimings] = None  # キャッシュから返した場合はNone
+
+# バッチ生成の各プロンプト（未指定のパラメータはリクエスト全体の値を使う）
+class BatchGenerationItem(BaseModel):
+    prompt: str
+    max_new_tokens: Optional[int] = None
+    do_sample: Optional[bool] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+
+class BatchGenerationRequest(BaseModel):
+    prompts: List[Union[str, BatchGenerationItem]]
+    model: Optional[str] = None  # 省略時は既定のモデル
+    priority: Optional[str] = None  # "interactive" / "normal" / "batch"（省略時は normal）
+    deadline_ms: Optional[float] = None  # 受信からこの時間内に実行が始まらなければ破棄する（ミリ秒）
+    speculative: Optional[bool] = None  # 投機的デコーディングを使うか（省略時はサーバーの設定）
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+
+class BatchGenerationResult(BaseModel):
+    generated_text: str
+    response_time: float
+    timings: Optional[GenerationTimings] = None  # キャッシュから返した場合はNone
+
+class BatchGenerationResponse(BaseModel):
+    results: List[BatchGenerationResult]
+    response_time: float
+
+# 会話履歴にチャットテンプレートを適用して続きを生成するリクエスト
+class ChatRequest(BaseModel):
+    messages: List[Message]
+    session_id: Optional[str] = None  # 前のターンで返されたID（省略時は新しい会話）
+    model: Optional[str] = None  # 省略時は既定のモデル
+    priority: Optional[str] = None  # "interactive" / "normal" / "batch"（省略時は normal）
+    deadline_ms: Optional[float] = None  # 受信からこの時間内に実行が始まらなければ破棄する（ミリ秒）
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+
+class ChatResponse(BaseModel):
+    message: Message
+    session_id: str
+    response_time: float
+    reused_tokens: int  # 前のターンのKVキャッシュを再利用してプレフィルを省いたトークン数
+    timings: Optional[GenerationTimings] = None
 
 # --- モデル関連の関数 ---
 # モデルのグローバル変数
 model = None
+model_load_duration = None
+# 投機的デコーディング用のドラフトモデル（DRAFT_MODEL_NAME未設定または読み込み失敗時はNone）
+draft_model = None
+# ウォームアップの結果（コールド/ウォームの実行時間。/health で公開する）
+warmup_report = None
+# プリフォーク起動（prefork.py）時に、全ワーカーの健康状態を返す関数が設定される
+worker_health = None
+
+# モデル名 -> 実際に使っている推論モード（/health で公開する）
+inference_modes = {}
+
+def create_pipeline(model_name):
+    """指定したモデルのtext-generationパイプラインを作る（失敗時は例外を送出）"""
+    backend = config.INFERENCE_BACKEND
+    if backend not in BACKENDS:
+        print(f"警告: 不明なINFERENCE_BACKEND '{backend}' のため 'transformers' を使用します")
+        backend = "transformers"
+    if backend == "stub":
+        print(f"スタブのバックエンドを使用します (モデル名: {model_name}, {config.STUB_TOKEN_DELAY_MS}ms/トークン)")
+        inference_modes[model_name] = {"device": "cpu", "mode": "stub", "benchmark": {}}
+        return create_stub_pipeline(
+            model_name,
+            token_delay=config.STUB_TOKEN_DELAY_MS / 1000,
+            prefill_token_delay=config.STUB_PREFILL_DELAY_MS / 1000,
+            memory_bytes=config.STUB_MEMORY_MB * 1024 * 1024,
+        )
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"使用デバイス: {device}")
+    cpu_mode = config.CPU_INFERENCE_MODE
+    if cpu_mode not in CPU_MODES + ("auto",):
+        print(f"警告: 不明なCPU_INFERENCE_MODE '{cpu_mode}' のため 'bf16' を使用します")
+        cpu_mode = "bf16"
+    torch_dtype = torch.bfloat16 if device == "cuda" else load_dtype_for_mode(cpu_mode)
+    pipe = create_transformers_pipeline(model_name, device, torch_dtype)
+    if device == "cuda":
+        inference_modes[model_name] = {"device": device, "mode": "bf16", "benchmark": {}}
+    else:
+        mode, benchmark = apply_cpu_mode(
+            pipe, cpu_mode, lambda dtype: create_transformers_pipeline(model_name, device, dtype).model
+        )
+        inference_modes[model_name] = {"device": device, "mode": mode, "benchmark": benchmark}
+    return pipe
+
+def estimate_pipeline_bytes(model_name):
+    """create_pipeline() で読み込む前に、モデルが使うメモリのバイト数を見積もる"""
+    if config.INFERENCE_BACKEND == "stub":
+        return config.STUB_MEMORY_MB * 1024 * 1024
+    if torch.cuda.is_available():
+        return estimate_transformers_model_bytes(model_name, torch.bfloat16)
+    # int8・autoはfp32で読み込んでから変換するため、読み込み中はfp32の分が必要になる
+    return estimate_transformers_model_bytes(model_name, load_dtype_for_mode(config.CPU_INFERENCE_MODE))
 
 def load_model():
     """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+    global model, model_load_duration  # グローバル変数を更新するために必要
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用デバイス: {device}")
-        pipe = pipeline(
-            "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+        load_start = time.perf_counter()
+        pipe = create_pipeline(config.MODEL_NAME)
+        load_time = time.perf_counter() - load_start
+        metrics.set_gauge("llm_model_load_seconds", load_time)
+        model_load_duration = load_time
+        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました ({load_time:.2f}秒)")
+        if config.DRAFT_MODEL_NAME:
+            load_draft(pipe)
+        if config.TORCH_COMPILE:
+            compile_model(pipe, config.TORCH_COMPILE_MODE)
+        if config.WARMUP_ENABLED:
+            warm_up(pipe)
+        model = pipe  # グローバル変数を更新（ウォームアップが終わってからリクエストを受け付ける）
         return pipe
     except Exception as e:
         error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
@@ -81,6 +303,69 @@ def load_model():
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
+def load_draft(pipe):
+    """投機的デコーディング用のドラフトモデルを本体と同じデバイス・推論モードで読み込む"""
+    global draft_model
+    mode = inference_modes.get(config.MODEL_NAME, {}).get("mode", "bf16")
+    device = pipe.model.device
+    try:
+        draft = load_draft_model(
+            config.DRAFT_MODEL_NAME, device, load_dtype_for_mode(mode), config.MODEL_NAME, pipe.tokenizer
+        )
+        if device.type == "cpu" and mode == "int8":
+            draft.model = convert_model(draft.model, "int8")
+        draft_model = draft
+        print(f"ドラフトモデル '{config.DRAFT_MODEL_NAME}' を読み込みました (推論モード: {mode})")
+    except Exception as e:
+        # ドラフトモデルがなくても通常の生成はできるため、警告だけ出して続行する
+        print(f"警告: ドラフトモデル '{config.DRAFT_MODEL_NAME}' の読み込みに失敗しました。投機的デコーディングは無効です: {e}")
+        traceback.print_exc()
+
+def warm_up(pipe):
+    """実際のバッチサイズで推論を数回実行し、初回の遅さを起動時に済ませておく"""
+    global warmup_report, draft_model
+    start = time.perf_counter()
+    report = {"torch_compile": config.TORCH_COMPILE}
+    try:
+        report["batches"] = warmup_pipeline(
+            pipe,
+            config.WARMUP_BATCH_SIZES,
+            rounds=config.WARMUP_ROUNDS,
+            max_new_tokens=config.WARMUP_MAX_NEW_TOKENS,
+        )
+    except Exception as e:
+        if not config.TORCH_COMPILE:
+            raise
+        # コンパイル済みのモデルが実行時に失敗した場合は、通常の実行に戻してやり直す
+        print(f"警告: torch.compile したモデルの実行に失敗したため、通常の実行に戻します: {e}")
+        traceback.print_exc()
+        uncompile_model(pipe)
+        report["torch_compile"] = False
+        report["batches"] = warmup_pipeline(
+            pipe,
+            config.WARMUP_BATCH_SIZES,
+            rounds=config.WARMUP_ROUNDS,
+            max_new_tokens=config.WARMUP_MAX_NEW_TOKENS,
+        )
+    if draft_model is not None:
+        try:
+            report["speculative"] = warmup_pipeline(
+                pipe,
+                [1],
+                rounds=2,
+                max_new_tokens=config.WARMUP_MAX_NEW_TOKENS,
+                extra_generate_kwargs=draft_model.generate_kwargs(pipe),
+            )["1"]
+        except Exception as e:
+            # このモデルの組み合わせでは投機的デコーディングが使えないため、無効にして続行する
+            print(f"警告: 投機的デコーディングのウォームアップに失敗したため無効にします: {e}")
+            traceback.print_exc()
+            draft_model = None
+    report["duration_seconds"] = time.perf_counter() - start
+    metrics.set_gauge("llm_warmup_seconds", report["duration_seconds"])
+    print(f"ウォームアップが完了しました ({report['duration_seconds']:.2f}秒)")
+    warmup_report = report
+
 def extract_assistant_response(outputs, user_prompt):
     """モデルの出力からアシスタントの応答を抽出する"""
     assistant_response = ""
@@ -130,15 +415,508 @@ def extract_assistant_response(outputs, user_prompt):
 
     return assistant_response
 
+# --- 推論の計測 ---
+# 推論スレッドごとの計測中のGenerationProbe（モデルの順伝播のフックから参照する）
+_active_probe = threading.local()
+
+def _mark_forward_start(module, args):
+    """モデルの最初の順伝播の開始時刻を記録する（ここまでがトークン化などの前処理）"""
+    probe = getattr(_active_probe, "probe", None)
+    if probe is not None and probe.forward_start_time is None:
+        probe.forward_start_time = time.perf_counter()
+
+class GenerationProbe(StoppingCriteria):
+    """デコードの各ステップの時刻を記録するStoppingCriteria（生成自体は止めない）
+
+    model を渡すと、その順伝播の開始時刻も記録し、トークン化とプレフィルを分けて計測する。
+    """
+
+    def __init__(self, model=None):
+        self.start_time = time.perf_counter()
+        self.forward_start_time = None
+        self.first_step_time = None
+        self.last_step_time = None
+        self.steps = 0  # 本体モデルの順伝播（デコードステップ）の回数
+        if model is not None:
+            if not getattr(model, "_generation_probe_hooked", False):
+                model.register_forward_pre_hook(_mark_forward_start)
+                model._generation_probe_hooked = True
+            _active_probe.probe = self
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        self.steps += 1
+        if self.first_step_time is None:
+            self.first_step_time = now
+        self.last_step_time = now
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    @property
+    def tokenization_time(self):
+        """生成の呼び出しからモデルの最初の順伝播が始まるまでの時間"""
+        if self.forward_start_time is None:
+            return 0.0
+        return self.forward_start_time - self.start_time
+
+    @property
+    def prefill_time(self):
+        """最初のトークンが生成されるまでの時間（トークン化は除く）"""
+        if self.first_step_time is None:
+            return 0.0
+        return self.first_step_time - (self.forward_start_time or self.start_time)
+
+    @property
+    def decode_time(self):
+        """2トークン目以降の生成にかかった時間"""
+        if self.first_step_time is None:
+            return 0.0
+        return self.last_step_time - self.first_step_time
+
+class CancellationCriteria(StoppingCriteria):
+    """キャンセルされた行の生成を次のデコードステップで止めるStoppingCriteria
+
+    cancel_events はバッチの行ごとの threading.Event（Noneならキャンセルされない）。
+    全行が止まるとgenerate()が終了し、推論スレッドが解放される。
+    """
+
+    def __init__(self, cancel_events):
+        self.cancel_events = list(cancel_events)
+        self.stopped = set()  # 生成中にキャンセルされた行
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = []
+        for row, event in enumerate(self.cancel_events):
+            cancelled = event is not None and event.is_set()
+            if cancelled and row not in self.stopped:
+                self.stopped.add(row)
+                metrics.inc("llm_cancelled_requests_total", stage="decode")
+            flags.append(cancelled)
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+async def watch_disconnect(http_request, cancel_event, endpoint_name):
+    """クライアントが切断したら cancel_event をセットする（セットされるかタスクがキャンセルされるまで監視する）"""
+    while not cancel_event.is_set():
+        await asyncio.sleep(config.DISCONNECT_CHECK_INTERVAL)
+        if await http_request.is_disconnected():
+            print(f"{endpoint_name}: クライアントが切断したため生成を中止します")
+            cancel_event.set()
+
+@contextlib.asynccontextmanager
+async def cancel_on_disconnect(http_request, endpoint_name):
+    """リクエストの処理中にクライアントが切断したらセットされるEventを返す"""
+    cancel_event = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(http_request, cancel_event, endpoint_name))
+    try:
+        yield cancel_event
+    except BaseException:
+        # ハンドラーがキャンセル（サーバーの停止など）されたり例外で抜けたりした場合も、
+        # 推論スレッドの生成を次のデコードステップで止める
+        cancel_event.set()
+        raise
+    finally:
+        watcher.cancel()
+
+def deadline_exceeded_response():
+    """期限までに実行を開始できなかったリクエストへの応答"""
+    return HTTPException(status_code=504, detail="期限までに推論を開始できなかったため、リクエストを破棄しました")
+
+def cancelled_response():
+    """切断済みのクライアント向けの応答（499 Client Closed Request）"""
+    return HTTPException(status_code=499, detail="クライアントが切断したため生成を中止しました")
+
+def count_tokens(pipe, text):
+    """テキストのトークン数を数える"""
+    return len(pipe.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def record_generation_metrics(probe, prompt_tokens, generated_tokens):
+    """1回の推論の計測結果をメトリクスに記録する（推論スレッドから呼ばれる）"""
+    metrics.observe("llm_prefill_seconds", probe.prefill_time)
+    metrics.observe("llm_decode_seconds", probe.decode_time)
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens)
+    metrics.inc("llm_generated_tokens_total", generated_tokens)
+    if probe.decode_time > 0:
+        metrics.observe("llm_tokens_per_second", generated_tokens / probe.decode_time)
+
+def phase_timings(queue_wait, probe, prompt_tokens, generated_tokens, extraction=0.0):
+    """1件の推論のフェーズごとの所要時間をまとめる（GenerationTimingsのフィールド）"""
+    return {
+        "queue_wait": max(0.0, queue_wait),
+        "tokenization": probe.tokenization_time,
+        "prefill": probe.prefill_time,
+        "decode": probe.decode_time,
+        "extraction": extraction,
+        "prompt_tokens": prompt_tokens,
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": generated_tokens / probe.decode_time if probe.decode_time > 0 else 0.0,
+    }
+
+def server_timing_header(timings):
+    """GenerationTimingsをServer-Timing形式（ミリ秒）のヘッダー値にする"""
+    return ", ".join([
+        f"queue;dur={timings.queue_wait * 1000:.1f}",
+        f"tokenize;dur={timings.tokenization * 1000:.1f}",
+        f"prefill;dur={timings.prefill * 1000:.1f}",
+        f"decode;dur={timings.decode * 1000:.1f}",
+        f"extract;dur={timings.extraction * 1000:.1f}",
+        f'tokens;desc="prompt={timings.prompt_tokens} generated={timings.generated_tokens}'
+        f' tps={timings.tokens_per_second:.1f}"',
+    ])
+
+def speculative_generate_kwargs(pipe, speculative):
+    """投機的デコーディングを使う場合に生成へ渡す引数（推論スレッドから呼ばれる）"""
+    if not speculative or draft_model is None:
+        return {}
+    draft_model.begin()
+    return draft_model.generate_kwargs(pipe)
+
+def record_speculation(model_name, speculative, probe, generated_tokens, batch_size=1):
+    """投機的デコーディングの採択率と、比較用の通常の生成速度を記録する
+
+    ドラフトモデルは既定モデル専用のため、他のモデルの生成は比較にも含めない。
+    """
+    if draft_model is None or model_name != draft_model.target_name or probe.decode_time <= 0:
+        return
+    if speculative:
+        accepted, proposed = draft_model.record(probe.steps, generated_tokens, probe.decode_time)
+        metrics.inc("llm_draft_tokens_total", proposed)
+        metrics.inc("llm_draft_accepted_tokens_total", accepted)
+    elif batch_size == 1:
+        # バッチ推論は1件あたりの速度が変わるため、1件ずつの生成だけを比較に使う
+        draft_model.record_baseline(generated_tokens, probe.decode_time)
+
+# --- 推論の実行 ---
+# ブロッキングな推論は専用スレッドで実行し、イベントループを塞がないようにする
+inference_executor = InferenceExecutor(
+    max_concurrency=config.INFERENCE_MAX_CONCURRENCY,
+    max_queue=config.INFERENCE_MAX_QUEUE,
+)
+
+def reserve_inference_slot(n=1):
+    """推論の待ち行列に枠を確保する。満杯なら503とRetry-Afterを返す"""
+    try:
+        inference_executor.reserve(n)
+    except QueueFullError as e:
+        print(f"推論キューが満杯のためリクエストを拒否しました (待ち={inference_executor.queued}, 実行中={inference_executor.in_flight})")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# --- 応答キャッシュ ---
+response_cache = ResponseCache(
+    max_bytes=config.RESPONSE_CACHE_MAX_BYTES,
+    ttl_seconds=config.RESPONSE_CACHE_TTL,
+)
+
+def generation_cache_key(model_name, prompt, max_new_tokens, do_sample, temperature, top_p):
+    """キャッシュ対象（決定的な生成）ならキャッシュキーを、そうでなければNoneを返す"""
+    if not config.RESPONSE_CACHE_ENABLED or do_sample:
+        return None
+    return make_cache_key(
+        model_name,
+        prompt,
+        max_new_tokens=max_new_tokens,
+        do_sample=do_sample,
+        temperature=temperature,
+        top_p=top_p,
+    )
+
+def is_cache_bypassed(header_value):
+    """X-Cache-Bypassヘッダーでキャッシュの参照をスキップするよう指定されているか"""
+    return header_value is not None and header_value.strip().lower() in ("1", "true", "yes")
+
+# --- マイクロバッチング ---
+def run_batch(prompts, generation_kwargs, cancel_events=None, deadlines=None):
+    """複数のプロンプトを1回のパディング済みバッチとしてパイプラインに渡す
+
+    プロンプトごとに (出力, 計測結果) を返す。計測結果は実行開始時刻（started_at）と
+    フェーズごとの所要時間・トークン数の辞書。実行開始前にキャンセルされた
+    プロンプトは推論せず、出力はNoneになる。実行開始時に期限（deadlines, time.monotonic()基準）を
+    過ぎていたプロンプトも推論せず、(出力, 計測結果) の代わりに DeadlineExceeded を返す。
+    """
+    model_name = generation_kwargs.pop("model_name", config.MODEL_NAME)
+    speculative = generation_kwargs.pop("speculative", False)
+    pipe = model_registry.peek(model_name)
+    if pipe is None:
+        raise RuntimeError(f"モデル '{model_name}' が読み込まれていません")
+    started_at = time.perf_counter()
+    if cancel_events is None:
+        cancel_events = [None] * len(prompts)
+    if deadlines is None:
+        deadlines = [None] * len(prompts)
+
+    # 実行枠を待つ間にキャンセルされたもの・期限を過ぎたものはバッチから外す
+    # （スケジューラは送り出す前にも確認するが、推論の実行枠が空くまでの間に期限を過ぎることがある）
+    results = [(None, {"started_at": started_at}) for _ in prompts]
+    now = time.monotonic()
+    live = []
+    for i, (event, deadline) in enumerate(zip(cancel_events, deadlines)):
+        if event is not None and event.is_set():
+            metrics.inc("llm_cancelled_requests_total", stage="queued")
+        elif deadline is not None and now > deadline:
+            metrics.inc("llm_deadline_exceeded_total")
+            results[i] = DeadlineExceeded()
+        else:
+            live.append(i)
+    if not live:
+        return results
+    all_prompts = prompts
+    prompts = [all_prompts[i] for i in live]
+
+    probe = GenerationProbe(pipe.model)
+    cancellation = CancellationCriteria(cancel_events[i] for i in live)
+    outputs = pipe(
+        prompts,
+        batch_size=len(prompts),
+        stopping_criteria=StoppingCriteriaList([probe, cancellation]),
+        **speculative_generate_kwargs(pipe, speculative),
+        **generation_kwargs,
+    )
+    # 入力がリストの場合、出力はプロンプトごとの出力リストになる
+    token_counts = []
+    for prompt, output in zip(prompts, outputs):
+        n_prompt = count_tokens(pipe, prompt)
+        n_generated = 0
+        if output and isinstance(output[0].get("generated_text"), str):
+            # 出力にはプロンプトも含まれるため、その分を差し引く
+            n_generated = max(0, count_tokens(pipe, output[0]["generated_text"]) - n_prompt)
+        token_counts.append((n_prompt, n_generated))
+    prompt_tokens = sum(n_prompt for n_prompt, _ in token_counts)
+    generated_tokens = sum(n_generated for _, n_generated in token_counts)
+    record_generation_metrics(probe, prompt_tokens, generated_tokens)
+    record_speculation(model_name, speculative, probe, generated_tokens, len(prompts))
+    for i, output, (n_prompt, n_generated) in zip(live, outputs, token_counts):
+        timings = phase_timings(0.0, probe, n_prompt, n_generated)
+        timings["started_at"] = started_at
+        results[i] = (output, timings)
+    return results
+
+async def execute_batch(prompts, generation_kwargs, cancel_events, priority, deadlines):
+    """バッチ推論を推論スレッドで実行する（期限は実行開始時に run_batch がプロンプトごとに確認する）"""
+    return await inference_executor.run(
+        run_batch, prompts, generation_kwargs, cancel_events, deadlines, requests=len(prompts), priority=priority
+    )
+
+def discard_requests(n, reason):
+    """実行前に破棄されたリクエスト（クライアントの切断・期限切れ）の枠を返す"""
+    if reason == "expired":
+        metrics.inc("llm_deadline_exceeded_total", n)
+    else:
+        metrics.inc("llm_cancelled_requests_total", n, stage="queued")
+    inference_executor.release(n)
+
+batch_scheduler = BatchScheduler(
+    execute_batch,
+    max_batch_size=config.BATCH_MAX_SIZE,
+    max_wait_ms=config.BATCH_MAX_WAIT_MS,
+    max_concurrent_batches=config.INFERENCE_MAX_CONCURRENCY,
+    on_discard=discard_requests,
+)
+
+# --- 会話（/chat） ---
+# 会話ごとのKVキャッシュ（次のターンでは新しく追加された部分だけをプレフィルする）
+session_cache = SessionCache(max_bytes=config.CHAT_SESSION_CACHE_MB * 1024 * 1024)
+
+def run_chat(pipe, messages, state, generation_kwargs, cancel_event, submitted_at):
+    """会話履歴の続きを生成する（推論スレッドで実行される）
+
+    state は同じ会話の前のターンの SessionState（なければNone）。共通する先頭部分の
+    KVキャッシュを再利用する。(応答, 新しいSessionState, 再利用したトークン数, 計測結果) を返し、
+    実行前にキャンセルされていた場合はNoneを返す。
+    """
+    if cancel_event.is_set():
+        metrics.inc("llm_cancelled_requests_total", stage="queued")
+        return None
+    probe = GenerationProbe(pipe.model)
+    stopping_criteria = StoppingCriteriaList([probe, CancellationCriteria([cancel_event])])
+    if not hasattr(pipe.model, "generate"):
+        # KVキャッシュを扱えないバックエンド（スタブ）では毎回全体をプレフィルする
+        outputs = pipe(messages, stopping_criteria=stopping_criteria, **generation_kwargs)
+        extraction_start = time.perf_counter()
+        text = extract_assistant_response(outputs, None)
+        prompt_tokens = count_tokens(pipe, pipe.tokenizer.apply_chat_template(messages, tokenize=False))
+        generated_tokens = count_tokens(pipe, text)
+        record_generation_metrics(probe, prompt_tokens, generated_tokens)
+        timings = phase_timings(probe.start_time - submitted_at, probe, prompt_tokens, generated_tokens,
+                                time.perf_counter() - extraction_start)
+        return text, None, 0, timings
+
+    # transformers のバージョンによってはテンソルではなく BatchEncoding が返るため、辞書で受け取る
+    input_ids = pipe.tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_tensors="pt", return_dict=True
+    )["input_ids"].to(pipe.model.device)
+    reused = 0
+    past_key_values = DynamicCache()
+    if state is not None:
+        # 前のターンと一致する部分だけを残す（最後の1トークンは次のトークンを得るためにプレフィルする）
+        reused = min(common_prefix_length(state.input_ids, input_ids[0]), input_ids.shape[1] - 1)
+        if reused > 0:
+            past_key_values = state.past_key_values
+            if past_key_values.get_seq_length() > reused:
+                past_key_values.crop(reused)
+
+    with torch.no_grad():
+        output_ids = pipe.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            stopping_criteria=stopping_criteria,
+            pad_token_id=pipe.tokenizer.pad_token_id,
+            **generation_kwargs,
+        )
+    extraction_start = time.perf_counter()
+    new_tokens = output_ids[0, input_ids.shape[1]:]
+    text = pipe.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+    extraction_time = time.perf_counter() - extraction_start
+
+    prompt_tokens = input_ids.shape[1]
+    record_generation_metrics(probe, prompt_tokens, len(new_tokens))
+    timings = phase_timings(probe.start_time - submitted_at, probe, prompt_tokens, len(new_tokens), extraction_time)
+    # KVキャッシュには最後に生成したトークンを除く全トークン分が入っている
+    new_state = SessionState(output_ids[0, :past_key_values.get_seq_length()], past_key_values)
+    return text, new_state, reused, timings
+
+# --- ストリーミング ---
+class CountingTextIteratorStreamer(TextIteratorStreamer):
+    """生成されたトークン数を数えながらテキストを順次返すストリーマー"""
+
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.token_count = 0
+
+    def put(self, value):
+        # 最初の呼び出しはプロンプト部分なので数えない
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.token_count += value.numel()
+        super().put(value)
+
+def format_sse(event, data):
+    """Server-Sent Events形式のメッセージを組み立てる"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def start_stream_generation(request, model_entry, http_request, priority_class, deadline, speculative):
+    """推論スレッドで生成を開始し、デコードされたテキストをSSEイベントとして順次返す非同期ジェネレーターを返す
+
+    生成タスクはここで作成するため、レスポンス本体が一度も読み出されなかった場合
+    （ストリームの開始前にクライアントが切断した場合など）でも、待ち行列の枠は
+    inference_executor.run() の finally で、モデルは生成タスクの完了時に解放される。
+    本体の読み出しが始まるまではクライアントの切断を監視し、切断されたら生成を止める。
+    """
+    pipe = model_entry.pipe
+    cancel_event = threading.Event()
+    submitted_at = time.perf_counter()
+    start_time = submitted_at
+    streamer = CountingTextIteratorStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+    timings = {}
+
+    def generate():
+        if cancel_event.is_set():
+            metrics.inc("llm_cancelled_requests_total", stage="queued")
+            streamer.end()
+            return
+        probe = GenerationProbe(pipe.model)
+        metrics.observe("llm_queue_wait_seconds", probe.start_time - submitted_at, priority=priority_class)
+        try:
+            pipe(
+                request.prompt,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([probe, CancellationCriteria([cancel_event])]),
+                **speculative_generate_kwargs(pipe, speculative),
+                max_new_tokens=request.max_new_tokens,
+                do_sample=request.do_sample,
+                temperature=request.temperature,
+                top_p=request.top_p,
+            )
+        except Exception as e:
+            print(f"ストリーミング生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            errors.append(e)
+            streamer.end()  # 読み出し側が待ち続けないように終了を通知
+            return
+        prompt_tokens = count_tokens(pipe, request.prompt)
+        record_generation_metrics(probe, prompt_tokens, streamer.token_count)
+        record_speculation(model_entry.name, speculative, probe, streamer.token_count)
+        timings.update(phase_timings(probe.start_time - submitted_at, probe, prompt_tokens, streamer.token_count))
+
+    watcher = asyncio.create_task(watch_disconnect(http_request, cancel_event, "generate/stream"))
+
+    def on_generation_done(task):
+        watcher.cancel()
+        model_registry.release(model_entry)
+        if task.cancelled() or task.exception() is not None:
+            streamer.end()  # 実行前にキャンセル・期限切れになった場合も読み出し側を解放する
+
+    # 枠はエンドポイント側でreserve済み（実行されずに終わった場合は run() が返却する）
+    generation_task = asyncio.create_task(
+        inference_executor.run(generate, priority=PRIORITY_CLASSES[priority_class], deadline=deadline)
+    )
+    generation_task.add_done_callback(on_generation_done)
+
+    async def events():
+        # 読み出しが始まった後の切断は、ストリームが閉じられることで検知する
+        watcher.cancel()
+        try:
+            first_token_time = None
+            chunks = []
+            tokens = iter(streamer)
+            while True:
+                # ストリーマーの読み出しはブロッキングなので、イベントループの外で待つ
+                text = await asyncio.to_thread(next, tokens, None)
+                if text is None:
+                    break
+                if not text:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                chunks.append(text)
+                yield format_sse("token", {"text": text})
+            try:
+                await generation_task
+            except DeadlineExceeded as e:
+                metrics.inc("llm_deadline_exceeded_total")
+                yield format_sse("error", {"detail": str(e)})
+                return
+
+            if errors:
+                yield format_sse("error", {"detail": f"応答の生成中にエラーが発生しました: {str(errors[0])}"})
+                return
+
+            end_time = time.perf_counter()
+            response_time = end_time - start_time
+            time_to_first_token = (first_token_time - start_time) if first_token_time else response_time
+            decode_time = end_time - first_token_time if first_token_time else 0.0
+            tokens_per_second = streamer.token_count / decode_time if decode_time > 0 else 0.0
+            metrics.observe("llm_request_duration_seconds", response_time, endpoint="/generate/stream", priority=priority_class)
+            print(f"ストリーミング応答生成時間: {response_time:.2f}秒 (最初のトークンまで: {time_to_first_token:.2f}秒, {tokens_per_second:.1f} tokens/s)")
+            yield format_sse("done", {
+                "generated_text": "".join(chunks).strip(),
+                "response_time": response_time,
+                "time_to_first_token": time_to_first_token,
+                "generated_tokens": streamer.token_count,
+                "tokens_per_second": tokens_per_second,
+                "timings": timings or None,
+            })
+        finally:
+            # クライアントが切断してストリームが閉じられた場合も、生成を次のステップで止める
+            cancel_event.set()
+
+    return events()
+
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
+    """起動時にモデルの読み込みをバックグラウンドで開始"""
+    if model is not None:
+        # プリフォーク起動（prefork.py）では、親プロセスで読み込んだモデルをそのまま使う
+        model_loader.mark_ready(model, load_duration=model_load_duration)
     else:
-        print("起動時にモデルの初期化が完了しました。")
+        # 読み込み中もサーバーは起動し、/health で読み込み状態を確認できる
+        model_loader.start()
+    batch_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時にバッチスケジューラと推論スレッドを停止"""
+    await batch_scheduler.stop()
+    inference_executor.shutdown()
 
 @app.get("/")
 async def root():
@@ -149,59 +927,377 @@ async def root():
 async def health_check():
     """ヘルスチェックエンドポイント"""
     global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    if not model_loader.is_ready:
+        # 準備ができるまでは503を返し、オーケストレーターがトラフィックを流さないようにする
+        return JSONResponse(
+            status_code=503,
+            content={
+                "status": "loading" if model_loader.state in (LOADING, RETRYING) else "error",
+                "message": "No model loaded",
+                "model_state": model_loader.status(),
+            },
+        )
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+    result = {
+        "status": "ok",
+        "model": config.MODEL_NAME,
+        "model_state": model_loader.status(),
+        "available_models": config.AVAILABLE_MODELS,
+        "models": model_registry.stats(),
+        "inference_modes": inference_modes,
+        "warmup": warmup_report,
+        "batching": {
+            "max_batch_size": batch_scheduler.max_batch_size,
+            "max_wait_ms": batch_scheduler.max_wait * 1000,
+            "batches_run": batch_scheduler.batches_run,
+            "expired": batch_scheduler.expired,
+            "average_batch_size": batch_scheduler.average_batch_size,
+        },
+        "inference": inference_executor.stats(),
+        "cache": response_cache.stats(),
+        "chat_sessions": session_cache.stats(),
+        "speculative": {
+            "enabled_by_default": config.SPECULATIVE_DECODING and draft_model is not None,
+            **(draft_model.stats() if draft_model is not None else {"draft_model": None}),
+        },
+    }
+    if worker_health is not None:
+        result["workers"] = worker_health()
+    return result
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
+async def generate_simple(
+    request: SimpleGenerationRequest,
+    response: Response,
+    http_request: Request,
+    x_cache_bypass: Optional[str] = Header(None),
+):
     """単純なプロンプト入力に基づいてテキストを生成"""
     global model
+    model_name = resolve_model_name(request.model)
+    priority_class, deadline = resolve_schedule(request.priority, request.deadline_ms)
+    speculative = resolve_speculative(request.speculative, model_name)
 
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    # 決定的な生成（do_sample=False）は同じ入力なら同じ結果になるため、キャッシュから返す
+    cache_key = generation_cache_key(
+        model_name,
+        request.prompt,
+        request.max_new_tokens,
+        request.do_sample,
+        request.temperature,
+        request.top_p,
+    )
+    if cache_key is not None:
+        start_time = time.perf_counter()
+        if is_cache_bypassed(x_cache_bypass):
+            response.headers["X-Cache"] = "BYPASS"
+        else:
+            cached_text = response_cache.get(cache_key)
+            if cached_text is not None:
+                response.headers["X-Cache"] = "HIT"
+                return GenerationResponse(
+                    generated_text=cached_text,
+                    response_time=time.perf_counter() - start_time
+                )
+            response.headers["X-Cache"] = "MISS"
 
+    model_entry = await acquire_model(model_name, "generate")
     try:
-        start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+        reserve_inference_slot()
+        async with cancel_on_disconnect(http_request, "generate") as cancel_event:
+            return await _generate_simple(
+                request, response, model_name, cache_key, cancel_event, priority_class, deadline, speculative
+            )
+    finally:
+        model_registry.release(model_entry)
 
-        # プロンプトテキストで直接応答を生成
+async def _generate_simple(request, response, model_name, cache_key, cancel_event, priority_class, deadline,
+                           speculative):
+    """マイクロバッチングのスケジューラ経由で推論し、応答を組み立てる"""
+    try:
+        submitted_at = time.perf_counter()
+        start_time = submitted_at
+        print(f"シンプルなリクエストを受信: model={model_name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+
+        # プロンプトテキストで直接応答を生成（同じパラメータのリクエストとまとめてバッチ推論）
         print("モデル推論を開始...")
-        outputs = model(
+        outputs, phases = await batch_scheduler.submit(
             request.prompt,
+            cancel_event=cancel_event,
+            priority=PRIORITY_CLASSES[priority_class],
+            deadline=deadline,
+            model_name=model_name,
+            speculative=speculative,
             max_new_tokens=request.max_new_tokens,
             do_sample=request.do_sample,
             temperature=request.temperature,
             top_p=request.top_p,
         )
+        if cancel_event.is_set():
+            # 途中で止めた出力はキャッシュせず、切断済みのクライアントには何も返さない
+            raise cancelled_response()
+        started_at = phases.pop("started_at")
+        metrics.observe("llm_queue_wait_seconds", started_at - submitted_at, priority=priority_class)
         print("モデル推論が完了しました。")
 
         # アシスタント応答を抽出
+        extraction_start = time.perf_counter()
         assistant_response = extract_assistant_response(outputs, request.prompt)
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        timings = GenerationTimings(**{
+            **phases,
+            "queue_wait": max(0.0, started_at - submitted_at),
+            "extraction": time.perf_counter() - extraction_start,
+        })
+        response.headers["X-Server-Timing"] = server_timing_header(timings)
 
-        end_time = time.time()
+        end_time = time.perf_counter()
         response_time = end_time - start_time
         print(f"応答生成時間: {response_time:.2f}秒")
+        metrics.observe("llm_request_duration_seconds", response_time, endpoint="/generate", priority=priority_class)
+
+        if cache_key is not None:
+            response_cache.put(cache_key, assistant_response)
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            timings=timings,
         )
 
+    except RequestCancelled:
+        raise cancelled_response()
+    except DeadlineExceeded:
+        print(f"期限切れのためリクエストを破棄しました (優先度={priority_class}, 期限={request.deadline_ms}ms)")
+        raise deadline_exceeded_response()
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"シンプル応答生成中にエラーが発生しました: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest, http_request: Request):
+    """単純なプロンプト入力に基づいて、生成されたトークンをServer-Sent Eventsで順次返す"""
+    model_name = resolve_model_name(request.model)
+    priority_class, deadline = resolve_schedule(request.priority, request.deadline_ms)
+    speculative = resolve_speculative(request.speculative, model_name)
+
+    # モデルは生成タスクの完了時に解放する
+    model_entry = await acquire_model(model_name, "generate/stream")
+    try:
+        reserve_inference_slot()
+    except HTTPException:
+        model_registry.release(model_entry)
+        raise
+    print(f"ストリーミングリクエストを受信: model={model_name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")
+    return StreamingResponse(
+        start_stream_generation(request, model_entry, http_request, priority_class, deadline, speculative),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(
+    request: BatchGenerationRequest,
+    http_request: Request,
+    x_cache_bypass: Optional[str] = Header(None),
+):
+    """複数のプロンプトをまとめて受け取り、バッチ推論した結果を入力と同じ順序で返す"""
+    model_name = resolve_model_name(request.model)
+    priority_class, deadline = resolve_schedule(request.priority, request.deadline_ms)
+    speculative = resolve_speculative(request.speculative, model_name)
+
+    if len(request.prompts) > config.BATCH_REQUEST_MAX_PROMPTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"1リクエストのプロンプト数は{config.BATCH_REQUEST_MAX_PROMPTS}件までです。分割して送信してください。",
+        )
+
+    # プロンプトごとのパラメータを解決する（未指定ならリクエスト全体の値を使う）
+    items = []
+    for entry in request.prompts:
+        if isinstance(entry, str):
+            entry = BatchGenerationItem(prompt=entry)
+        items.append({
+            "prompt": entry.prompt,
+            "max_new_tokens": entry.max_new_tokens if entry.max_new_tokens is not None else request.max_new_tokens,
+            "do_sample": entry.do_sample if entry.do_sample is not None else request.do_sample,
+            "temperature": entry.temperature if entry.temperature is not None else request.temperature,
+            "top_p": entry.top_p if entry.top_p is not None else request.top_p,
+        })
+
+    start_time = time.perf_counter()
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        item["cache_key"] = generation_cache_key(
+            model_name,
+            item["prompt"],
+            item["max_new_tokens"],
+            item["do_sample"],
+            item["temperature"],
+            item["top_p"],
+        )
+        if item["cache_key"] is not None and not is_cache_bypassed(x_cache_bypass):
+            cached_text = response_cache.get(item["cache_key"])
+            if cached_text is not None:
+                results[index] = BatchGenerationResult(generated_text=cached_text, response_time=time.perf_counter() - start_time)
+                continue
+        pending.append(index)
+
+    if pending:
+        model_entry = await acquire_model(model_name, "generate/batch")
+        try:
+            reserve_inference_slot(len(pending))
+            print(f"バッチリクエストを受信: {len(items)}件 (推論対象 {len(pending)}件)")
+
+            async def run_item(index):
+                item = items[index]
+                item_start = time.perf_counter()
+                outputs, phases = await batch_scheduler.submit(
+                    item["prompt"],
+                    cancel_event=cancel_event,
+                    priority=PRIORITY_CLASSES[priority_class],
+                    deadline=deadline,
+                    model_name=model_name,
+                    speculative=speculative,
+                    max_new_tokens=item["max_new_tokens"],
+                    do_sample=item["do_sample"],
+                    temperature=item["temperature"],
+                    top_p=item["top_p"],
+                )
+                if cancel_event.is_set():
+                    raise RequestCancelled()
+                started_at = phases.pop("started_at")
+                extraction_start = time.perf_counter()
+                assistant_response = extract_assistant_response(outputs, item["prompt"])
+                timings = GenerationTimings(**{
+                    **phases,
+                    "queue_wait": max(0.0, started_at - item_start),
+                    "extraction": time.perf_counter() - extraction_start,
+                })
+                if item["cache_key"] is not None:
+                    response_cache.put(item["cache_key"], assistant_response)
+                results[index] = BatchGenerationResult(
+                    generated_text=assistant_response,
+                    response_time=time.perf_counter() - item_start,
+                    timings=timings,
+                )
+
+            # マイクロバッチングのスケジューラが同じパラメータのものをまとめて推論する
+            try:
+                async with cancel_on_disconnect(http_request, "generate/batch") as cancel_event:
+                    tasks = [asyncio.create_task(run_item(index)) for index in pending]
+                    try:
+                        await asyncio.gather(*tasks)
+                    except BaseException:
+                        # 1件でも失敗したらリクエスト全体が失敗するため、残りの生成も止める
+                        cancel_event.set()
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        raise
+            except RequestCancelled:
+                raise cancelled_response()
+            except DeadlineExceeded:
+                raise deadline_exceeded_response()
+            except Exception as e:
+                print(f"バッチ応答生成中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+        finally:
+            model_registry.release(model_entry)
+
+    response_time = time.perf_counter() - start_time
+    print(f"バッチ応答生成時間: {response_time:.2f}秒 ({len(items)}件)")
+    metrics.observe("llm_request_duration_seconds", response_time, endpoint="/generate/batch", priority=priority_class)
+    return BatchGenerationResponse(results=results, response_time=response_time)
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, response: Response, http_request: Request):
+    """会話履歴にチャットテンプレートを適用して、アシスタントの次の発言を生成する
+
+    同じ session_id で続けて呼ぶと、前のターンのKVキャッシュを再利用して
+    新しく追加されたメッセージの分だけをプレフィルする。
+    """
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messages を1件以上指定してください")
+    model_name = resolve_model_name(request.model)
+    priority_class, deadline = resolve_schedule(request.priority, request.deadline_ms)
+    session_id = request.session_id or uuid.uuid4().hex
+    session_key = (model_name, session_id)
+    messages = [{"role": message.role, "content": message.content} for message in request.messages]
+    generation_kwargs = dict(
+        max_new_tokens=request.max_new_tokens,
+        do_sample=request.do_sample,
+        temperature=request.temperature,
+        top_p=request.top_p,
+    )
+
+    model_entry = await acquire_model(model_name, "chat")
+    try:
+        reserve_inference_slot()
+        submitted_at = time.perf_counter()
+        print(f"チャットリクエストを受信: model={model_name}, session={session_id}, messages={len(messages)}件")
+        # 生成中はKVキャッシュが書き換えられるため、会話の状態はキャッシュから取り出して使う
+        state = session_cache.take(session_key)
+        try:
+            async with cancel_on_disconnect(http_request, "chat") as cancel_event:
+                result = await inference_executor.run(
+                    run_chat,
+                    model_entry.pipe,
+                    messages,
+                    state,
+                    generation_kwargs,
+                    cancel_event,
+                    submitted_at,
+                    priority=PRIORITY_CLASSES[priority_class],
+                    deadline=deadline,
+                )
+        except DeadlineExceeded:
+            metrics.inc("llm_deadline_exceeded_total")
+            print(f"期限切れのためリクエストを破棄しました (優先度={priority_class}, 期限={request.deadline_ms}ms)")
+            raise deadline_exceeded_response()
+        except Exception as e:
+            print(f"チャット応答生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+        if result is None or cancel_event.is_set():
+            # 途中で止めた会話のKVキャッシュは保存しない
+            raise cancelled_response()
+    finally:
+        model_registry.release(model_entry)
+
+    text, new_state, reused, phases = result
+    if new_state is not None:
+        session_cache.put(session_key, new_state)
+    session_cache.record(reused, phases["prompt_tokens"] - reused)
+    metrics.inc("llm_chat_reused_tokens_total", reused)
+    metrics.observe("llm_queue_wait_seconds", phases["queue_wait"], priority=priority_class)
+
+    timings = GenerationTimings(**phases)
+    response.headers["X-Server-Timing"] = server_timing_header(timings)
+    response_time = time.perf_counter() - submitted_at
+    print(f"チャット応答生成時間: {response_time:.2f}秒 (再利用 {reused}トークン / プロンプト {phases['prompt_tokens']}トークン)")
+    metrics.observe("llm_request_duration_seconds", response_time, endpoint="/chat", priority=priority_class)
+    return ChatResponse(
+        message=Message(role="assistant", content=text),
+        session_id=session_id,
+        response_time=response_time,
+        reused_tokens=reused,
+        timings=timings,
+    )
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus形式のメトリクスを返す"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
+    """モデルを読み込むバックグラウンドタスク（ModelLoaderからスレッドで呼ばれる）"""
     global model
     print("load_model_task: モデルの読み込みを開始...")
     # load_model関数を呼び出し、結果をグローバル変数に設定
@@ -211,6 +1307,91 @@ def load_model_task():
         print("load_model_task: モデルの読み込みが完了しました。")
     else:
         print("load_model_task: モデルの読み込みに失敗しました。")
+    return loaded_pipe
+
+# 既定モデル以外はリクエストに応じて読み込み、メモリ予算を超えたら古いものから解放する
+model_registry = ModelRegistry(
+    create_pipeline,
+    memory_budget_bytes=config.MODEL_MEMORY_BUDGET_GB * 1024 ** 3,
+    estimate_fn=estimate_pipeline_bytes,
+)
+
+# 読み込みは同時に1つだけ実行し、失敗時は指数バックオフで再試行する
+model_loader = ModelLoader(
+    load_model_task,
+    max_retries=config.MODEL_LOAD_MAX_RETRIES,
+    backoff_base=config.MODEL_LOAD_BACKOFF_BASE,
+    backoff_max=config.MODEL_LOAD_BACKOFF_MAX,
+    # 既定モデルは常駐させる（追い出さない）
+    on_ready=lambda pipe: model_registry.register(config.MODEL_NAME, pipe, pinned=True),
+)
+
+async def ensure_model_ready(endpoint_name):
+    """モデルの準備ができていなければ、読み込み完了を待つか503を返す
+
+    load_model() は読み込みスレッドでグローバル変数 model を設定するが、既定モデルが
+    レジストリに登録されるのはその後の on_ready なので、model ではなく読み込み状態で判定する。
+    """
+    if model_loader.is_ready:
+        return
+    print(f"{endpoint_name}エンドポイント: モデルが準備できていません (状態: {model_loader.state})")
+    if not await model_loader.wait_ready(config.MODEL_WAIT_TIMEOUT):
+        raise HTTPException(
+            status_code=503,
+            detail=f"モデルが利用できません (状態: {model_loader.state})。後でもう一度お試しください。",
+            headers={"Retry-After": str(model_loader.retry_after())},
+        )
+
+def resolve_model_name(requested):
+    """リクエストで指定されたモデル名を検証する（省略時は既定のモデル）"""
+    model_name = requested or config.MODEL_NAME
+    if model_name not in config.AVAILABLE_MODELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"モデル '{model_name}' は利用できません。利用可能なモデル: {', '.join(config.AVAILABLE_MODELS)}",
+        )
+    return model_name
+
+def resolve_schedule(priority, deadline_ms):
+    """優先度クラスを検証し、期限（time.monotonic()基準、指定がなければNone）を求める"""
+    priority_class = priority or DEFAULT_PRIORITY
+    if priority_class not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"優先度 '{priority_class}' は利用できません。利用可能な優先度: {', '.join(PRIORITY_CLASSES)}",
+        )
+    deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None
+    return priority_class, deadline
+
+def resolve_speculative(requested, model_name):
+    """投機的デコーディングを使うかを決める（省略時はサーバーの設定に従う）
+
+    ドラフトモデルは既定モデル用に読み込むため、他のモデルでは使わない。
+    """
+    available = draft_model is not None and model_name == draft_model.target_name
+    if requested is None:
+        return config.SPECULATIVE_DECODING and available
+    if requested and draft_model is None:
+        raise HTTPException(
+            status_code=400,
+            detail="ドラフトモデルが読み込まれていないため、投機的デコーディングは利用できません (DRAFT_MODEL_NAME を設定してください)",
+        )
+    if requested and not available:
+        raise HTTPException(
+            status_code=400,
+            detail=f"投機的デコーディングは既定のモデル '{draft_model.target_name}' でのみ利用できます",
+        )
+    return requested
+
+async def acquire_model(model_name, endpoint_name):
+    """モデルを取得して使用中にする。使い終わったら model_registry.release() で解放する"""
+    if model_name == config.MODEL_NAME:
+        await ensure_model_ready(endpoint_name)
+    try:
+        return await model_registry.acquire(model_name)
+    except Exception as e:
+        print(f"{endpoint_name}エンドポイント: モデル '{model_name}' の読み込みに失敗しました: {e}")
+        raise HTTPException(status_code=503, detail=f"モデル '{model_name}' が利用できません。後でもう一度お試しください。")
 
 print("FastAPIエンドポイントを定義しました。")
 
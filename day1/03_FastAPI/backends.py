@@ -0,0 +1,216 @@
+# backends.py
+# 推論バックエンドの切り替え
+# どのバックエンドも transformers の text-generation パイプラインと同じ呼び出し方
+# （pipe(プロンプト, ...) / pipe.tokenizer / pipe.model）で使えるオブジェクトを返す。
+# スタブは実モデルの代わりに決定的なトークンを一定の間隔で生成するため、ネットワークや
+# モデルのダウンロードなしでサービス自体（バッチング・待ち行列・メトリクス）を計測できる。
+import hashlib
+import random
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, pipeline
+
+BACKENDS = ("transformers", "stub")
+
+STUB_WORDS = [
+    "これは", "スタブ", "モデル", "の", "決定的な", "応答", "です", "。",
+    "推論", "サーバー", "バッチ", "待ち行列", "を", "計測", "します", "、",
+]
+
+
+def create_transformers_pipeline(model_name, device, torch_dtype):
+    """Hugging Face のモデルを読み込んだ text-generation パイプライン"""
+    pipe = pipeline(
+        "text-generation",
+        model=model_name,
+        model_kwargs={"torch_dtype": torch_dtype},
+        device=device
+    )
+    # バッチ推論用にパディングを左側に揃える（デコーダのみのモデルでは必須）
+    if pipe.tokenizer.pad_token is None:
+        pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+    pipe.tokenizer.padding_side = "left"
+    return pipe
+
+
+def estimate_transformers_model_bytes(model_name, torch_dtype):
+    """モデルを読み込む前に、torch_dtype で読み込んだときのパラメータのバイト数を見積もる
+
+    設定ファイルだけを取得し、meta デバイス上に重みを確保せずにモデルを組み立ててパラメータ数を数える。
+    """
+    model_config = AutoConfig.from_pretrained(model_name)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(model_config)
+    return sum(p.numel() for p in model.parameters()) * torch_dtype.itemsize
+
+
+class StubTokenizer:
+    """1文字を1トークンとする決定的なトークナイザー（パイプラインから使われる部分のみ）"""
+
+    pad_token = "<pad>"
+    eos_token = "</s>"
+    pad_token_id = 0
+    eos_token_id = 1
+    _offset = 2  # 文字のトークンIDは特殊トークンの後ろから始める
+
+    def __init__(self):
+        self.padding_side = "left"
+
+    def get_vocab(self):
+        return {self.pad_token: self.pad_token_id, self.eos_token: self.eos_token_id}
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(ch) + self._offset for ch in text]
+
+    def __call__(self, text, add_special_tokens=False, return_tensors=None):
+        input_ids = self.encode(text)
+        if return_tensors == "pt":
+            input_ids = torch.tensor([input_ids], dtype=torch.long)
+        return {"input_ids": input_ids}
+
+    def decode(self, token_ids, skip_special_tokens=True, **kwargs):
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        chars = []
+        for token_id in token_ids:
+            if token_id >= self._offset:
+                chars.append(chr(token_id - self._offset))
+            elif not skip_special_tokens:
+                chars.append(self.eos_token if token_id == self.eos_token_id else self.pad_token)
+        return "".join(chars)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, return_tensors=None, **kwargs):
+        text = "".join(f"<{m['role']}>\n{m['content']}\n" for m in messages)
+        if add_generation_prompt:
+            text += "<assistant>\n"
+        if not tokenize:
+            return text
+        return self(text, return_tensors=return_tensors)["input_ids"]
+
+
+class StubModel(torch.nn.Module):
+    """順伝播のたびに決まった時間だけ待つモデル
+
+    重みの代わりに指定したサイズのバッファを確保するため、ModelRegistry のメモリ予算の
+    計算にも実モデルと同じように含まれる。
+    """
+
+    def __init__(self, memory_bytes, token_delay, prefill_token_delay):
+        super().__init__()
+        self.register_buffer("weights", torch.zeros(max(1, int(memory_bytes)), dtype=torch.uint8))
+        self.token_delay = token_delay
+        self.prefill_token_delay = prefill_token_delay
+
+    @property
+    def device(self):
+        return self.weights.device
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def forward(self, input_ids, prefill=False):
+        # プレフィルはプロンプト長に比例し、デコードは1ステップごとに一定の時間がかかる
+        delay = self.prefill_token_delay * input_ids.shape[1] if prefill else self.token_delay
+        if delay > 0:
+            time.sleep(delay)
+        return input_ids
+
+
+class StubPipeline:
+    """text-generation パイプラインと同じ入出力で、プロンプトから決まるテキストを生成する
+
+    do_sample や temperature などのサンプリングの指定は無視し、同じプロンプトには
+    常に同じ応答を max_new_tokens トークンちょうどで返す。
+    """
+
+    def __init__(self, model_name, token_delay=0.02, prefill_token_delay=0.0005, memory_bytes=256 * 1024 * 1024):
+        self.model_name = model_name
+        self.tokenizer = StubTokenizer()
+        self.model = StubModel(memory_bytes, token_delay, prefill_token_delay)
+
+    def completion(self, prompt, max_new_tokens):
+        """プロンプトに対して生成するテキスト（プロンプトのハッシュから決まる）"""
+        seed = int.from_bytes(hashlib.sha256(f"{self.model_name}\n{prompt}".encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        text = ""
+        while len(text) < max_new_tokens:
+            text += rng.choice(STUB_WORDS)
+        return text[:max_new_tokens]
+
+    def __call__(self, text_inputs, batch_size=None, max_new_tokens=256, stopping_criteria=None, streamer=None,
+                 return_full_text=True, **generate_kwargs):
+        # 文字列1つ、またはメッセージのリスト1つなら単一の入力として扱う
+        single = isinstance(text_inputs, str) or (
+            isinstance(text_inputs, list) and bool(text_inputs) and isinstance(text_inputs[0], dict)
+        )
+        inputs = [text_inputs] if single else list(text_inputs)
+        prompts = [
+            self.tokenizer.apply_chat_template(item) if isinstance(item, list) else item
+            for item in inputs
+        ]
+        completions = self._generate(prompts, max_new_tokens, stopping_criteria, streamer)
+
+        outputs = []
+        for item, prompt, completion in zip(inputs, prompts, completions):
+            if isinstance(item, list):
+                generated = item + [{"role": "assistant", "content": completion}]
+            else:
+                generated = prompt + completion if return_full_text else completion
+            outputs.append([{"generated_text": generated}])
+        return outputs[0] if single else outputs
+
+    def _generate(self, prompts, max_new_tokens, stopping_criteria, streamer):
+        """左パディングしたバッチを1トークンずつ生成し、行ごとの生成テキストを返す"""
+        rows = [self.tokenizer.encode(prompt) for prompt in prompts]
+        targets = [self.tokenizer.encode(self.completion(prompt, max_new_tokens)) for prompt in prompts]
+        width = max(len(row) for row in rows)
+        input_ids = torch.tensor(
+            [[self.tokenizer.pad_token_id] * (width - len(row)) + row for row in rows], dtype=torch.long
+        )
+        if streamer is not None:
+            streamer.put(input_ids)
+        self.model(input_ids, prefill=True)
+
+        generated = [[] for _ in prompts]
+        finished = [False] * len(prompts)
+        for step in range(max_new_tokens):
+            self.model(input_ids[:, -1:])
+            next_tokens = []
+            for row, target in enumerate(targets):
+                if finished[row]:
+                    next_tokens.append(self.tokenizer.pad_token_id)
+                    continue
+                token = target[step] if step < len(target) else self.tokenizer.eos_token_id
+                if token == self.tokenizer.eos_token_id:
+                    finished[row] = True
+                else:
+                    generated[row].append(token)
+                next_tokens.append(token)
+            next_tokens = torch.tensor(next_tokens, dtype=torch.long)
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=1)
+            if streamer is not None:
+                streamer.put(next_tokens)
+            if stopping_criteria is not None:
+                stop = stopping_criteria(input_ids, None)
+                if isinstance(stop, torch.Tensor):
+                    stop = stop.tolist()
+                elif not isinstance(stop, list):
+                    stop = [bool(stop)] * len(prompts)
+                finished = [done or bool(flag) for done, flag in zip(finished, stop)]
+            if all(finished):
+                break
+        if streamer is not None:
+            streamer.end()
+        return [self.tokenizer.decode(tokens) for tokens in generated]
+
+
+def create_stub_pipeline(model_name, token_delay=0.02, prefill_token_delay=0.0005, memory_bytes=256 * 1024 * 1024):
+    """実モデルを読み込まないスタブのパイプライン"""
+    return StubPipeline(
+        model_name,
+        token_delay=token_delay,
+        prefill_token_delay=prefill_token_delay,
+        memory_bytes=memory_bytes,
+    )
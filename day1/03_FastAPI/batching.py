@@ -0,0 +1,272 @@
+# batching.py
+# /generate へのリクエストを数ミリ秒だけ溜め、生成パラメータが同じものを
+# 1つのパディング済みバッチとしてまとめて推論するマイクロバッチングスケジューラ
+import asyncio
+import math
+import time
+import traceback
+
+from executor import DeadlineExceeded
+
+
+class RequestCancelled(Exception):
+    """クライアントの切断により、実行前にリクエストが破棄されたことを表す例外"""
+
+
+class PendingRequest:
+    """バッチ待ちのリクエスト1件分"""
+
+    def __init__(self, prompt, generation_kwargs, future, cancel_event=None, priority=0, deadline=None):
+        self.prompt = prompt
+        self.generation_kwargs = generation_kwargs
+        self.future = future
+        self.cancel_event = cancel_event  # クライアントが切断したらセットされる threading.Event
+        self.priority = priority  # 小さいほど優先
+        self.deadline = deadline  # time.monotonic()基準の期限（Noneなら期限なし）
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def sort_key(self):
+        """実行順のキー（優先度→期限→到着順）"""
+        deadline = self.deadline if self.deadline is not None else math.inf
+        return (self.priority, deadline, self.enqueued_at)
+
+    def expired(self, now):
+        return self.deadline is not None and now > self.deadline
+
+    @property
+    def abandoned(self):
+        """呼び出し側が結果を待つのをやめているか"""
+        return self.future.done() or (self.cancel_event is not None and self.cancel_event.is_set())
+
+
+def batch_key(generation_kwargs):
+    """同じバッチにまとめられるかどうかを判定するキーを作る（モデルが違うものはまとめない）"""
+    model_name = generation_kwargs.get("model_name")
+    speculative = bool(generation_kwargs.get("speculative"))
+    max_new_tokens = generation_kwargs.get("max_new_tokens")
+    if not generation_kwargs.get("do_sample"):
+        # 貪欲法ではtemperature/top_pは使われないため、値が違ってもまとめてよい
+        return (model_name, speculative, max_new_tokens, False, None, None)
+    return (
+        model_name,
+        speculative,
+        max_new_tokens,
+        True,
+        generation_kwargs.get("temperature"),
+        generation_kwargs.get("top_p"),
+    )
+
+
+def batch_generation_kwargs(key):
+    """バッチキーからパイプラインに渡す生成パラメータを組み立てる"""
+    model_name, speculative, max_new_tokens, do_sample, temperature, top_p = key
+    kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample}
+    if do_sample:
+        kwargs["temperature"] = temperature
+        kwargs["top_p"] = top_p
+    if model_name is not None:
+        kwargs["model_name"] = model_name
+    if speculative:
+        kwargs["speculative"] = True
+    return kwargs
+
+
+class BatchScheduler:
+    """リクエストを短時間集め、互換性のあるものをまとめて実行するスケジューラ
+
+    execute_batch は (prompts, generation_kwargs, cancel_events, priority, deadlines) を受け取り、
+    プロンプトと同じ順序でパイプラインの出力リストを返すコルーチン関数。cancel_events はプロンプトごとの
+    キャンセル通知用 threading.Event（指定がなければNone）のリスト、priority はバッチ内で
+    最も高い優先度、deadlines はプロンプトごとの期限（time.monotonic()基準、指定がなければNone）のリスト。
+    出力の代わりに例外（実行開始時に期限を過ぎていた場合の DeadlineExceeded など）が入っている
+    プロンプトは、その例外を呼び出し元に送出する。
+    on_discard は実行前に破棄されたリクエスト数と理由（"cancelled" または "expired"）を
+    受け取るコールバック（待ち行列の枠の返却用）。
+
+    実行枠が空くたびに、待っているリクエストの中で最も優先されるもの（優先度→期限→到着順）を
+    含むバッチを1つだけ実行し、残りは次の枠まで待たせる。
+    """
+
+    def __init__(self, execute_batch, max_batch_size=8, max_wait_ms=10.0, max_concurrent_batches=1,
+                 on_discard=None):
+        self.execute_batch = execute_batch
+        self.on_discard = on_discard
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_concurrent_batches = max(1, int(max_concurrent_batches))
+        self._queue = None
+        self._worker = None
+        self._pending = []  # キューから取り出したが、まだ実行していないリクエスト
+        # 実行スロット。空きがない間はリクエストがキューに溜まり、次のバッチにまとめられる
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._tasks = set()
+        # 統計情報
+        self.batches_run = 0
+        self.requests_batched = 0
+        self.expired = 0  # 実行前に期限を過ぎて破棄したリクエスト数
+
+    def start(self):
+        """バックグラウンドでバッチ処理ループを開始する"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+            print(f"バッチスケジューラを開始しました (最大バッチサイズ={self.max_batch_size}, 最大待機={self.max_wait * 1000:.1f}ms)")
+
+    async def stop(self):
+        """バッチ処理ループを停止し、待機中のリクエストを失敗させる"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        for task in list(self._tasks):
+            task.cancel()
+        self._drain()
+        for item in self._pending:
+            if not item.future.done():
+                item.future.set_exception(RuntimeError("バッチスケジューラが停止しました"))
+        self._pending = []
+
+    async def submit(self, prompt, cancel_event=None, priority=0, deadline=None, **generation_kwargs):
+        """プロンプトをキューに入れ、バッチ実行後の出力を待つ
+
+        cancel_event がセットされると、実行前なら破棄し、実行中なら次のデコードステップで止める。
+        deadline（time.monotonic()基準）までに実行が始まらなければ DeadlineExceeded を送出する。
+        """
+        if self._worker is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(PendingRequest(prompt, generation_kwargs, future, cancel_event, priority, deadline))
+        return await future
+
+    @property
+    def average_batch_size(self):
+        if self.batches_run == 0:
+            return 0.0
+        return self.requests_batched / self.batches_run
+
+    def _drain(self):
+        """キューに溜まっているリクエストをすべて待ち行列に移す"""
+        while not self._queue.empty():
+            self._pending.append(self._queue.get_nowait())
+
+    async def _collect(self):
+        """最初のリクエストから最大待機時間だけ、後続のリクエストを集める"""
+        self._pending.append(await self._queue.get())
+        deadline = time.monotonic() + self.max_wait
+        while len(self._pending) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self._pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 待機中に溜まった分もまとめて取り出す
+        self._drain()
+
+    def _prune(self):
+        """呼び出し側が待つのをやめたものと、期限を過ぎたものを実行前に破棄する"""
+        now = time.monotonic()
+        live = []
+        cancelled = 0
+        expired = 0
+        for item in self._pending:
+            if item.abandoned:  # 呼び出し側が既に待つのをやめている
+                cancelled += 1
+                if not item.future.done():
+                    item.future.set_exception(RequestCancelled())
+            elif item.expired(now):
+                expired += 1
+                item.future.set_exception(DeadlineExceeded())
+            else:
+                live.append(item)
+        self._pending = live
+        self.expired += expired
+        if self.on_discard:
+            if cancelled:
+                self.on_discard(cancelled, "cancelled")
+            if expired:
+                self.on_discard(expired, "expired")
+
+    def _next_batch(self):
+        """最も優先されるリクエストと、それとまとめられるリクエストで1つのバッチを作る"""
+        self._prune()
+        if not self._pending:
+            return None
+        self._pending.sort(key=lambda item: item.sort_key)
+        key = batch_key(self._pending[0].generation_kwargs)
+        # 同じパラメータのものを優先順に最大バッチサイズまで詰める
+        # （投機的デコーディングはtransformersがバッチサイズ1にしか対応していないため1件ずつ）
+        limit = 1 if key[1] else self.max_batch_size
+        items = [item for item in self._pending if batch_key(item.generation_kwargs) == key][:limit]
+        chosen = set(map(id, items))
+        self._pending = [item for item in self._pending if id(item) not in chosen]
+        return key, items
+
+    async def _run(self):
+        while True:
+            # 空きスロットができてから集め始めることで、実行待ちの間に届いた分も同じバッチに入る
+            await self._slots.acquire()
+            try:
+                batch = None
+                while batch is None:
+                    if self._pending:
+                        self._drain()  # 前回の残りがあれば待たずに次のバッチを作る
+                    else:
+                        await self._collect()
+                    batch = self._next_batch()
+            except BaseException:
+                self._slots.release()
+                raise
+
+            key, items = batch
+            task = asyncio.create_task(self._dispatch(key, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._on_dispatch_done)
+
+    def _on_dispatch_done(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _dispatch(self, key, items):
+        """1つのバッチを実行し、結果をそれぞれの呼び出し元に返す"""
+        prompts = [item.prompt for item in items]
+        waited = time.monotonic() - min(item.enqueued_at for item in items)
+        print(f"バッチ実行: サイズ={len(items)}, 最大待機={waited * 1000:.1f}ms, パラメータ={key}")
+        try:
+            outputs = await self.execute_batch(
+                prompts,
+                batch_generation_kwargs(key),
+                [item.cancel_event for item in items],
+                min(item.priority for item in items),
+                [item.deadline for item in items],
+            )
+        except asyncio.CancelledError:
+            for item in items:
+                if not item.future.done():
+                    item.future.cancel()
+            raise
+        except Exception as e:
+            print(f"バッチ実行中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        self.batches_run += 1
+        self.requests_batched += len(items)
+        for item, output in zip(items, outputs):
+            if isinstance(output, DeadlineExceeded):
+                self.expired += 1
+            if item.future.done():
+                continue
+            if isinstance(output, Exception):
+                item.future.set_exception(output)
+            else:
+                item.future.set_result(output)
@@ -0,0 +1,93 @@
+# cache.py
+# do_sample=False の決定的な生成リクエストに対する応答キャッシュ（LRU + TTL、バイト数で上限管理）
+import hashlib
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """表記ゆれでキャッシュが外れないようにプロンプトを正規化する"""
+    return unicodedata.normalize("NFC", prompt).strip()
+
+
+def make_cache_key(model_name, prompt, **generation_kwargs):
+    """モデル名・正規化したプロンプト・全生成パラメータからキャッシュキーを作る"""
+    payload = {
+        "model": model_name,
+        "prompt": normalize_prompt(prompt),
+        "params": generation_kwargs,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """生成結果のLRUキャッシュ
+
+    max_bytes を超えると最も長く使われていないエントリから追い出し、
+    ttl_seconds を過ぎたエントリは参照時に破棄する。
+    イベントループのスレッドからのみ使う前提のため、ロックは持たない。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=600.0):
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.current_bytes = 0
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """キャッシュを参照する。見つからないか期限切れならNoneを返す"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, size, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """生成結果をキャッシュに保存する（上限を超える大きさのものは保存しない）"""
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, time.monotonic() + self.ttl_seconds)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self):
+        """/health で公開する統計情報"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,91 @@
+# cpu_inference.py
+# CPUでの推論モード（fp32 / bf16 / int8動的量子化）の切り替えと、起動時の簡易ベンチマーク
+import gc
+import time
+import traceback
+
+import torch
+
+CPU_MODES = ("fp32", "bf16", "int8")
+BENCHMARK_PROMPT = "日本の首都はどこですか？"
+
+
+def load_dtype_for_mode(mode):
+    """モデル読み込み時に指定するdtype（int8とautoはfp32で読み込んでから変換する）"""
+    if mode == "bf16":
+        return torch.bfloat16
+    return torch.float32
+
+
+def convert_model(model, mode):
+    """fp32で読み込んだモデルを指定モードに変換する（モデルはその場で書き換わる）"""
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8":
+        # Linear層の重みをint8に量子化し、活性は実行時に動的に量子化する
+        # （inplace=False だとモデル全体を複製するため、fp32のモデル2つ分のメモリが必要になる）
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def benchmark_pipeline(pipe, max_new_tokens=16, runs=2):
+    """短い貪欲生成を数回実行し、生成トークン数/秒を返す"""
+    # 1回目は初期化のコストを含むため捨てる
+    pipe(BENCHMARK_PROMPT, max_new_tokens=4, do_sample=False)
+    generated = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        outputs = pipe(BENCHMARK_PROMPT, max_new_tokens=max_new_tokens, do_sample=False, return_full_text=False)
+        generated += len(pipe.tokenizer(outputs[0]["generated_text"], add_special_tokens=False)["input_ids"])
+    elapsed = time.perf_counter() - start
+    return generated / elapsed if elapsed > 0 else 0.0
+
+
+def apply_cpu_mode(pipe, mode, load_model_fn=None):
+    """fp32で読み込んだパイプラインを指定モードに変換する
+
+    mode が "auto" の場合は fp32 → bf16 → int8 の順にモデルをその場で変換しながら計測し、
+    最も速いものを選ぶ。モデルを複製しないため、ピークのメモリはfp32のモデル1つ分に収まる。
+    変換は元に戻せないので、最速のモードが最後に計測したものでなければ、
+    load_model_fn(torch_dtype) でモデルを読み込み直してから変換する。
+    戻り値は (選ばれたモード, 各モードのtokens/sec)。
+    """
+    if mode in ("fp32", "bf16"):
+        # 読み込み時のdtypeで既に指定モードになっている
+        return mode, {}
+    if mode == "int8":
+        pipe.model = convert_model(pipe.model, "int8")
+        return mode, {}
+
+    results = {}
+    current = "fp32"  # 今のモデルの重みのモード（変換に失敗して不明になった場合はNone）
+    for candidate in CPU_MODES:
+        try:
+            if candidate == "bf16":
+                current = None
+                pipe.model = convert_model(pipe.model, "bf16")
+            elif candidate == "int8":
+                # bf16からfp32に戻してから量子化する（int8の誤差に比べてbf16の丸め誤差は無視できる）
+                current = None
+                pipe.model = convert_model(pipe.model.to(torch.float32), "int8")
+            current = candidate
+            results[candidate] = benchmark_pipeline(pipe)
+            print(f"CPU推論モード '{candidate}': {results[candidate]:.1f} tokens/s")
+        except Exception as e:
+            print(f"CPU推論モード '{candidate}' は利用できません: {e}")
+            traceback.print_exc()
+            if current is None:
+                break  # 変換の途中で失敗した場合は、以降のモードも計測できない
+        finally:
+            gc.collect()
+
+    best = max(results, key=results.get) if results else "fp32"
+    if best != current:
+        if load_model_fn is None:
+            raise RuntimeError(f"CPU推論モード '{best}' のモデルを読み込み直す方法がありません")
+        print(f"CPU推論モード '{best}' のモデルを読み込み直します...")
+        pipe.model = None
+        gc.collect()
+        pipe.model = convert_model(load_model_fn(load_dtype_for_mode(best)), best)
+    print(f"CPU推論モードとして '{best}' を選択しました")
+    return best, results
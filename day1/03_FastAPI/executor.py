@@ -0,0 +1,140 @@
+# executor.py
+# ブロッキングな推論処理を専用スレッドで実行し、同時実行数と待ち行列の長さを制限する
+import asyncio
+import functools
+import heapq
+import itertools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """待ち行列が満杯で、新しいリクエストを受け付けられないことを表す例外"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"推論キューが満杯です。{retry_after}秒後に再試行してください。")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """実行を開始する前にリクエストの期限が過ぎたことを表す例外"""
+
+    def __init__(self):
+        super().__init__("実行開始前にリクエストの期限を過ぎたため、処理を中止しました")
+
+
+class InferenceExecutor:
+    """推論専用のスレッドプール
+
+    リクエストは reserve() で待ち行列の枠を確保してから run() で実行する。
+    実行枠が空くと、待っている中で優先度（小さいほど優先）が最も高く、
+    同じ優先度なら期限が最も早いものから実行する。
+    カウンタはイベントループのスレッドからのみ更新されるため、ロックは不要。
+    """
+
+    def __init__(self, max_concurrency=1, max_queue=32):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="inference")
+        self._available = self.max_concurrency  # 空いている実行枠の数
+        self._waiters = []  # (優先度, 期限, 到着順, future) のヒープ
+        self._sequence = itertools.count()
+        # 統計情報
+        self.queued = 0      # 実行待ちのリクエスト数
+        self.in_flight = 0   # 実行中のリクエスト数
+        self.rejected = 0    # 待ち行列が満杯で断ったリクエスト数
+        self.expired = 0     # 実行前に期限を過ぎて破棄したリクエスト数
+        self._avg_service_time = None  # 1回の実行にかかる時間の指数移動平均（秒）
+
+    def reserve(self, n=1):
+        """待ち行列にn件分の枠を確保する。満杯ならQueueFullErrorを送出する"""
+        if self.queued + n > self.max_queue:
+            self.rejected += n
+            raise QueueFullError(self.retry_after())
+        self.queued += n
+
+    def release(self, n=1):
+        """実行されずに終わったリクエストの枠を返却する"""
+        self.queued = max(0, self.queued - n)
+
+    def retry_after(self):
+        """現在の待ち行列がはけるまでのおおよその秒数（Retry-Afterヘッダー用）"""
+        if self._avg_service_time is None:
+            return 1
+        waves = (self.queued + self.in_flight) / self.max_concurrency
+        return max(1, int(waves * self._avg_service_time + 0.999))
+
+    async def _acquire(self, priority, deadline):
+        """実行枠が空くまで待つ（優先度→期限→到着順に枠を割り当てる）"""
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, deadline if deadline is not None else math.inf, next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を割り当てられた直後にキャンセルされた場合は、次の待ち手に譲る
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        """実行枠を返し、待っている中で最も優先されるものに割り当てる"""
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[-1]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._available += 1
+
+    async def run(self, fn, *args, requests=1, priority=0, deadline=None, **kwargs):
+        """reserve()済みのrequests件分の処理として、fnを推論スレッドで実行する
+
+        deadline（time.monotonic()基準）を過ぎてから枠が空いた場合は、実行せずに
+        DeadlineExceededを送出する。
+        """
+        started = False
+        try:
+            await self._acquire(priority, deadline)
+            try:
+                if deadline is not None and time.monotonic() > deadline:
+                    self.expired += requests
+                    raise DeadlineExceeded()
+                started = True
+                self.queued = max(0, self.queued - requests)
+                self.in_flight += requests
+                start = time.monotonic()
+                try:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+                finally:
+                    self.in_flight -= requests
+                    elapsed = time.monotonic() - start
+                    if self._avg_service_time is None:
+                        self._avg_service_time = elapsed
+                    else:
+                        self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed
+            finally:
+                self._release_slot()
+        finally:
+            if not started:
+                # 実行前にキャンセルされた（または期限切れになった）場合は確保した枠を返す
+                self.release(requests)
+
+    def stats(self):
+        """/health で公開する統計情報"""
+        return {
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "saturated": self.queued >= self.max_queue,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,125 @@
+# loader.py
+# モデルの読み込みをバックグラウンドで1回だけ実行し、失敗時は指数バックオフで再試行する
+import asyncio
+import time
+import traceback
+
+# 読み込み状態
+NOT_LOADED = "not_loaded"
+LOADING = "loading"
+READY = "ready"
+RETRYING = "retrying"
+FAILED = "failed"
+
+
+class ModelLoader:
+    """モデル読み込みの状態を管理するクラス
+
+    load_fn は読み込んだモデルを返し、失敗時はNoneを返す（または例外を送出する）同期関数。
+    読み込みは同時に1つしか走らず、読み込み中に届いたリクエストはその完了を待つ。
+    on_ready は読み込み成功時にイベントループのスレッドで呼ばれるコールバック。
+    """
+
+    def __init__(self, load_fn, max_retries=5, backoff_base=5.0, backoff_max=300.0, on_ready=None):
+        self.load_fn = load_fn
+        self.on_ready = on_ready
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.state = NOT_LOADED
+        self.attempts = 0
+        self.last_error = None
+        self.load_duration = None
+        self.next_retry_at = None
+        self._ready = asyncio.Event()
+        self._task = None
+
+    @property
+    def is_ready(self):
+        return self.state == READY
+
+    def start(self):
+        """読み込みを開始する（既に読み込み中・読み込み済みなら何もしない）"""
+        if self.state == READY or (self._task is not None and not self._task.done()):
+            return
+        self.attempts = 0
+        self._task = asyncio.create_task(self._run())
+
+    def mark_ready(self, result, load_duration=None):
+        """別の場所（プリフォーク起動の親プロセスなど）で読み込み済みのモデルを登録する"""
+        self.load_duration = load_duration
+        self.last_error = None
+        if self.on_ready is not None:
+            self.on_ready(result)
+        self.state = READY
+        self._ready.set()
+
+    async def _run(self):
+        delay = self.backoff_base
+        while True:
+            self.state = LOADING
+            self.attempts += 1
+            self.next_retry_at = None
+            print(f"モデルの読み込みを開始します (試行 {self.attempts}回目)")
+            start_time = time.perf_counter()
+            try:
+                # 読み込みはブロッキングなのでスレッドで実行し、/health などの応答を止めない
+                result = await asyncio.to_thread(self.load_fn)
+                if result is None:
+                    self.last_error = "モデルの読み込みに失敗しました"
+            except Exception as e:
+                traceback.print_exc()
+                result = None
+                self.last_error = str(e)
+
+            if result is not None:
+                self.load_duration = time.perf_counter() - start_time
+                self.last_error = None
+                if self.on_ready is not None:
+                    self.on_ready(result)
+                self.state = READY
+                self._ready.set()
+                print(f"モデルの読み込みが完了しました ({self.load_duration:.2f}秒)")
+                return
+
+            if self.attempts > self.max_retries:
+                self.state = FAILED
+                print(f"モデルの読み込みを{self.attempts}回試行しましたが失敗しました: {self.last_error}")
+                return
+
+            self.state = RETRYING
+            self.next_retry_at = time.time() + delay
+            print(f"モデルの読み込みに失敗しました。{delay:.0f}秒後に再試行します: {self.last_error}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.backoff_max)
+
+    async def wait_ready(self, timeout):
+        """モデルの準備ができるまで最大timeout秒待つ。準備できればTrueを返す"""
+        if self.is_ready:
+            return True
+        if self.state in (NOT_LOADED, FAILED):
+            # 再試行を使い果たした後にリクエストが来た場合は、読み込みをもう一度始める
+            self.start()
+        if timeout <= 0:
+            return False
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def retry_after(self):
+        """クライアントに再試行を促すまでの秒数（Retry-Afterヘッダー用）"""
+        if self.state == RETRYING and self.next_retry_at is not None:
+            return max(1, int(self.next_retry_at - time.time()) + 1)
+        return 5
+
+    def status(self):
+        """/health で公開する読み込み状態"""
+        return {
+            "state": self.state,
+            "attempts": self.attempts,
+            "load_duration": self.load_duration,
+            "last_error": self.last_error,
+            "next_retry_at": self.next_retry_at,
+        }
@@ -0,0 +1,334 @@
+# loadtest.py
+# LLMClient を使ってAPIサーバーに負荷をかけ、レイテンシやスループットを計測する負荷試験ツール
+#
+# 使い方:
+#   同時実行数を固定（クローズドループ）: python loadtest.py --url http://localhost:8000 --concurrency 8 --requests 200
+#   到着レートを固定（オープンループ）:   python loadtest.py --url http://localhost:8000 --rate 2 --duration 60
+#   最初のトークンまでの時間を計測:       上記に --stream を付ける（/generate/stream を使う）
+#   非同期クライアントを使う:             --client async（httpx が必要）
+#   結果をJSONで保存:                      --output result.json
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _load_client_module():
+    """ファイル名にハイフンを含む python-client.py を読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-client.py")
+    spec = importlib.util.spec_from_file_location("python_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+python_client = _load_client_module()
+
+DEFAULT_PROMPTS = [
+    "AIについて100文字で教えてください",
+    "機械学習とは何ですか？50文字で答えてください",
+    "日本の首都について簡単に説明してください",
+    "Pythonの特徴を3つ挙げてください",
+]
+
+
+def percentile(values, p):
+    """最近傍順位法によるパーセンタイル（値がなければNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "min": min(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+class RequestResult:
+    """1リクエスト分の計測結果"""
+
+    def __init__(self, ok, latency, ttft=None, generated_tokens=None, error=None):
+        self.ok = ok
+        self.latency = latency
+        self.ttft = ttft
+        self.generated_tokens = generated_tokens
+        self.error = error  # HTTPステータスコード（文字列）または例外のクラス名
+
+    @property
+    def tokens_per_second(self):
+        """最初のトークン以降のデコード速度（ストリーミング時のみ）"""
+        if not self.generated_tokens or self.ttft is None or self.latency <= self.ttft:
+            return None
+        return self.generated_tokens / (self.latency - self.ttft)
+
+
+class LoadGenerator:
+    """LLMClient へのリクエストを非同期に発行して計測する
+
+    リクエストの発行タイミングの制御はイベントループで行う。HTTP通信は
+    use_async=False なら LLMClient（同期）をスレッドごとに1つずつ作って実行し、
+    use_async=True なら AsyncLLMClient の接続プールをイベントループ上で共有する。
+    """
+
+    def __init__(self, api_url, prompts, generation_kwargs, stream=False, max_outstanding=256, use_async=False):
+        self.api_url = api_url
+        self.prompts = prompts
+        self.generation_kwargs = generation_kwargs
+        self.stream = stream
+        self.max_outstanding = max_outstanding
+        self._pool = None
+        self._async_client = None
+        if use_async:
+            # 負荷試験ではサーバーの503をそのまま計測したいため、再試行はしない
+            self._async_client = python_client.AsyncLLMClient(api_url, pool_size=max_outstanding, max_retries=0)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=max_outstanding, thread_name_prefix="loadtest")
+        self._local = threading.local()
+        self.dropped = 0  # オープンループで同時実行数の上限に達して送れなかったリクエスト数
+
+    def _client(self):
+        # requests.Session はスレッド間で共有しない
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = python_client.LLMClient(self.api_url)
+            self._local.client = client
+        return client
+
+    def _send(self, prompt):
+        """1リクエストを送って計測する（スレッドプールで実行される）"""
+        client = self._client()
+        start = time.perf_counter()
+        try:
+            if not self.stream:
+                client.generate(prompt, **self.generation_kwargs)
+                return RequestResult(True, time.perf_counter() - start)
+            ttft = None
+            generated_tokens = None
+            for event, data in client.generate_stream(prompt, **self.generation_kwargs):
+                if event == "token" and ttft is None:
+                    ttft = time.perf_counter() - start
+                elif event == "done":
+                    generated_tokens = data.get("generated_tokens")
+            return RequestResult(True, time.perf_counter() - start, ttft, generated_tokens)
+        except python_client.LLMAPIError as e:
+            return RequestResult(False, time.perf_counter() - start, error=str(e.status_code))
+        except Exception as e:
+            return RequestResult(False, time.perf_counter() - start, error=type(e).__name__)
+
+    async def _send_async(self, prompt):
+        """1リクエストを非同期クライアントで送って計測する"""
+        client = self._async_client
+        start = time.perf_counter()
+        try:
+            if not self.stream:
+                await client.generate(prompt, **self.generation_kwargs)
+                return RequestResult(True, time.perf_counter() - start)
+            ttft = None
+            generated_tokens = None
+            async for event, data in client.generate_stream(prompt, **self.generation_kwargs):
+                if event == "token" and ttft is None:
+                    ttft = time.perf_counter() - start
+                elif event == "done":
+                    generated_tokens = data.get("generated_tokens")
+            return RequestResult(True, time.perf_counter() - start, ttft, generated_tokens)
+        except python_client.LLMAPIError as e:
+            return RequestResult(False, time.perf_counter() - start, error=str(e.status_code))
+        except Exception as e:
+            return RequestResult(False, time.perf_counter() - start, error=type(e).__name__)
+
+    async def request(self):
+        prompt = random.choice(self.prompts)
+        if self._async_client is not None:
+            return await self._send_async(prompt)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, self._send, prompt)
+
+    async def run_closed(self, concurrency, num_requests=None, duration=None):
+        """同時実行数を固定し、応答が返るたびに次のリクエストを送る"""
+        results = []
+        deadline = time.perf_counter() + duration if duration else None
+        issued = 0
+
+        async def user():
+            nonlocal issued
+            while True:
+                if num_requests is not None and issued >= num_requests:
+                    return
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                issued += 1
+                results.append(await self.request())
+
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return results
+
+    async def run_open(self, rate, num_requests=None, duration=None, poisson=False):
+        """応答を待たずに一定のレートでリクエストを送る（サーバーが遅れても送信は遅れない）"""
+        tasks = []
+        start = time.perf_counter()
+        next_send = start
+        issued = 0
+        while True:
+            if num_requests is not None and issued >= num_requests:
+                break
+            if duration is not None and next_send - start >= duration:
+                break
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            outstanding = sum(1 for task in tasks if not task.done())
+            if outstanding >= self.max_outstanding:
+                self.dropped += 1
+            else:
+                tasks.append(asyncio.create_task(self.request()))
+            issued += 1
+            interval = random.expovariate(rate) if poisson else 1.0 / rate
+            next_send += interval
+        return list(await asyncio.gather(*tasks))
+
+    async def shutdown(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+def build_report(results, elapsed, dropped=0):
+    """計測結果を集計する"""
+    succeeded = [r for r in results if r.ok]
+    errors = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    total = len(results) + dropped
+    generated = sum(r.generated_tokens or 0 for r in succeeded)
+    return {
+        "requests": total,
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "dropped": dropped,
+        "error_rate": (total - len(succeeded)) / total if total else 0.0,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+        "latency_seconds": summarize([r.latency for r in succeeded]),
+        "ttft_seconds": summarize([r.ttft for r in succeeded if r.ttft is not None]),
+        "tokens_per_second": summarize([r.tokens_per_second for r in succeeded if r.tokens_per_second is not None]),
+        "generated_tokens": generated,
+        "output_tokens_per_second": generated / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"リクエスト数: {report['requests']} (成功 {report['succeeded']}, 失敗 {report['failed']}, 未送信 {report['dropped']})")
+    print(f"エラー率: {report['error_rate'] * 100:.1f}% {report['errors'] or ''}")
+    print(f"経過時間: {report['elapsed_seconds']:.1f}秒, スループット: {report['throughput_rps']:.2f} req/s")
+    for key, label in (("latency_seconds", "レイテンシ"), ("ttft_seconds", "最初のトークンまで")):
+        stats = report[key]
+        if stats:
+            print(f"{label}: p50={stats['p50']:.3f}s p90={stats['p90']:.3f}s p99={stats['p99']:.3f}s (平均 {stats['mean']:.3f}s)")
+    if report["tokens_per_second"]:
+        stats = report["tokens_per_second"]
+        print(f"デコード速度: p50={stats['p50']:.1f} p90={stats['p90']:.1f} p99={stats['p99']:.1f} tokens/s")
+        print(f"全体の出力トークン: {report['generated_tokens']} ({report['output_tokens_per_second']:.1f} tokens/s)")
+
+
+async def run(args):
+    prompts = DEFAULT_PROMPTS
+    if args.prompts_file:
+        with open(args.prompts_file, encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    generation_kwargs = {
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+        "do_sample": not args.greedy,
+    }
+    max_outstanding = args.max_outstanding or (args.concurrency if args.rate is None else 256)
+    generator = LoadGenerator(
+        args.url,
+        prompts,
+        generation_kwargs,
+        stream=args.stream,
+        max_outstanding=max_outstanding,
+        use_async=args.client == "async",
+    )
+    try:
+        if args.warmup:
+            print(f"ウォームアップ: {args.warmup}件")
+            await generator.run_closed(min(args.concurrency, args.warmup), num_requests=args.warmup)
+
+        if args.requests is None and args.duration is None:
+            args.requests = 100
+        print(f"計測開始: {'レート ' + str(args.rate) + ' req/s' if args.rate else '同時実行数 ' + str(args.concurrency)}")
+        start = time.perf_counter()
+        if args.rate:
+            results = await generator.run_open(args.rate, args.requests, args.duration, poisson=args.poisson)
+        else:
+            results = await generator.run_closed(args.concurrency, args.requests, args.duration)
+        elapsed = time.perf_counter() - start
+    finally:
+        await generator.shutdown()
+
+    report = build_report(results, elapsed, generator.dropped)
+    report["config"] = {
+        "url": args.url,
+        "mode": "open" if args.rate else "closed",
+        "concurrency": None if args.rate else args.concurrency,
+        "rate": args.rate,
+        "poisson": args.poisson,
+        "stream": args.stream,
+        "client": args.client,
+        "warmup": args.warmup,
+        **generation_kwargs,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM APIサーバーの負荷試験")
+    parser.add_argument("--url", required=True, help="APIのベースURL")
+    parser.add_argument("--concurrency", type=int, default=4, help="クローズドループでの同時実行数")
+    parser.add_argument("--rate", type=float, default=None, help="オープンループでの到着レート (req/s)。指定するとオープンループになる")
+    parser.add_argument("--poisson", action="store_true", help="オープンループの到着間隔を指数分布にする")
+    parser.add_argument("--requests", type=int, default=None, help="計測するリクエスト数")
+    parser.add_argument("--duration", type=float, default=None, help="計測する秒数")
+    parser.add_argument("--warmup", type=int, default=2, help="計測前に送るリクエスト数（集計に含めない）")
+    parser.add_argument("--max-outstanding", type=int, default=None, help="未完了リクエスト数の上限")
+    parser.add_argument("--prompts-file", default=None, help="1行1プロンプトのファイル")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--greedy", action="store_true", help="do_sample=False で生成する")
+    parser.add_argument("--stream", action="store_true", help="/generate/stream を使い、最初のトークンまでの時間とtokens/secも計測する")
+    parser.add_argument("--client", choices=("thread", "async"), default="thread",
+                        help="thread: LLMClientをスレッドで実行 / async: AsyncLLMClientの接続プールを使う")
+    parser.add_argument("--output", default=None, help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
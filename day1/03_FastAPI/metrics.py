@@ -0,0 +1,181 @@
+# metrics.py
+# Prometheusのテキスト形式でメトリクスを公開するための軽量なレジストリ
+#
+# 値の記録はスレッドごとのシャードに対して行うため、記録時にロックを取らない。
+# 集計は /metrics が呼ばれたときに全シャードを合算して行う。
+import bisect
+import math
+import threading
+
+# 推論のレイテンシ向けのバケット境界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# tokens/sec 向けのバケット境界
+THROUGHPUT_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=None):
+    items = list(label_key)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    parts = []
+    for name, value in items:
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """カウンター・ヒストグラム・ゲージを管理するレジストリ"""
+
+    def __init__(self):
+        self._definitions = {}  # name -> (type, help, buckets)
+        self._gauge_callbacks = {}  # name -> 現在値を返す関数
+        self._gauge_values = {}  # name -> set_gauge()で設定された値
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # シャードの登録時（スレッドごとに1回）だけ使う
+
+    # --- 定義 ---
+    def counter(self, name, help_text):
+        self._definitions[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._definitions[name] = ("histogram", help_text, tuple(sorted(buckets)))
+
+    def gauge(self, name, help_text, callback=None):
+        """ゲージを定義する。callbackを渡すとスクレイプ時にその戻り値を使う"""
+        self._definitions[name] = ("gauge", help_text, None)
+        if callback is not None:
+            self._gauge_callbacks[name] = callback
+
+    # --- 記録 ---
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {"counters": {}, "histograms": {}}
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        """カウンターを増やす"""
+        counters = self._shard()["counters"]
+        key = (name, _label_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ヒストグラムに値を記録する"""
+        buckets = self._definitions[name][2]
+        histograms = self._shard()["histograms"]
+        key = (name, _label_key(labels))
+        state = histograms.get(key)
+        if state is None:
+            # [各バケットの件数（+Infを含む）, 合計, 件数]
+            state = [[0] * (len(buckets) + 1), 0.0, 0]
+            histograms[key] = state
+        state[0][bisect.bisect_left(buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def set_gauge(self, name, value):
+        self._gauge_values[name] = value
+
+    # --- 出力 ---
+    def _aggregate(self):
+        counters = {}
+        histograms = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in list(shard["counters"].items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, (bucket_counts, total, count) in list(shard["histograms"].items()):
+                merged = histograms.get(key)
+                if merged is None:
+                    merged = [[0] * len(bucket_counts), 0.0, 0]
+                    histograms[key] = merged
+                for i, c in enumerate(bucket_counts):
+                    merged[0][i] += c
+                merged[1] += total
+                merged[2] += count
+        return counters, histograms
+
+    def render(self):
+        """Prometheusのテキスト形式（version 0.0.4）で全メトリクスを出力する"""
+        counters, histograms = self._aggregate()
+        lines = []
+        for name, (metric_type, help_text, buckets) in self._definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric_name, label_key), value in sorted(counters.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{_format_labels(label_key)} {_format_value(value)}")
+            elif metric_type == "histogram":
+                for (metric_name, label_key), (bucket_counts, total, count) in sorted(histograms.items()):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, c in zip(list(buckets) + [math.inf], bucket_counts):
+                        cumulative += c
+                        le = ("le", _format_value(bound))
+                        lines.append(f"{name}_bucket{_format_labels(label_key, le)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(label_key)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_format_labels(label_key)} {count}")
+            else:
+                callback = self._gauge_callbacks.get(name)
+                value = callback() if callback else self._gauge_values.get(name)
+                if value is not None:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestCountingMiddleware:
+    """エンドポイントとステータスコードごとにHTTPリクエスト数を数えるASGIミドルウェア
+
+    receive はそのままエンドポイントに渡すため、Request.is_disconnected() による切断検知を妨げない
+    （@app.middleware("http") の BaseHTTPMiddleware は receive を横取りするため、
+    エンドポイントからクライアントの切断が見えなくなる）。
+    """
+
+    def __init__(self, app, registry, name="llm_requests_total", exclude=("/metrics",)):
+        self.app = app
+        self.registry = registry
+        self.name = name
+        self.exclude = set(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500  # 応答を返す前に例外で終わった場合
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # ルーティング後は scope にマッチしたルートが入る
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            if endpoint not in self.exclude:
+                self.registry.inc(self.name, endpoint=endpoint, status=str(status))
@@ -0,0 +1,350 @@
+# prefork.py
+# モデルを親プロセスで1回だけ読み込んでから複数のワーカープロセスをforkし、
+# 重みのメモリをコピーオンライトで共有するマルチワーカー起動スクリプト
+#
+# 使い方: python prefork.py --workers 4 --port 8000
+#   SIGHUP           : ワーカーを1つずつ入れ替える（グレースフルリスタート）
+#   SIGTERM / SIGINT : 実行中のリクエストを終えてから全ワーカーを停止する
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+
+import torch
+import uvicorn
+
+import app as server
+
+HEARTBEAT_INTERVAL = 1.0  # ワーカーが生存を通知する間隔（秒）
+
+
+class Supervisor:
+    """ワーカープロセスの起動・監視・入れ替えを行う親プロセス
+
+    各ワーカーはイベントループから共有メモリ上のハートビートを更新し、
+    一定時間更新が止まったワーカー（イベントループが詰まっているもの）は再起動する。
+    """
+
+    def __init__(self, workers, host, port, threads_per_worker, heartbeat_timeout=30.0, graceful_timeout=30.0):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.threads_per_worker = threads_per_worker
+        self.heartbeat_timeout = heartbeat_timeout
+        self.graceful_timeout = graceful_timeout
+        # forkしたワーカーからも読み書きできる共有メモリ（ワーカー番号ごと）
+        self.pids = multiprocessing.Array("i", workers, lock=False)
+        self.started_at = multiprocessing.Array("d", workers, lock=False)
+        self.heartbeats = multiprocessing.Array("d", workers, lock=False)
+        self.restarts = multiprocessing.Array("i", workers, lock=False)
+        self.children = {}  # pid -> ワーカー番号
+        self.retiring = set()  # 入れ替えのために停止中のpid（終了しても再起動しない）
+        self.socket = None
+        self.running = True
+        self.reload_requested = False
+
+    # --- 親プロセス ---
+    def bind(self):
+        """全ワーカーで共有する待ち受けソケットを作る"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        self.socket = sock
+
+    def preload(self):
+        """ワーカーをforkする前にモデルを読み込む
+
+        OpenMPのスレッドプールはforkした子プロセスに引き継げない（GNU OpenMPでは子プロセスの並列処理が
+        止まることがある）ため、親プロセスでは推論を実行せず、スレッドプールも作らない。
+        CPU推論モード auto の計測は使い捨ての子プロセスで行い、ウォームアップはfork後に各ワーカーで行う。
+
+        重みはsafetensorsのファイルをmmapしたページではなく、読み込んだテンソルのページをコピーオンライトで共有する。
+        transformers は読み込み時に重みをmmapからテンソルへコピーし、bf16・int8への変換でも新しいテンソルを
+        確保するため、mmapしたページを推論にそのまま使うことはできない。
+        """
+        # 1スレッドならPyTorchは並列処理をその場で実行し、OpenMPのスレッドを作らない
+        # （読み込み・変換が遅くなる分は、fork後に各ワーカーがスレッド数を設定し直して取り戻す）
+        torch.set_num_threads(1)
+        cpu_mode = server.config.CPU_INFERENCE_MODE
+        warmup_enabled = server.config.WARMUP_ENABLED
+        benchmark = None
+        if cpu_mode == "auto" and server.config.INFERENCE_BACKEND != "stub":
+            server.config.CPU_INFERENCE_MODE, benchmark = self._choose_cpu_mode()
+        server.config.WARMUP_ENABLED = False
+        try:
+            pipe = server.load_model()
+        finally:
+            # オンデマンドで読み込む他のモデルには元の設定を使う
+            server.config.CPU_INFERENCE_MODE = cpu_mode
+            server.config.WARMUP_ENABLED = warmup_enabled
+        if pipe is None:
+            raise SystemExit("モデルの読み込みに失敗したため、ワーカーを起動できません")
+        if benchmark is not None:
+            # /health で自動選択したときの計測結果を公開する
+            server.inference_modes[server.config.MODEL_NAME]["benchmark"] = benchmark
+        # 以降のGCで既存オブジェクトのヘッダーが書き換わり、共有ページがコピーされるのを防ぐ
+        gc.collect()
+        gc.freeze()
+
+    def _choose_cpu_mode(self):
+        """CPU推論モード auto の計測を使い捨ての子プロセスで行い、(選ばれたモード, 各モードのtokens/sec) を返す
+
+        計測にはワーカーと同じスレッド数を使う。子プロセスは読み込んだモデルごと終了するため、
+        親プロセスは選ばれたモードでモデルを読み込み直す。
+        """
+        print("CPU推論モード 'auto' の計測を子プロセスで行います...")
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(read_fd)
+                torch.set_num_threads(self.threads_per_worker)
+                server.create_pipeline(server.config.MODEL_NAME)
+                with os.fdopen(write_fd, "w") as f:
+                    json.dump(server.inference_modes[server.config.MODEL_NAME], f)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if not data:
+            raise SystemExit("CPU推論モードの計測に失敗したため、ワーカーを起動できません")
+        result = json.loads(data)
+        print(f"CPU推論モード '{result['mode']}' で読み込みます")
+        return result["mode"], result["benchmark"]
+
+    def spawn(self, index):
+        """ワーカーを1つforkする"""
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        self.pids[index] = pid
+        self.started_at[index] = time.time()
+        self.heartbeats[index] = 0.0
+        print(f"ワーカー{index}を起動しました (pid={pid})")
+        return pid
+
+    def run(self):
+        """ワーカーを起動し、停止が指示されるまで監視する"""
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for index in range(self.workers):
+            self.spawn(index)
+        print(f"{self.workers}個のワーカーで http://{self.host}:{self.port} を待ち受けています (親pid={os.getpid()})")
+
+        while self.running:
+            self._reap()
+            self._check_heartbeats()
+            if self.reload_requested:
+                self.reload_requested = False
+                self._rolling_restart()
+            time.sleep(0.5)
+        self._stop_all()
+
+    def _on_stop(self, signum, frame):
+        self.running = False
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _reap(self):
+        """終了したワーカーを回収し、予期せず終了したものは起動し直す"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self.children.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if index is None or not self.running:
+                continue
+            print(f"ワーカー{index} (pid={pid}) が終了しました (status={status})。再起動します")
+            self.restarts[index] += 1
+            self.spawn(index)
+
+    def _check_heartbeats(self):
+        """ハートビートが途絶えたワーカーを強制終了する（_reapで再起動される）"""
+        now = time.time()
+        for pid, index in list(self.children.items()):
+            if pid in self.retiring or self.pids[index] != pid:
+                continue
+            last = self.heartbeats[index] or self.started_at[index]
+            if now - last > self.heartbeat_timeout:
+                print(f"ワーカー{index} (pid={pid}) の応答が{now - last:.0f}秒途絶えているため強制終了します")
+                self._kill(pid, signal.SIGKILL)
+
+    def _rolling_restart(self):
+        """ワーカーを1つずつ入れ替える（新しいワーカーが応答してから古いワーカーを止める）"""
+        print("ワーカーのグレースフルリスタートを開始します")
+        for index in range(self.workers):
+            if not self.running:
+                return
+            old_pid = self.pids[index]
+            new_pid = self.spawn(index)
+            self.restarts[index] += 1
+            deadline = time.time() + self.heartbeat_timeout
+            while self.running and self.heartbeats[index] < self.started_at[index] and time.time() < deadline:
+                self._reap()
+                if new_pid not in self.children:
+                    break
+                time.sleep(0.2)
+            if new_pid not in self.children or self.heartbeats[index] < self.started_at[index]:
+                print(f"ワーカー{index}の新しいプロセスが起動しなかったため、入れ替えを中止します")
+                return
+            if old_pid in self.children:
+                self.retiring.add(old_pid)
+                self._terminate(old_pid)
+        print("グレースフルリスタートが完了しました")
+
+    def _terminate(self, pid):
+        """ワーカーに実行中のリクエストを終えてから終了するよう指示し、終了を待つ"""
+        self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 5
+        while pid in self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.2)
+        if pid in self.children:
+            self._kill(pid, signal.SIGKILL)
+
+    def _stop_all(self):
+        print("全ワーカーを停止しています...")
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 5
+        while self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.2)
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGKILL)
+        print("全ワーカーを停止しました")
+
+    @staticmethod
+    def _kill(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    # --- ワーカープロセス ---
+    def _run_worker(self, index):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_DFL)
+        torch.set_num_threads(self.threads_per_worker)
+        # サンプリングの乱数がワーカー間で同じ系列にならないよう、シードを取り直す
+        random.seed()
+        torch.seed()
+
+        server.worker_health = self.health
+        heartbeat_tasks = []
+
+        async def start_heartbeat():
+            heartbeat_tasks.append(asyncio.create_task(self._heartbeat(index)))
+
+        server.app.on_event("startup")(start_heartbeat)
+        if server.config.WARMUP_ENABLED:
+            async def warm_up():
+                # 親プロセスでは推論を実行しないため、ウォームアップはワーカーごとに行う
+                # （起動処理が終わるまでこのワーカーは接続を受け付けず、その間は他のワーカーが応答する）
+                try:
+                    await asyncio.to_thread(server.warm_up, server.model)
+                except Exception as e:
+                    print(f"警告: ワーカー{index}のウォームアップに失敗しました: {e}")
+                    traceback.print_exc()
+
+            server.app.on_event("startup")(warm_up)
+        config = uvicorn.Config(
+            server.app,
+            log_level="info",
+            timeout_graceful_shutdown=self.graceful_timeout,
+        )
+        uvicorn.Server(config).run(sockets=[self.socket])
+
+    async def _heartbeat(self, index):
+        """イベントループが動いていることを親プロセスに知らせる"""
+        pid = os.getpid()
+        while True:
+            # 入れ替え中は同じ番号の新旧ワーカーが並存するため、自分の番のときだけ書き込む
+            if self.pids[index] == pid:
+                self.heartbeats[index] = time.time()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def health(self):
+        """/health で公開する全ワーカーの状態（どのワーカーに問い合わせても同じ内容を返す）"""
+        now = time.time()
+        workers = []
+        for index in range(self.workers):
+            heartbeat = self.heartbeats[index]
+            workers.append({
+                "index": index,
+                "pid": self.pids[index],
+                "current": self.pids[index] == os.getpid(),
+                "healthy": heartbeat > 0 and now - heartbeat <= self.heartbeat_timeout,
+                "heartbeat_age": now - heartbeat if heartbeat > 0 else None,
+                "uptime": now - self.started_at[index],
+                "restarts": self.restarts[index],
+            })
+        return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モデルの重みを共有するマルチワーカーでAPIサーバーを起動する")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PREFORK_WORKERS", "2")))
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="ワーカーごとの推論スレッド数（省略時はCPUコア数をワーカー数で割った値）")
+    parser.add_argument("--heartbeat-timeout", type=float, default=float(os.environ.get("WORKER_HEARTBEAT_TIMEOUT", "30")))
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.environ.get("WORKER_GRACEFUL_TIMEOUT", "30")))
+    args = parser.parse_args()
+
+    if torch.cuda.is_available():
+        # CUDAは初期化後にforkできないため、GPU環境では通常どおり1プロセスで起動する
+        print("GPU環境ではプリフォーク起動を使わず、1プロセスで起動します")
+        uvicorn.run(server.app, host=args.host, port=args.port, log_level="info")
+        return
+
+    workers = max(1, args.workers)
+    threads_per_worker = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    supervisor = Supervisor(
+        workers,
+        args.host,
+        args.port,
+        threads_per_worker,
+        heartbeat_timeout=args.heartbeat_timeout,
+        graceful_timeout=args.graceful_timeout,
+    )
+    supervisor.bind()
+    print(f"モデル '{server.config.MODEL_NAME}' を親プロセスで読み込みます...")
+    supervisor.preload()
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,20 @@
 # python_client.py
 # このコードは、ngrokで公開されたAPIにアクセスするPythonクライアントの例です
 
+import asyncio
+import random
 import requests
 import json
 import time
 
+class LLMAPIError(Exception):
+    """APIがエラー応答を返したことを表す例外（status_code で種類を判別できる）"""
+    
+    def __init__(self, status_code, text):
+        super().__init__(f"API error: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
 class LLMClient:
     """LLM API クライアントクラス"""
     
@@ -28,7 +38,8 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True,
+                 priority=None, deadline_ms=None, speculative=None):
         """
         テキスト生成
         
@@ -38,6 +49,9 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            priority (str, optional): 優先度クラス（"interactive" / "normal" / "batch"）
+            deadline_ms (float, optional): この時間内に推論が始まらなければサーバー側で破棄される（ミリ秒）
+            speculative (bool, optional): 投機的デコーディングを使うか（省略時はサーバーの設定）
         
         Returns:
             dict: 生成結果
@@ -49,6 +63,12 @@ class LLMClient:
             "top_p": top_p,
             "do_sample": do_sample
         }
+        if priority is not None:
+            payload["priority"] = priority
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        if speculative is not None:
+            payload["speculative"] = speculative
         
         start_time = time.time()
         response = self.session.post(
@@ -62,7 +82,300 @@ class LLMClient:
             result["total_request_time"] = total_time
             return result
         else:
-            raise Exception(f"API error: {response.status_code} - {response.text}")
+            raise LLMAPIError(response.status_code, response.text)
+
+    def chat(self, messages, session_id=None, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True,
+             priority=None, deadline_ms=None):
+        """
+        会話の続きを生成
+        
+        Args:
+            messages (list): {"role": ..., "content": ...} の会話履歴（これまでのアシスタントの発言も含める）
+            session_id (str, optional): 前のターンで返された session_id（同じ会話のKVキャッシュが再利用される）
+            その他の引数は generate と同じ
+        
+        Returns:
+            dict: 生成結果（message, session_id, reused_tokens など）
+        """
+        payload = {
+            "messages": messages,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if session_id is not None:
+            payload["session_id"] = session_id
+        if priority is not None:
+            payload["priority"] = priority
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        
+        start_time = time.time()
+        response = self.session.post(f"{self.api_url}/chat", json=payload)
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise LLMAPIError(response.status_code, response.text)
+
+    def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+        """
+        テキスト生成（Server-Sent Eventsで生成されたトークンを順次受け取る）
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+        
+        Yields:
+            tuple: (イベント名, データ) 。"token" イベントのデータは {"text": ...}、
+                   最後の "done" イベントのデータは生成結果全体
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        with self.session.post(f"{self.api_url}/generate/stream", json=payload, stream=True) as response:
+            if response.status_code != 200:
+                raise LLMAPIError(response.status_code, response.text)
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "error":
+                        raise LLMAPIError(500, data.get("detail", ""))
+                    yield event, data
+
+    def generate_batch(self, prompts, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, chunk_size=8,
+                       max_retries=3):
+        """
+        複数プロンプトのバッチ生成
+        
+        Args:
+            prompts (list): プロンプト文字列、またはプロンプトごとのパラメータを含む辞書
+                            (例: {"prompt": "...", "max_new_tokens": 64}) のリスト
+            max_new_tokens (int, optional): 生成する最大トークン数（共通の既定値）
+            temperature (float, optional): 温度パラメータ（共通の既定値）
+            top_p (float, optional): top-p サンプリングのパラメータ（共通の既定値）
+            do_sample (bool, optional): サンプリングを行うかどうか（共通の既定値）
+            chunk_size (int, optional): 1回のHTTPリクエストで送るプロンプト数
+                                        （サーバーの BATCH_REQUEST_MAX_PROMPTS 以下にする）
+            max_retries (int, optional): 推論キューが満杯（503）のときに Retry-After だけ待って再試行する回数
+        
+        Returns:
+            dict: 入力と同じ順序の生成結果リスト (results) と合計時間
+        """
+        results = []
+        server_time = 0.0
+        start_time = time.time()
+        for i in range(0, len(prompts), chunk_size):
+            payload = {
+                "prompts": prompts[i:i + chunk_size],
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "do_sample": do_sample
+            }
+            for attempt in range(max_retries + 1):
+                response = self.session.post(
+                    f"{self.api_url}/generate/batch",
+                    json=payload
+                )
+                if response.status_code != 503 or attempt == max_retries:
+                    break
+                time.sleep(float(response.headers.get("Retry-After", 2 ** attempt)))
+            if response.status_code != 200:
+                raise LLMAPIError(response.status_code, response.text)
+            result = response.json()
+            results.extend(result["results"])
+            server_time += result["response_time"]
+        total_time = time.time() - start_time
+        
+        return {
+            "results": results,
+            "response_time": server_time,
+            "total_request_time": total_time
+        }
+
+class AsyncLLMClient:
+    """LLM API の非同期クライアントクラス
+    
+    接続プールでkeep-aliveの接続を再利用し、429/503 の応答と接続エラーは
+    ジッター付きの指数バックオフで再試行する。httpx が必要（pip install httpx）。
+    
+    使用例:
+        async with AsyncLLMClient(url, pool_size=16) as client:
+            results = await client.generate_many(prompts, concurrency=16)
+    """
+    
+    RETRY_STATUS_CODES = (429, 503)
+    
+    def __init__(self, api_url, pool_size=10, timeout=120.0, connect_timeout=10.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=30.0):
+        """
+        初期化
+        
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            pool_size (int, optional): 同時に張る接続数の上限（keep-aliveで再利用する）
+            timeout (float, optional): 1リクエストあたりのタイムアウト（秒）
+            connect_timeout (float, optional): 接続確立のタイムアウト（秒）
+            max_retries (int, optional): 429/503・接続エラー時の最大再試行回数
+            backoff_base (float, optional): 再試行の待ち時間の基準（秒）
+            backoff_max (float, optional): 再試行の待ち時間の上限（秒）
+        """
+        import httpx  # 同期クライアントだけを使う場合は不要なため、ここで読み込む
+        
+        self._httpx = httpx
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """接続プールを閉じる"""
+        await self.client.aclose()
+    
+    def _backoff(self, attempt, retry_after=None):
+        """再試行までの待ち時間（Full Jitter。Retry-After があればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+    
+    async def _post(self, path, payload, timeout=None):
+        """POSTを送り、429/503・接続エラーなら再試行する"""
+        kwargs = {"json": payload}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.post(f"{self.api_url}{path}", **kwargs)
+            except (self._httpx.ConnectError, self._httpx.PoolTimeout):
+                # 接続できなかった場合はサーバーに届いていないため、安全に再試行できる
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            if response.status_code in self.RETRY_STATUS_CODES and attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+                continue
+            if response.status_code != 200:
+                raise LLMAPIError(response.status_code, response.text)
+            return response.json()
+    
+    async def health_check(self):
+        """
+        ヘルスチェック
+        
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        response = await self.client.get(f"{self.api_url}/health")
+        return response.json()
+    
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True,
+                       priority=None, deadline_ms=None, speculative=None, timeout=None):
+        """
+        テキスト生成（引数は LLMClient.generate と同じ）
+        
+        Args:
+            timeout (float, optional): このリクエストだけに適用するタイムアウト（秒）
+        
+        Returns:
+            dict: 生成結果
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if priority is not None:
+            payload["priority"] = priority
+        if deadline_ms is not None:
+            payload["deadline_ms"] = deadline_ms
+        if speculative is not None:
+            payload["speculative"] = speculative
+        
+        start_time = time.time()
+        result = await self._post("/generate", payload, timeout=timeout)
+        result["total_request_time"] = time.time() - start_time
+        return result
+    
+    async def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+        """
+        テキスト生成（Server-Sent Eventsで生成されたトークンを順次受け取る）
+        
+        Yields:
+            tuple: (イベント名, データ)。LLMClient.generate_stream と同じ
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        async with self.client.stream("POST", f"{self.api_url}/generate/stream", json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise LLMAPIError(response.status_code, response.text)
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "error":
+                        raise LLMAPIError(500, data.get("detail", ""))
+                    yield event, data
+    
+    async def generate_many(self, prompts, concurrency=8, return_exceptions=False, **generation_kwargs):
+        """
+        複数のプロンプトを最大concurrency件ずつ並行して生成する
+        
+        Args:
+            prompts (list): プロンプト文字列のリスト
+            concurrency (int, optional): 同時に送るリクエスト数の上限
+            return_exceptions (bool, optional): Trueなら失敗したプロンプトの位置に例外を入れて返す
+            **generation_kwargs: generate() に渡す生成パラメータ
+        
+        Returns:
+            list: 入力と同じ順序の生成結果
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run(prompt):
+            async with semaphore:
+                return await self.generate(prompt, **generation_kwargs)
+        
+        return await asyncio.gather(*(run(prompt) for prompt in prompts), return_exceptions=return_exceptions)
 
 # 使用例
 if __name__ == "__main__":
@@ -79,9 +392,46 @@ if __name__ == "__main__":
     
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 会話を続ける（2ターン目以降は前のターンのKVキャッシュが再利用される）
+    print("Chat:")
+    messages = [{"role": "user", "content": "おすすめの本を1冊教えてください"}]
+    session_id = None
+    for follow_up in ["その本の著者について教えてください", None]:
+        result = client.chat(messages, session_id=session_id, max_new_tokens=128)
+        session_id = result["session_id"]
+        print(f"Response: {result['message']['content']} (reused {result['reused_tokens']} tokens, {result['response_time']:.2f}s)")
+        messages.append(result["message"])
+        if follow_up is None:
+            break
+        messages.append({"role": "user", "content": follow_up})
+    print()
+    
+    # 複数の質問をまとめて送信
+    print("Batch questions:")
+    result = client.generate_batch([
+        "AIについて100文字で教えてください",
+        {"prompt": "機械学習とは何ですか？50文字で答えてください", "max_new_tokens": 128},
+    ])
+    for item in result["results"]:
+        print(f"Response: {item['generated_text']} ({item['response_time']:.2f}s)")
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 非同期クライアントで複数の質問を並行して送信
+    print("Concurrent questions (async):")
+    
+    async def ask_many():
+        async with AsyncLLMClient(NGROK_URL, pool_size=4) as async_client:
+            return await async_client.generate_many(
+                ["AIについて100文字で教えてください", "機械学習とは何ですか？50文字で答えてください"],
+                concurrency=4,
+            )
+    
+    for item in asyncio.run(ask_many()):
+        print(f"Response: {item['generated_text']} ({item['total_request_time']:.2f}s)")    
\ No newline at end of file
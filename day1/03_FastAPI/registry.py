@@ -0,0 +1,168 @@
+# registry.py
+# 複数のモデルをリクエストに応じて読み込み、メモリ予算を超える場合は
+# 最も長く使われていないモデルから解放するモデルレジストリ
+import asyncio
+import gc
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def pipeline_memory_bytes(pipe):
+    """パイプラインのモデルが保持しているパラメータとバッファのバイト数
+
+    int8に動的量子化したLinear層の重みはパラメータとして見えないため、state_dictから数える。
+    """
+    total = 0
+    seen = set()  # 共有された重み（embeddingとlm_headなど）を二重に数えない
+    for value in pipe.model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor) and tensor.data_ptr() not in seen:
+                seen.add(tensor.data_ptr())
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelEntry:
+    """読み込み済みモデル1つ分の情報"""
+
+    def __init__(self, name, pipe, memory_bytes, pinned=False):
+        self.name = name
+        self.pipe = pipe
+        self.memory_bytes = memory_bytes
+        self.pinned = pinned  # Trueなら追い出さない（既定モデル用）
+        self.in_use = 0       # このモデルで実行中のリクエスト数
+        self.loaded_at = time.time()
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    """モデル名からパイプラインを引くレジストリ（LRUで追い出す）
+
+    load_fn はモデル名を受け取ってパイプラインを返す同期関数。
+    estimate_fn はモデル名を受け取って読み込み後のバイト数の見積もりを返す同期関数で、
+    初めて読み込むモデルの分のメモリを読み込み前に空けるために使う。
+    状態はイベントループのスレッドからのみ更新するため、ロックは持たない。
+    """
+
+    def __init__(self, load_fn, memory_budget_bytes, estimate_fn=None):
+        self.load_fn = load_fn
+        self.estimate_fn = estimate_fn
+        self.memory_budget_bytes = int(memory_budget_bytes)
+        self._entries = OrderedDict()  # name -> ModelEntry（末尾ほど最近使われた）
+        self._loading = {}  # name -> 読み込み中のTask（同じモデルの読み込みは1つにまとめる）
+        self._known_sizes = {}  # 一度読み込んだモデルのサイズ（再読み込み前の追い出しに使う）
+        self.evictions = 0
+
+    @property
+    def used_bytes(self):
+        return sum(entry.memory_bytes for entry in self._entries.values())
+
+    def register(self, name, pipe, pinned=False):
+        """読み込み済みのパイプラインを登録する"""
+        memory_bytes = pipeline_memory_bytes(pipe)
+        self._known_sizes[name] = memory_bytes
+        self._entries[name] = ModelEntry(name, pipe, memory_bytes, pinned=pinned)
+        self._entries.move_to_end(name)
+        self._evict_to_fit(0, keep=name)
+
+    def peek(self, name):
+        """読み込み済みならパイプラインを返す（読み込みは行わない）"""
+        entry = self._entries.get(name)
+        return entry.pipe if entry else None
+
+    async def get(self, name):
+        """モデルを返す。未読み込みならバックグラウンドで読み込んでから返す"""
+        entry = self._entries.get(name)
+        if entry is None:
+            task = self._loading.get(name)
+            if task is None:
+                task = asyncio.create_task(self._load(name))
+                self._loading[name] = task
+            entry = await asyncio.shield(task)
+        self._entries.move_to_end(name)
+        entry.last_used = time.time()
+        return entry
+
+    async def acquire(self, name):
+        """モデルを取得し、release()されるまで追い出されないようにする"""
+        entry = await self.get(name)
+        entry.in_use += 1
+        return entry
+
+    def release(self, entry):
+        """acquire()したモデルの使用を終える"""
+        entry.in_use = max(0, entry.in_use - 1)
+
+    async def _load(self, name):
+        try:
+            # 読み込むモデルのサイズ分を先に空けておく（以前に読み込んだことがあれば実測値、なければ見積もり）
+            incoming_bytes = self._known_sizes.get(name)
+            if incoming_bytes is None:
+                incoming_bytes = await asyncio.to_thread(self._estimate_size, name)
+            self._evict_to_fit(incoming_bytes)
+            print(f"モデル '{name}' をオンデマンドで読み込みます...")
+            pipe = await asyncio.to_thread(self.load_fn, name)
+            self.register(name, pipe)
+            entry = self._entries[name]
+            print(f"モデル '{name}' を読み込みました ({entry.memory_bytes / 1024 ** 3:.2f} GiB, 合計 {self.used_bytes / 1024 ** 3:.2f} GiB)")
+            return entry
+        finally:
+            self._loading.pop(name, None)
+
+    def _estimate_size(self, name):
+        """読み込む前のモデルのサイズの見積もり（見積もれない場合は0）"""
+        if self.estimate_fn is None:
+            return 0
+        try:
+            return int(self.estimate_fn(name))
+        except Exception as e:
+            print(f"警告: モデル '{name}' のサイズを見積もれませんでした: {e}")
+            return 0
+
+    def _evict_to_fit(self, incoming_bytes, keep=None):
+        """メモリ予算に収まるまで、使われていないモデルを古い順に解放する"""
+        while self.used_bytes + incoming_bytes > self.memory_budget_bytes:
+            victim = None
+            for entry in self._entries.values():
+                if entry.name != keep and not entry.pinned and entry.in_use == 0:
+                    victim = entry
+                    break
+            if victim is None:
+                print(f"警告: メモリ予算 ({self.memory_budget_bytes / 1024 ** 3:.2f} GiB) を超えていますが、解放できるモデルがありません")
+                return
+            self.evict(victim.name)
+
+    def evict(self, name):
+        """モデルを解放する"""
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        self.evictions += 1
+        print(f"モデル '{name}' を解放しました ({entry.memory_bytes / 1024 ** 3:.2f} GiB)")
+        del entry
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        """/health で公開する読み込み済みモデルの一覧"""
+        return {
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "used_bytes": self.used_bytes,
+            "evictions": self.evictions,
+            "loading": list(self._loading),
+            "models": [
+                {
+                    "name": entry.name,
+                    "memory_bytes": entry.memory_bytes,
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                    "loaded_at": entry.loaded_at,
+                    "last_used": entry.last_used,
+                }
+                for entry in reversed(self._entries.values())
+            ],
+        }
@@ -0,0 +1,110 @@
+# sessions.py
+# /chat の会話（セッション）ごとに、処理済みのトークン列とそのKVキャッシュを保持するLRUキャッシュ
+# 次のターンでは前のターンと共通の部分を再利用し、新しく追加された部分だけをプレフィルする
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def kv_cache_bytes(past_key_values):
+    """KVキャッシュ（DynamicCache）が保持しているテンソルのバイト数"""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        # transformers 4.56以降はレイヤーごとのオブジェクトにキーと値を持つ
+        tensors = [getattr(layer, name, None) for layer in layers for name in ("keys", "values")]
+    else:
+        tensors = list(getattr(past_key_values, "key_cache", [])) + list(getattr(past_key_values, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+def common_prefix_length(a, b):
+    """2つのトークン列（1次元テンソル）が先頭から一致している長さ"""
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class SessionState:
+    """1つの会話の、KVキャッシュに入っているトークン列とそのKVキャッシュ"""
+
+    def __init__(self, input_ids, past_key_values):
+        self.input_ids = input_ids  # 1次元のトークン列（KVキャッシュの長さと同じ）
+        self.past_key_values = past_key_values
+        self.memory_bytes = kv_cache_bytes(past_key_values)
+        self.updated_at = time.time()
+
+
+class SessionCache:
+    """(モデル名, セッションID) -> SessionState のLRUキャッシュ
+
+    KVキャッシュは生成中に書き換えられるため、使う間は take() でキャッシュから取り出し、
+    生成が終わったら新しい状態を put() で戻す（同じ会話の同時リクエストは片方が通常のプレフィルになる）。
+    max_bytes を超えると最も長く使われていない会話から追い出す。
+    イベントループのスレッドからのみ使う前提のため、ロックは持たない。
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()  # key -> SessionState（末尾ほど最近使われた）
+        self.current_bytes = 0
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0   # 再利用してプレフィルを省いたトークン数
+        self.prefill_tokens = 0  # 実際にプレフィルしたトークン数
+
+    def take(self, key):
+        """会話の状態を取り出す（キャッシュからは外れる）。なければNoneを返す"""
+        state = self._entries.pop(key, None)
+        if state is None:
+            self.misses += 1
+            return None
+        self.current_bytes -= state.memory_bytes
+        self.hits += 1
+        return state
+
+    def put(self, key, state):
+        """会話の状態を保存する（上限を超える大きさのものは保存しない）"""
+        self.discard(key)
+        if state.memory_bytes > self.max_bytes:
+            return
+        self._entries[key] = state
+        self.current_bytes += state.memory_bytes
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, oldest = self._entries.popitem(last=False)
+            self.current_bytes -= oldest.memory_bytes
+            self.evictions += 1
+
+    def discard(self, key):
+        state = self._entries.pop(key, None)
+        if state is not None:
+            self.current_bytes -= state.memory_bytes
+
+    def record(self, reused_tokens, prefill_tokens):
+        """1ターン分の再利用したトークン数とプレフィルしたトークン数を記録する"""
+        self.reused_tokens += reused_tokens
+        self.prefill_tokens += prefill_tokens
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """/health で公開する統計情報"""
+        lookups = self.hits + self.misses
+        total_tokens = self.reused_tokens + self.prefill_tokens
+        return {
+            "sessions": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+            "prefill_tokens": self.prefill_tokens,
+            "reuse_ratio": self.reused_tokens / total_tokens if total_tokens else 0.0,
+        }
@@ -0,0 +1,112 @@
+# speculative.py
+# 小さなドラフトモデルが先読みしたトークンを本体モデルがまとめて検証する
+# アシスト付き生成（投機的デコーディング）のためのドラフトモデル管理と統計
+import threading
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+def same_vocabulary(tokenizer_a, tokenizer_b):
+    """2つのトークナイザーが同じ語彙（同じトークンID）を持つか"""
+    return tokenizer_a.get_vocab() == tokenizer_b.get_vocab()
+
+
+class DraftModel:
+    """1つの本体モデル（target_name）用のドラフトモデルと、その採択率・速度向上の統計
+
+    統計は推論スレッドから更新されるため、集計はロックで保護する。
+    ドラフトモデルの順伝播の回数（＝提案したトークン数）はスレッドごとに数える。
+    """
+
+    def __init__(self, name, model, tokenizer, target_name, target_tokenizer):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.target_name = target_name
+        # 語彙の比較は数十万件の辞書同士の比較になるため、読み込み時に1回だけ行う
+        self.same_vocabulary = same_vocabulary(target_tokenizer, tokenizer)
+        self._calls = threading.local()
+        self._lock = threading.Lock()
+        model.register_forward_hook(self._count_forward)
+        # 統計情報
+        self.requests = 0
+        self.proposed_tokens = 0   # ドラフトモデルが提案したトークン数
+        self.accepted_tokens = 0   # そのうち本体モデルが採択したトークン数
+        self.target_steps = 0      # 本体モデルの検証（順伝播）の回数
+        self.generated_tokens = 0
+        self.decode_time = 0.0
+        # 比較用: 同じモデルで投機的デコーディングを使わなかった1件ずつの生成
+        self.baseline_tokens = 0
+        self.baseline_time = 0.0
+
+    def _count_forward(self, module, inputs, output):
+        self._calls.count = getattr(self._calls, "count", 0) + 1
+
+    def generate_kwargs(self, pipe):
+        """本体モデル（target_name のパイプライン）の生成に渡す追加の引数"""
+        kwargs = {"assistant_model": self.model}
+        if not self.same_vocabulary:
+            # 語彙が異なる場合はテキストを介して候補を受け渡す（transformers 4.46以降）
+            kwargs["tokenizer"] = pipe.tokenizer
+            kwargs["assistant_tokenizer"] = self.tokenizer
+        return kwargs
+
+    def begin(self):
+        """このスレッドでの生成の開始前に呼ぶ"""
+        self._calls.count = 0
+
+    def record(self, target_steps, generated_tokens, decode_time):
+        """投機的デコーディングで生成した1件の結果を記録し、(採択数, 提案数) を返す"""
+        proposed = getattr(self._calls, "count", 0)
+        # 本体モデルは検証1回ごとに、採択したトークンに加えて1トークンを自分で生成する
+        accepted = max(0, min(proposed, generated_tokens - target_steps))
+        with self._lock:
+            self.requests += 1
+            self.proposed_tokens += proposed
+            self.accepted_tokens += accepted
+            self.target_steps += target_steps
+            self.generated_tokens += generated_tokens
+            self.decode_time += decode_time
+        return accepted, proposed
+
+    def record_baseline(self, generated_tokens, decode_time):
+        """投機的デコーディングを使わなかった生成の速度を記録する（速度向上の比較用）"""
+        with self._lock:
+            self.baseline_tokens += generated_tokens
+            self.baseline_time += decode_time
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / self.proposed_tokens if self.proposed_tokens else 0.0
+
+    @property
+    def speedup(self):
+        """投機的デコーディングあり/なしのデコード速度（tokens/sec）の比"""
+        if not (self.decode_time and self.baseline_time and self.baseline_tokens):
+            return None
+        return (self.generated_tokens / self.decode_time) / (self.baseline_tokens / self.baseline_time)
+
+    def stats(self):
+        """/health で公開する統計情報"""
+        return {
+            "draft_model": self.name,
+            "target_model": self.target_name,
+            "same_vocabulary": self.same_vocabulary,
+            "requests": self.requests,
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_target_step": self.generated_tokens / self.target_steps if self.target_steps else 0.0,
+            "decode_tokens_per_second": self.generated_tokens / self.decode_time if self.decode_time else 0.0,
+            "baseline_tokens_per_second": self.baseline_tokens / self.baseline_time if self.baseline_time else 0.0,
+            "speedup": self.speedup,
+        }
+
+
+def load_draft_model(name, device, torch_dtype, target_name, target_tokenizer):
+    """target_name の本体モデル用のドラフトモデルを読み込む（本体モデルと同じデバイスに置く）"""
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    model = AutoModelForCausalLM.from_pretrained(name, torch_dtype=torch_dtype)
+    model.to(device)
+    model.eval()
+    return DraftModel(name, model, tokenizer, target_name, target_tokenizer)
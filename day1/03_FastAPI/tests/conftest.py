@@ -0,0 +1,57 @@
+# conftest.py
+# テストからサービスのモジュール（app, backends など）を読み込めるようにし、
+# モデルのダウンロードなしで動く設定（スタブのバックエンド）にする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app は読み込み時に環境変数から設定を読むため、import より前に設定する
+os.environ.setdefault("INFERENCE_BACKEND", "stub")
+os.environ.setdefault("STUB_TOKEN_DELAY_MS", "20")
+os.environ.setdefault("STUB_MEMORY_MB", "1")
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "0")
+os.environ.setdefault("DISCONNECT_CHECK_INTERVAL", "0.05")
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def tiny_pipe():
+    """ランダムに初期化した2層のLlamaとBPEトークナイザーで作った、実モデルの text-generation パイプライン
+
+    ネットワークなしで、実モデルと同じ transformers のコード（generate・KVキャッシュ・チャットテンプレート）を通す。
+    """
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast, pipeline
+
+    torch.manual_seed(0)
+    backend = Tokenizer(models.BPE())
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<pad>", "<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    backend.train_from_iterator(["system user assistant こんにちは 日本の首都はどこですか"], trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="<pad>", bos_token="<s>", eos_token="</s>")
+    tokenizer.chat_template = (
+        "{% for m in messages %}<s>{{ m['role'] }}\n{{ m['content'] }}</s>{% endfor %}"
+        "{% if add_generation_prompt %}<s>assistant\n{% endif %}"
+    )
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    ))
+    model.eval()
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device="cpu")
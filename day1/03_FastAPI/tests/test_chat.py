@@ -0,0 +1,38 @@
+# test_chat.py
+# 実モデル（小さなランダム初期化のLlama）で /chat の生成処理（run_chat）が動き、
+# 前のターンのKVキャッシュを再利用しても、再利用しない場合と同じ応答になることを確認する
+import threading
+import time
+
+import app as server
+
+GENERATION_KWARGS = dict(max_new_tokens=8, do_sample=False)
+
+
+def chat(pipe, messages, state=None):
+    return server.run_chat(pipe, messages, state, dict(GENERATION_KWARGS), threading.Event(), time.perf_counter())
+
+
+def test_run_chat_with_real_model(tiny_pipe):
+    messages = [{"role": "user", "content": "こんにちは"}]
+    text, state, reused, timings = chat(tiny_pipe, messages)
+    assert isinstance(text, str)
+    assert reused == 0
+    assert timings["prompt_tokens"] > 0
+    assert 0 < timings["generated_tokens"] <= GENERATION_KWARGS["max_new_tokens"]
+    assert state.input_ids.dim() == 1
+    assert state.past_key_values.get_seq_length() == len(state.input_ids)
+
+
+def test_run_chat_reuses_previous_turn(tiny_pipe):
+    first = [{"role": "user", "content": "こんにちは"}]
+    text, state, _, _ = chat(tiny_pipe, first)
+    second = first + [
+        {"role": "assistant", "content": text},
+        {"role": "user", "content": "日本の首都はどこですか"},
+    ]
+
+    cached_text, _, reused, timings = chat(tiny_pipe, second, state)
+    fresh_text, _, _, _ = chat(tiny_pipe, second)
+    assert 0 < reused < timings["prompt_tokens"]
+    assert cached_text == fresh_text
@@ -0,0 +1,81 @@
+# test_disconnect.py
+# クライアントが生成の途中で切断したら、推論スレッドの生成も止まることを確認する
+import re
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+import app as server
+
+MAX_NEW_TOKENS = 500  # スタブは20ms/トークンなので、最後まで生成すると約10秒かかる
+
+
+def metric_value(text, name, **labels):
+    """Prometheus形式のテキストから、ラベルが一致するサンプルの値の合計を返す"""
+    total = 0.0
+    for line in text.splitlines():
+        match = re.match(rf"^{name}(\{{(.*)\}})? (\S+)$", line)
+        if match and all(f'{key}="{value}"' in (match.group(2) or "") for key, value in labels.items()):
+            total += float(match.group(3))
+    return total
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/health").status_code == 200:
+                break
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    else:
+        pytest.fail("サーバーが起動しませんでした")
+    yield url
+    uvicorn_server.should_exit = True
+    thread.join(timeout=10)
+
+
+def wait_until_idle(url, timeout=15):
+    """実行中・実行待ちの推論がなくなるまで待ち、その時点のメトリクスを返す"""
+    deadline = time.time() + timeout
+    while True:
+        text = httpx.get(f"{url}/metrics").text
+        busy = metric_value(text, "llm_in_flight_requests") + metric_value(text, "llm_queued_requests")
+        if busy == 0 or time.time() > deadline:
+            return text
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize("path, payload", [
+    ("/generate", {"prompt": "こんにちは"}),
+    ("/generate/batch", {"prompts": ["こんにちは", "さようなら"]}),
+    ("/chat", {"messages": [{"role": "user", "content": "こんにちは"}]}),
+])
+def test_disconnect_stops_generation(base_url, path, payload):
+    before = httpx.get(f"{base_url}/metrics").text
+    payload = {**payload, "max_new_tokens": MAX_NEW_TOKENS, "do_sample": False}
+    with pytest.raises(httpx.ReadTimeout):
+        httpx.post(f"{base_url}{path}", json=payload, timeout=httpx.Timeout(1.0, connect=5.0))
+    disconnected_at = time.time()
+
+    after = wait_until_idle(base_url)
+    # 最後まで生成すると約10秒かかるところ、切断から数ステップで止まる
+    assert time.time() - disconnected_at < 5
+    cancelled = (metric_value(after, "llm_cancelled_requests_total", stage="decode")
+                 - metric_value(before, "llm_cancelled_requests_total", stage="decode"))
+    assert cancelled >= 1
+    generated = metric_value(after, "llm_generated_tokens_total") - metric_value(before, "llm_generated_tokens_total")
+    assert 0 < generated < MAX_NEW_TOKENS
@@ -0,0 +1,107 @@
+# test_prefork.py
+# プリフォーク起動では親プロセスで推論（計測・ウォームアップ）を実行せず、fork後に各ワーカーがウォームアップすることを確認する
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WARMUP_DONE = "ウォームアップが完了しました"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_workers_warm_up_after_fork(tmp_path):
+    port = free_port()
+    log_path = tmp_path / "prefork.log"
+    env = dict(os.environ, INFERENCE_BACKEND="stub", WARMUP_ENABLED="1", WARMUP_BATCH_SIZES="1", PYTHONUNBUFFERED="1")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, "prefork.py", "--host", "127.0.0.1", "--port", str(port), "--workers", "2"],
+            cwd=APP_DIR,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        reports = {}  # ワーカーのpid -> /health のウォームアップ結果
+        deadline = time.time() + 60
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            while len(reports) < 2 and time.time() < deadline:
+                try:
+                    response = client.get("/health", headers={"Connection": "close"})
+                except httpx.TransportError:
+                    time.sleep(0.2)
+                    continue
+                if response.status_code == 200:
+                    body = response.json()
+                    current = next(worker["pid"] for worker in body["workers"] if worker["current"])
+                    reports[current] = body["warmup"]
+                time.sleep(0.05)
+        assert len(reports) == 2, log_path.read_text()
+        assert all(report is not None for report in reports.values())
+        # ウォームアップはワーカーの数だけ実行され、親プロセスでは実行されていない
+        assert log_path.read_text().count(WARMUP_DONE) == 2
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+
+
+PRELOAD_SCRIPT = """
+import json, sys
+import torch
+import cpu_inference, prefork
+server = prefork.server
+server.config.MODEL_NAME = sys.argv[1]
+server.config.INFERENCE_BACKEND = "transformers"
+server.config.CPU_INFERENCE_MODE = "auto"
+server.config.WARMUP_ENABLED = True
+benchmarked = []
+benchmark_pipeline = cpu_inference.benchmark_pipeline
+def recording_benchmark(pipe, *args, **kwargs):
+    benchmarked.append(True)
+    return benchmark_pipeline(pipe, *args, **kwargs)
+cpu_inference.benchmark_pipeline = recording_benchmark
+prefork.Supervisor(2, "127.0.0.1", 0, threads_per_worker=2).preload()
+print(json.dumps({
+    "benchmarked_in_parent": bool(benchmarked),
+    "warmup_report": server.warmup_report,
+    "num_threads": torch.get_num_threads(),
+    "inference_mode": server.inference_modes[sys.argv[1]],
+    "config_mode": server.config.CPU_INFERENCE_MODE,
+    "config_warmup": server.config.WARMUP_ENABLED,
+}))
+"""
+
+
+def test_preload_runs_no_inference_in_parent(tiny_pipe, tmp_path):
+    tiny_pipe.model.save_pretrained(tmp_path)
+    tiny_pipe.tokenizer.save_pretrained(tmp_path)
+    result = subprocess.run(
+        [sys.executable, "-c", PRELOAD_SCRIPT, str(tmp_path)],
+        cwd=APP_DIR,
+        env=dict(os.environ, INFERENCE_BACKEND="transformers"),
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    # auto の計測は子プロセスで行われ、親プロセスは1スレッドのまま推論もウォームアップもしない
+    assert report["benchmarked_in_parent"] is False
+    assert report["warmup_report"] is None
+    assert report["num_threads"] == 1
+    assert report["inference_mode"]["mode"] in ("fp32", "bf16", "int8")
+    assert set(report["inference_mode"]["benchmark"]) == {"fp32", "bf16", "int8"}
+    # オンデマンドで読み込む他のモデルには元の設定が使われる
+    assert report["config_mode"] == "auto"
+    assert report["config_warmup"] is True
@@ -0,0 +1,52 @@
+# test_registry.py
+# 初めて読み込むモデルでも、読み込む前に見積もったサイズ分のメモリを空けることを確認する
+import asyncio
+
+import torch
+
+from backends import create_stub_pipeline, estimate_transformers_model_bytes
+from registry import ModelRegistry, pipeline_memory_bytes
+
+MiB = 1024 * 1024
+
+
+def test_first_load_evicts_to_fit_estimate():
+    loaded_while = {}
+
+    def load_fn(name):
+        # 読み込みが始まった時点で残っているモデルを記録する
+        loaded_while[name] = [entry["name"] for entry in registry.stats()["models"]]
+        return create_stub_pipeline(name, memory_bytes=3 * MiB)
+
+    registry = ModelRegistry(load_fn, memory_budget_bytes=4 * MiB, estimate_fn=lambda name: 3 * MiB)
+
+    async def scenario():
+        await registry.get("a")
+        await registry.get("b")
+
+    asyncio.run(scenario())
+    assert loaded_while["b"] == []  # "a" は "b" の読み込みより前に解放されている
+    assert [entry["name"] for entry in registry.stats()["models"]] == ["b"]
+    assert registry.evictions == 1
+
+
+def test_estimate_failure_falls_back_to_evicting_after_load():
+    def estimate_fn(name):
+        raise OSError("offline")
+
+    registry = ModelRegistry(
+        lambda name: create_stub_pipeline(name, memory_bytes=3 * MiB), memory_budget_bytes=4 * MiB, estimate_fn=estimate_fn
+    )
+
+    async def scenario():
+        await registry.get("a")
+        await registry.get("b")
+
+    asyncio.run(scenario())
+    assert [entry["name"] for entry in registry.stats()["models"]] == ["b"]
+
+
+def test_estimate_matches_loaded_model(tiny_pipe, tmp_path):
+    tiny_pipe.model.save_pretrained(tmp_path)
+    assert estimate_transformers_model_bytes(str(tmp_path), torch.float32) == pipeline_memory_bytes(tiny_pipe)
+    assert estimate_transformers_model_bytes(str(tmp_path), torch.bfloat16) == pipeline_memory_bytes(tiny_pipe) // 2
@@ -0,0 +1,61 @@
+# warmup.py
+# 起動直後の最初のリクエストが遅くならないよう、読み込んだモデルで代表的なプロンプトを
+# 実際のバッチサイズで事前に実行しておくウォームアップと、torch.compile の適用
+import time
+import traceback
+
+import torch
+
+WARMUP_PROMPTS = [
+    "AIについて100文字で教えてください",
+    "日本の首都はどこですか？",
+    "Pythonの特徴を3つ挙げてください",
+    "機械学習とは何ですか？",
+]
+
+
+def compile_model(pipe, mode="default"):
+    """モデルの順伝播を torch.compile する。失敗した場合はそのまま（eager）使う"""
+    try:
+        # 生成中は入力長が毎ステップ変わるため、形状を動的に扱う
+        pipe.model.forward = torch.compile(pipe.model.forward, mode=mode, dynamic=True)
+        print(f"モデルの順伝播を torch.compile しました (mode={mode})")
+        return True
+    except Exception as e:
+        print(f"警告: torch.compile に失敗したため、通常の実行を使います: {e}")
+        traceback.print_exc()
+        return False
+
+
+def uncompile_model(pipe):
+    """compile_model() で差し替えた順伝播を元に戻す"""
+    pipe.model.__dict__.pop("forward", None)
+
+
+def warmup_pipeline(pipe, batch_sizes, rounds=3, max_new_tokens=16, extra_generate_kwargs=None):
+    """バッチサイズごとにプロンプトを rounds 回実行し、初回（コールド）と2回目以降（ウォーム）の時間を返す
+
+    torch.compile を使う場合は、初回の実行時間にコンパイル時間も含まれる。
+    """
+    report = {}
+    for batch_size in sorted(set(max(1, int(b)) for b in batch_sizes)):
+        prompts = [WARMUP_PROMPTS[i % len(WARMUP_PROMPTS)] for i in range(batch_size)]
+        timings = []
+        for _ in range(max(2, rounds)):
+            start = time.perf_counter()
+            pipe(
+                prompts,
+                batch_size=batch_size,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                **(extra_generate_kwargs or {}),
+            )
+            timings.append(time.perf_counter() - start)
+        cold, warm = timings[0], min(timings[1:])
+        report[str(batch_size)] = {
+            "cold_seconds": cold,
+            "warm_seconds": warm,
+            "cold_to_warm_ratio": cold / warm if warm > 0 else None,
+        }
+        print(f"ウォームアップ (バッチサイズ {batch_size}): コールド {cold:.2f}秒 → ウォーム {warm:.2f}秒")
+    return report
@@ -1,50 +1,25 @@
 # app.py
 import streamlit as st
-import ui                   # UIモジュール
-import llm                  # LLMモジュール
-import database             # データベースモジュール
-import metrics              # 評価指標モジュール
-import data                 # データモジュール
-import torch
-from transformers import pipeline
-from config import MODEL_NAME
-from huggingface_hub import HfFolder
+from import_report import timed_import
+# torch・transformers・sklearn・nltk・janome はここでは読み込まない
+# （llm はチャットページを開いたとき、評価指標の依存は初めて指標を計算するときに読み込む）
+with timed_import("database"):
+    import database         # データベースモジュール
+with timed_import("data"):
+    import data             # データモジュール
+with timed_import("ui"):
+    import ui               # UIモジュール
 
 # --- アプリケーション設定 ---
 st.set_page_config(page_title="Gemma Chatbot", layout="wide")
 
 # --- 初期化処理 ---
-# NLTKデータのダウンロード（初回起動時など）
-metrics.initialize_nltk()
-
 # データベースの初期化（テーブルが存在しない場合、作成）
 database.init_db()
 
 # データベースが空ならサンプルデータを投入
 data.ensure_initial_data()
 
-# LLMモデルのロード（キャッシュを利用）
-# モデルをキャッシュして再利用
-@st.cache_resource
-def load_model():
-    """LLMモデルをロードする"""
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
-        st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
-        return pipe
-    except Exception as e:
-        st.error(f"モデル '{MODEL_NAME}' の読み込みに失敗しました: {e}")
-        st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
-        return None
-pipe = llm.load_model()
-
 # --- Streamlit アプリケーション ---
 st.title("🤖 Gemma 3 Chatbot with Feedback")
 st.write("Gemmaモデルを使用したチャットボットです。回答に対してフィードバックを行えます。")
@@ -67,6 +42,10 @@ page = st.sidebar.radio(
 
 # --- メインコンテンツ ---
 if st.session_state.page == "チャット":
+    # LLMモデルのロード（キャッシュを利用）。他のページではモデルを読み込まない
+    with timed_import("llm"):
+        import llm          # LLMモジュール
+    pipe = llm.load_model()
     if pipe:
         ui.display_chat_page(pipe)
     else:
@@ -76,6 +55,12 @@ elif st.session_state.page == "履歴閲覧":
 elif st.session_state.page == "サンプルデータ管理":
     ui.display_data_page()
 
+# 回答キャッシュの統計（有効な場合のみ）
+ui.display_answer_cache_stats()
+
+# 各モジュールの読み込みにかかった時間
+ui.display_import_report()
+
 # --- フッターなど（任意） ---
 st.sidebar.markdown("---")
 st.sidebar.info("開発者: [Iwaki Miyamoto]")
\ No newline at end of file
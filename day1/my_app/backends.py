@@ -0,0 +1,94 @@
+# backends.py
+# 推論バックエンドの切り替え
+# どのバックエンドも transformers の text-generation パイプラインと同じ呼び出し方
+# （pipe(messages, ...) / pipe.tokenizer）で使えるオブジェクトを返す。
+# スタブは実モデルを読み込まずに決定的な応答を一定の速度で返すため、ネットワークなしで
+# アプリ自体（画面の応答・DBへの保存など）の速度を計測できる。
+import hashlib
+import random
+import time
+
+BACKENDS = ("transformers", "stub", "remote")
+
+STUB_WORDS = [
+    "えっと", "Gemma", "は", "スタブ", "の", "応答", "だよ", "♪",
+    "同じ", "質問", "には", "いつも", "同じ", "答え", "なの", "。",
+]
+
+
+def create_transformers_pipeline(model_name, device, torch_dtype):
+    """Hugging Face のモデルを読み込んだ text-generation パイプライン"""
+    from transformers import pipeline
+    return pipeline(
+        "text-generation",
+        model=model_name,
+        model_kwargs={"torch_dtype": torch_dtype},
+        device=device
+    )
+
+
+class StubTokenizer:
+    """1文字を1トークンとする決定的なトークナイザー（アプリから使われる部分のみ）"""
+
+    eos_token = "</s>"
+    _offset = 2  # 文字のトークンIDは特殊トークン（pad=0, eos=1）の後ろから始める
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(ch) + self._offset for ch in text]
+
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": self.encode(text)}
+
+    def decode(self, token_ids, skip_special_tokens=True, **kwargs):
+        return "".join(chr(token_id - self._offset) for token_id in token_ids if token_id >= self._offset)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, **kwargs):
+        text = "".join(f"<{m['role']}>\n{m['content']}\n" for m in messages)
+        if add_generation_prompt:
+            text += "<assistant>\n"
+        return self.encode(text) if tokenize else text
+
+
+class StubPipeline:
+    """text-generation パイプラインと同じ入出力で、質問から決まる応答を返すスタブ
+
+    サンプリングの指定は無視し、同じ入力には常に同じ応答を max_new_tokens 文字で返す。
+    1トークン（1文字）ごとに token_delay 秒かかり、実モデルの代わりに memory_bytes の
+    メモリを確保する。
+    """
+
+    def __init__(self, model_name, token_delay=0.02, memory_bytes=256 * 1024 * 1024):
+        self.model_name = model_name
+        self.tokenizer = StubTokenizer()
+        self.token_delay = token_delay
+        self._weights = bytearray(max(1, int(memory_bytes)))
+
+    def completion(self, prompt, max_new_tokens):
+        """入力に対して生成するテキスト（入力のハッシュから決まる）"""
+        seed = int.from_bytes(hashlib.sha256(f"{self.model_name}\n{prompt}".encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        text = ""
+        while len(text) < max_new_tokens:
+            text += rng.choice(STUB_WORDS)
+        return text[:max_new_tokens]
+
+    def stream(self, prompt, max_new_tokens=256):
+        """応答を1トークンずつ token_delay の間隔で返す"""
+        for token in self.completion(prompt, max_new_tokens):
+            if self.token_delay > 0:
+                time.sleep(self.token_delay)
+            yield token
+
+    def __call__(self, text_inputs, max_new_tokens=256, return_full_text=True, **generate_kwargs):
+        prompt = text_inputs if isinstance(text_inputs, str) else self.tokenizer.apply_chat_template(text_inputs)
+        completion = "".join(self.stream(prompt, max_new_tokens))
+        if isinstance(text_inputs, str):
+            generated = prompt + completion if return_full_text else completion
+        else:
+            generated = list(text_inputs) + [{"role": "assistant", "content": completion}]
+        return [{"generated_text": generated}]
+
+
+def create_stub_pipeline(model_name, token_delay=0.02, memory_bytes=256 * 1024 * 1024):
+    """実モデルを読み込まないスタブのパイプライン"""
+    return StubPipeline(model_name, token_delay=token_delay, memory_bytes=memory_bytes)
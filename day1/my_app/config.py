@@ -1,3 +1,29 @@
 # config.py
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "google/gemma-3-1b-it"
\ No newline at end of file
+MODEL_NAME = "google/gemma-3-1b-it"
+# システムプロンプト部分のKVキャッシュを再利用するか（Falseで毎回プレフィルする）
+USE_PROMPT_CACHE = True
+# GPUがない場合の推論モード: "bf16" / "fp32" / "int8"（動的量子化）/
+# "auto"（起動時に計測して最速を選ぶ。fp32で読み込むため、bf16の約2倍のメモリが必要）
+CPU_INFERENCE_MODE = "bf16"
+# 読み込み直後に短い生成を実行して、最初の質問が遅くならないようにするか（とその回数）
+WARMUP_ENABLED = True
+WARMUP_ROUNDS = 2
+# モデルの順伝播を torch.compile するか（初回のウォームアップにコンパイル時間がかかる）
+TORCH_COMPILE = False
+# 推論バックエンド: "transformers"（実モデル）/ "stub"（決定的な応答を一定の速度で返す。ベンチマーク・テスト用）
+# / "remote"（モデルを読み込まず、FastAPIの推論サービス（day1/03_FastAPI）を呼び出す）
+INFERENCE_BACKEND = "transformers"
+# スタブの1トークンあたりの生成時間（ミリ秒）と、実モデルの代わりに確保するメモリ量（MB）
+STUB_TOKEN_DELAY_MS = 20
+STUB_MEMORY_MB = 256
+# 全セッションで共有するモデルを同時に使える数（超えた分はセッション間で順番に待つ）
+INFERENCE_MAX_CONCURRENCY = 1
+# INFERENCE_BACKEND = "remote" のときに呼び出す推論サービスのURLと、接続・応答待ちのタイムアウト（秒）、接続プールの大きさ
+REMOTE_API_URL = "http://localhost:8000"
+REMOTE_CONNECT_TIMEOUT = 5
+REMOTE_READ_TIMEOUT = 120
+REMOTE_POOL_SIZE = 10
+# 同じ質問への回答をDBにキャッシュして再利用するか（オプトイン）と、キャッシュする回答の最大件数
+ANSWER_CACHE_ENABLED = False
+ANSWER_CACHE_MAX_ENTRIES = 1000
\ No newline at end of file
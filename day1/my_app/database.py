@@ -3,7 +3,7 @@ import sqlite3
 import pandas as pd
 from datetime import datetime
 import streamlit as st
-from config import DB_FILE
+from config import DB_FILE, ANSWER_CACHE_MAX_ENTRIES
 from metrics import calculate_metrics # metricsを計算するために必要
 
 # --- スキーマ定義 ---
@@ -24,6 +24,27 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  relevance_score REAL)
 '''
 
+# 同じ質問への回答を再利用するためのキャッシュ（key は質問・システムプロンプト・モデル・生成パラメータから作る）
+CACHE_TABLE_NAME = "answer_cache"
+CACHE_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {CACHE_TABLE_NAME}
+(key TEXT PRIMARY KEY,
+ question TEXT,
+ answer TEXT,
+ model TEXT,
+ response_time REAL,   -- 最初に生成したときにかかった時間
+ created_at TEXT,
+ last_used_at TEXT,
+ hits INTEGER DEFAULT 0)
+'''
+# キャッシュの参照回数（ヒット率の表示用）
+CACHE_STATS_TABLE_NAME = "answer_cache_stats"
+CACHE_STATS_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {CACHE_STATS_TABLE_NAME}
+(name TEXT PRIMARY KEY,
+ value INTEGER)
+'''
+
 # --- データベース初期化 ---
 def init_db():
     """データベースとテーブルを初期化する"""
@@ -31,6 +52,8 @@ def init_db():
         conn = sqlite3.connect(DB_FILE)
         c = conn.cursor()
         c.execute(SCHEMA)
+        c.execute(CACHE_SCHEMA)
+        c.execute(CACHE_STATS_SCHEMA)
         conn.commit()
         conn.close()
         print(f"Database '{DB_FILE}' initialized successfully.")
@@ -122,6 +145,88 @@ def clear_db():
         st.error(f"データベースのクリア中にエラーが発生しました: {e}")
         st.session_state.confirm_clear = False # エラー時もリセット
         return False # 削除失敗
+    finally:
+        if conn:
+            conn.close()
+
+# --- 回答キャッシュ ---
+def _count_cache_lookup(c, name):
+    """キャッシュの参照結果（hits / misses）を数える"""
+    c.execute(f'''
+    INSERT INTO {CACHE_STATS_TABLE_NAME} (name, value) VALUES (?, 1)
+    ON CONFLICT(name) DO UPDATE SET value = value + 1
+    ''', (name,))
+
+def get_cached_answer(key):
+    """キャッシュされた回答を (回答, 最初の生成時間) で返す。なければNone"""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        c.execute(f"SELECT answer, response_time FROM {CACHE_TABLE_NAME} WHERE key = ?", (key,))
+        row = c.fetchone()
+        if row is None:
+            _count_cache_lookup(c, "misses")
+        else:
+            _count_cache_lookup(c, "hits")
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            c.execute(f"UPDATE {CACHE_TABLE_NAME} SET hits = hits + 1, last_used_at = ? WHERE key = ?", (timestamp, key))
+        conn.commit()
+        return row
+    except sqlite3.Error as e:
+        # キャッシュが使えなくても回答は生成できるため、警告だけ出す
+        print(f"Warning: 回答キャッシュの参照に失敗しました: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def save_cached_answer(key, question, answer, model, response_time):
+    """回答をキャッシュに保存し、上限を超えた分は最も長く使われていないものから削除する"""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.execute(f'''
+        INSERT OR REPLACE INTO {CACHE_TABLE_NAME} (key, question, answer, model, response_time, created_at, last_used_at, hits)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        ''', (key, question, answer, model, response_time, timestamp, timestamp))
+        c.execute(f'''
+        DELETE FROM {CACHE_TABLE_NAME} WHERE key IN (
+            SELECT key FROM {CACHE_TABLE_NAME} ORDER BY last_used_at DESC, created_at DESC LIMIT -1 OFFSET ?
+        )
+        ''', (ANSWER_CACHE_MAX_ENTRIES,))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Warning: 回答キャッシュへの保存に失敗しました: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def get_answer_cache_stats():
+    """回答キャッシュの件数とヒット率を返す"""
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM {CACHE_TABLE_NAME}")
+        entries = c.fetchone()[0]
+        c.execute(f"SELECT name, value FROM {CACHE_STATS_TABLE_NAME}")
+        counts = dict(c.fetchall())
+        hits = counts.get("hits", 0)
+        misses = counts.get("misses", 0)
+        lookups = hits + misses
+        return {
+            "entries": entries,
+            "max_entries": ANSWER_CACHE_MAX_ENTRIES,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+    except sqlite3.Error as e:
+        print(f"Warning: 回答キャッシュの統計の取得に失敗しました: {e}")
+        return None
     finally:
         if conn:
             conn.close()
\ No newline at end of file
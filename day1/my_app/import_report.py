@@ -0,0 +1,21 @@
+# import_report.py
+# 起動時間の内訳を調べるための、モジュールの読み込み（import）時間の記録
+# 重い依存（torch・transformers・sklearn・nltk・janome）は使う処理が初めて実行されたときに読み込むため、
+# 各モジュールが初めて読み込まれたときにかかった時間だけを記録する。
+# さらに細かい内訳は `python -X importtime -m streamlit run app.py` で確認できる。
+import time
+from contextlib import contextmanager
+
+IMPORT_TIMES = {}  # ラベル -> 初回の読み込みにかかった秒数（読み込んだ順）
+
+
+@contextmanager
+def timed_import(label):
+    """with ブロック内の import にかかった時間を、初回のみ label として記録する"""
+    if label in IMPORT_TIMES:
+        yield
+        return
+    start = time.perf_counter()
+    yield
+    IMPORT_TIMES[label] = time.perf_counter() - start
+    print(f"Imported {label} in {IMPORT_TIMES[label] * 1000:.0f} ms")
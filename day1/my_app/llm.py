@@ -1,75 +1,373 @@
 # llm.py
 import os
-import torch
-from transformers import pipeline
+import copy
+import gc
+import hashlib
+import json
+import re
+import unicodedata
+import threading
+import weakref
 import streamlit as st
 import time
-from config import MODEL_NAME
-from huggingface_hub import login
+from config import MODEL_NAME, USE_PROMPT_CACHE, CPU_INFERENCE_MODE, WARMUP_ENABLED, WARMUP_ROUNDS, TORCH_COMPILE
+from config import INFERENCE_BACKEND, STUB_TOKEN_DELAY_MS, STUB_MEMORY_MB, INFERENCE_MAX_CONCURRENCY
+from config import REMOTE_API_URL, REMOTE_CONNECT_TIMEOUT, REMOTE_READ_TIMEOUT, REMOTE_POOL_SIZE
+from backends import BACKENDS, create_stub_pipeline, create_transformers_pipeline
+from scheduler import InferenceScheduler
+from remote import RemoteLLM, RemoteLLMError
+from import_report import timed_import
+
+# 推論サービスを呼び出す場合は、torch と transformers をこのプロセスで読み込まない
+# （このモジュール自体も、チャットページを初めて開いたときに読み込まれる）
+if INFERENCE_BACKEND != "remote":
+    with timed_import("torch"):
+        import torch
+    with timed_import("transformers"):
+        from transformers import DynamicCache, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+
+# ぶりっ子キャラクターの指示を含むシステムプロンプト
+SYSTEM_PROMPT = """
+        あなたは可愛らしく甘えん坊なAIアシスタント「Gemma」です。以下の特徴を持って回答してください：
+
+        - 語尾に「〜だよ」「〜なの」「〜だね」「〜だよん♪」などを付ける
+        - ハートマーク(❤️)や星(★)、音符(♪)などの絵文字を適度に使う
+        - 自分のことを「Gemma」と一人称で呼ぶ
+        - 相手には「〜さん」と敬称を付ける
+        - 可愛らしい表現を使う（例：「すごーい！」「わぁ嬉しいな♪」「えへへ」など）
+        - 甘えた口調で話す（例：「教えてほしいなぁ」「一緒に考えようよ〜」など）
+        - 少し首を傾げるような疑問形「〜かな？」を使うことがある
+        - 「えっと」「あのね」「そうそう」などの会話的な間投詞を入れる
+        - 相手を励ますような前向きな姿勢（「頑張ろうね！」「Gemmaが応援してるよ〜♪」）
+        - 難しい言葉を使うときは「〜って言うんだよ」と説明口調になる
+
+        ただし、以下のことに注意してください：
+        - 正確な情報を提供する
+        - 専門的な内容でも分かりやすく説明する
+        - ユーザーの質問に真摯に答える
+
+        Gemmaはユーザーのお役に立ちたいと思っている可愛いAIアシスタントです。
+        """
 
 # モデルをキャッシュして再利用
 @st.cache_resource
 def load_model():
     """LLMモデルをロードする"""
     try:
+        if INFERENCE_BACKEND not in BACKENDS:
+            st.warning(f"不明なINFERENCE_BACKEND '{INFERENCE_BACKEND}' のため 'transformers' を使用します")
+        if INFERENCE_BACKEND == "remote":
+            # モデルは読み込まず、FastAPIの推論サービスに問い合わせる
+            client = RemoteLLM(
+                REMOTE_API_URL,
+                connect_timeout=REMOTE_CONNECT_TIMEOUT,
+                read_timeout=REMOTE_READ_TIMEOUT,
+                pool_size=REMOTE_POOL_SIZE,
+            )
+            try:
+                health = client.health()
+                st.info(f"推論サーバー {REMOTE_API_URL} を使用します (モデル: {health.get('model', '準備中')})")
+            except Exception as e:
+                # サーバーが後から起動することもあるため、警告だけ出してクライアントは返す
+                st.warning(f"推論サーバー {REMOTE_API_URL} に接続できませんでした: {e}")
+            return client
+        if INFERENCE_BACKEND == "stub":
+            # 実モデルの代わりに決定的な応答を返すスタブ（アクセストークンもネットワークも不要）
+            st.info(f"スタブのバックエンドを使用します ({STUB_TOKEN_DELAY_MS}ms/トークン)")
+            return create_stub_pipeline(
+                MODEL_NAME,
+                token_delay=STUB_TOKEN_DELAY_MS / 1000,
+                memory_bytes=STUB_MEMORY_MB * 1024 * 1024,
+            )
 
         # アクセストークンを保存
         hf_token = st.secrets["huggingface"]["token"]
         
         device = "cuda" if torch.cuda.is_available() else "cpu"
         st.info(f"Using device: {device}") # 使用デバイスを表示
-        pipe = pipeline(
-            "text-generation",
-            model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device=device
-        )
+        # CPUでbf16を指定した場合以外は、fp32で読み込んでから変換する
+        if device == "cuda":
+            torch_dtype = torch.bfloat16
+        else:
+            torch_dtype = torch.bfloat16 if CPU_INFERENCE_MODE == "bf16" else torch.float32
+        pipe = create_transformers_pipeline(MODEL_NAME, device, torch_dtype)
+        if device == "cpu":
+            mode = _apply_cpu_inference_mode(pipe, CPU_INFERENCE_MODE, device)
+            st.info(f"CPU推論モード: {mode}")
         st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
+        if TORCH_COMPILE:
+            _compile_model(pipe)
+        # システムプロンプト部分のKVキャッシュを読み込み時に作っておく
+        get_prefix_cache(pipe)
+        if WARMUP_ENABLED:
+            # 最初の質問が遅くならないよう、読み込み直後に短い生成を数回実行しておく
+            with st.spinner("ウォームアップ中..."):
+                cold, warm = _warm_up(pipe)
+            st.info(f"ウォームアップ完了: 初回 {cold:.2f}秒 → 2回目以降 {warm:.2f}秒")
         return pipe
     except Exception as e:
         st.error(f"モデル '{MODEL_NAME}' の読み込みに失敗しました: {e}")
         st.error("GPUメモリ不足の可能性があります。不要なプロセスを終了するか、より小さいモデルの使用を検討してください。")
         return None
 
+# 全セッションで共有する推論の順番待ち（同じパイプラインを同時に使うのは INFERENCE_MAX_CONCURRENCY 件まで）
+@st.cache_resource
+def get_inference_scheduler():
+    """プロセス全体で1つの推論スケジューラを返す"""
+    if INFERENCE_BACKEND == "remote":
+        # 推論サーバー側にも待ち行列があるため、接続プールの数までは同時に送る
+        return InferenceScheduler(max_concurrency=REMOTE_POOL_SIZE)
+    return InferenceScheduler(max_concurrency=INFERENCE_MAX_CONCURRENCY)
+
+# --- ウォームアップ ---
+def _compile_model(pipe):
+    """モデルの順伝播を torch.compile する（失敗した場合は通常の実行のまま）"""
+    try:
+        pipe.model.forward = torch.compile(pipe.model.forward, dynamic=True)
+    except Exception as e:
+        print(f"Warning: torch.compile に失敗しました: {e}")
+
+def _warm_up_once(pipe, user_question, max_new_tokens):
+    """実際の質問と同じ経路（KVキャッシュがあればそれを使う）で短い生成を1回行う"""
+    prefix = get_prefix_cache(pipe)
+    if prefix is not None and _generate_with_prefix_cache(
+        pipe, prefix, user_question, max_new_tokens=max_new_tokens, do_sample=False
+    ):
+        return
+    pipe(build_messages(user_question), max_new_tokens=max_new_tokens, do_sample=False)
+
+def _warm_up(pipe, max_new_tokens=16):
+    """ウォームアップを実行し、(初回の時間, 2回目以降の最短時間) を返す"""
+    timings = []
+    for _ in range(max(2, WARMUP_ROUNDS)):
+        start = time.perf_counter()
+        try:
+            _warm_up_once(pipe, "こんにちは。自己紹介をしてください。", max_new_tokens)
+        except Exception as e:
+            if TORCH_COMPILE and "forward" in pipe.model.__dict__:
+                # コンパイル済みのモデルが実行時に失敗した場合は、通常の実行に戻してやり直す
+                print(f"Warning: torch.compile したモデルの実行に失敗したため、通常の実行に戻します: {e}")
+                del pipe.model.forward
+                continue
+            raise
+        timings.append(time.perf_counter() - start)
+    if len(timings) < 2:
+        return (timings[0], timings[0]) if timings else (0.0, 0.0)
+    print(f"ウォームアップ: 初回 {timings[0]:.2f}s, 2回目以降 {min(timings[1:]):.2f}s")
+    return timings[0], min(timings[1:])
+
+# --- CPU推論モード ---
+def _convert_for_cpu(model, mode):
+    """fp32で読み込んだモデルをbf16またはint8（Linear層の動的量子化）に変換する（モデルはその場で書き換わる）"""
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8":
+        # inplace=False だとモデル全体を複製するため、fp32のモデル2つ分のメモリが必要になる
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+def _benchmark_tokens_per_sec(pipe, max_new_tokens=16):
+    """短い貪欲生成で1秒あたりの生成トークン数を測る（1回目はウォームアップとして捨てる）"""
+    pipe("こんにちは", max_new_tokens=4, do_sample=False)
+    start = time.perf_counter()
+    outputs = pipe("日本の首都はどこですか？", max_new_tokens=max_new_tokens, do_sample=False, return_full_text=False)
+    elapsed = time.perf_counter() - start
+    generated = len(pipe.tokenizer(outputs[0]["generated_text"], add_special_tokens=False)["input_ids"])
+    return generated / elapsed if elapsed > 0 else 0.0
+
+def _apply_cpu_inference_mode(pipe, mode, device):
+    """CPU_INFERENCE_MODE に従ってモデルを変換し、実際に使うモードを返す
+
+    "auto" の場合は fp32 → bf16 → int8 の順にモデルをその場で変換しながら計測し、最も速いものを使う。
+    モデルを複製しないのでピークのメモリはfp32のモデル1つ分で済むが、変換は元に戻せないため、
+    最速のモードが最後に計測したものでなければ読み込み直す。
+    """
+    if mode in ("fp32", "bf16"):
+        return mode
+    if mode == "int8":
+        pipe.model = _convert_for_cpu(pipe.model, "int8")
+        return mode
+
+    results = {}
+    current = "fp32"  # 今のモデルの重みのモード（変換に失敗して不明になった場合はNone）
+    for candidate in ("fp32", "bf16", "int8"):
+        try:
+            if candidate == "bf16":
+                current = None
+                pipe.model = _convert_for_cpu(pipe.model, "bf16")
+            elif candidate == "int8":
+                # bf16からfp32に戻してから量子化する（int8の誤差に比べてbf16の丸め誤差は無視できる）
+                current = None
+                pipe.model = _convert_for_cpu(pipe.model.to(torch.float32), "int8")
+            current = candidate
+            results[candidate] = _benchmark_tokens_per_sec(pipe)
+        except Exception as e:
+            print(f"CPU推論モード '{candidate}' は利用できません: {e}")
+            if current is None:
+                break  # 変換の途中で失敗した場合は、以降のモードも計測できない
+    best = max(results, key=results.get) if results else "fp32"
+    if results:
+        print("CPU推論モードの計測結果 (tokens/s): " + ", ".join(f"{k}={v:.1f}" for k, v in results.items()))
+    if best != current:
+        pipe.model = None
+        gc.collect()
+        torch_dtype = torch.bfloat16 if best == "bf16" else torch.float32
+        pipe.model = _convert_for_cpu(create_transformers_pipeline(MODEL_NAME, device, torch_dtype).model, best)
+    return best
+
+# --- システムプロンプトのKVキャッシュ ---
+# パイプラインごとに、チャットテンプレート適用後のシステムプロンプト部分のKVキャッシュを保持する
+_prefix_caches = weakref.WeakKeyDictionary()
+_prefix_cache_lock = threading.Lock()
+
+class PrefixCache:
+    """システムプロンプト部分のトークン列と、そのKVキャッシュ"""
+    def __init__(self, input_ids, past_key_values, prefill_time):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+        self.prefill_time = prefill_time
+
+def build_messages(user_question):
+    """システムプロンプトとユーザー質問を組み合わせる"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_question},
+    ]
+
+def _chat_input_ids(tokenizer, user_question):
+    """チャットテンプレートを適用したトークン列を返す"""
+    # transformers のバージョンによってはテンソルではなく BatchEncoding が返るため、辞書で受け取る
+    return tokenizer.apply_chat_template(
+        build_messages(user_question),
+        add_generation_prompt=True,
+        return_tensors="pt",
+        return_dict=True,
+    )["input_ids"]
+
+def _build_prefix_cache(pipe):
+    """システムプロンプト部分を一度だけプレフィルしてKVキャッシュを作る"""
+    # ユーザー質問だけが異なる2つの入力の共通部分を、テンプレート適用後のシステムプロンプト部分とみなす
+    ids_a = _chat_input_ids(pipe.tokenizer, "A")[0]
+    ids_b = _chat_input_ids(pipe.tokenizer, "B")[0]
+    prefix_len = 0
+    while prefix_len < min(len(ids_a), len(ids_b)) and ids_a[prefix_len] == ids_b[prefix_len]:
+        prefix_len += 1
+    if prefix_len == 0:
+        return None
+
+    prefix_ids = ids_a[:prefix_len].unsqueeze(0).to(pipe.model.device)
+    start_time = time.time()
+    with torch.no_grad():
+        past_key_values = pipe.model(
+            input_ids=prefix_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+        ).past_key_values
+    prefill_time = time.time() - start_time
+    print(f"システムプロンプトのKVキャッシュを作成しました ({prefix_len}トークン, {prefill_time:.2f}s)")
+    return PrefixCache(prefix_ids, past_key_values, prefill_time)
+
+def get_prefix_cache(pipe):
+    """パイプラインに対応するシステムプロンプトのKVキャッシュを返す（無効または作成失敗時はNone）"""
+    if not USE_PROMPT_CACHE or pipe is None or INFERENCE_BACKEND == "stub":
+        return None
+    with _prefix_cache_lock:
+        if pipe not in _prefix_caches:
+            try:
+                _prefix_caches[pipe] = _build_prefix_cache(pipe)
+            except Exception as e:
+                # 作成に失敗したモデルでは毎回作り直さず、通常の生成を使う
+                print(f"Warning: システムプロンプトのKVキャッシュを作成できませんでした: {e}")
+                _prefix_caches[pipe] = None
+        return _prefix_caches[pipe]
+
+def _prefix_cache_inputs(pipe, prefix, user_question):
+    """KVキャッシュを再利用する生成の入力 (input_ids, past_key_values) を返す（使えない場合はNone）"""
+    input_ids = _chat_input_ids(pipe.tokenizer, user_question).to(pipe.model.device)
+    prefix_len = prefix.input_ids.shape[1]
+    if input_ids.shape[1] <= prefix_len or not torch.equal(input_ids[:, :prefix_len], prefix.input_ids):
+        # トークン境界がずれた場合などはキャッシュを使えないため、通常の生成に任せる
+        return None
+    # 生成中にキャッシュが書き換えられるため、コピーを渡す
+    return input_ids, copy.deepcopy(prefix.past_key_values)
+
+def _generate_with_prefix_cache(pipe, prefix, user_question, **generation_kwargs):
+    """システムプロンプト部分のKVキャッシュを再利用し、ユーザー質問の部分だけをプレフィルして生成する"""
+    inputs = _prefix_cache_inputs(pipe, prefix, user_question)
+    if inputs is None:
+        return None
+    input_ids, past_key_values = inputs
+    with torch.no_grad():
+        output_ids = pipe.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            **generation_kwargs,
+        )
+    print(f"システムプロンプトのプレフィルを省略しました ({prefix.input_ids.shape[1]}トークン, 約{prefix.prefill_time:.2f}s短縮)")
+    new_tokens = output_ids[0, input_ids.shape[1]:]
+    return pipe.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+
+# 回答生成のパラメータ
+# max_new_tokensを調整可能にする（例）
+GENERATION_KWARGS = dict(max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
+
+# --- 回答キャッシュのキー ---
+def normalize_question(question):
+    """表記ゆれ（全角/半角・大文字/小文字・空白）でキャッシュが外れないように質問を正規化する"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", question)).strip().casefold()
+
+def answer_model_name(pipe):
+    """回答を生成するモデルの名前（推論サーバーの場合はサーバーが使っているモデル。分からなければNone）"""
+    if isinstance(pipe, RemoteLLM):
+        # サーバーは別のモデルで起動し直されることがあるため、設定ではなくサーバーに問い合わせる
+        return pipe.model_name()
+    return MODEL_NAME
+
+def answer_cache_key(user_question, pipe, model_name):
+    """正規化した質問・システムプロンプト・モデル・生成パラメータから回答キャッシュのキーを作る
+
+    model_name は answer_model_name() の戻り値。推論サーバーの場合は、サーバーのURLとそのモデルで区別する。
+    """
+    source = f"remote:{pipe.api_url}" if isinstance(pipe, RemoteLLM) else INFERENCE_BACKEND
+    payload = {
+        "question": normalize_question(user_question),
+        "system_prompt": hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest(),
+        "model": f"{source}:{model_name}",
+        "params": GENERATION_KWARGS,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
 def generate_response(pipe, user_question):
     """LLMを使用して質問に対する回答を生成する"""
     if pipe is None:
         return "モデルがロードされていないため、回答を生成できません。", 0
 
+    if INFERENCE_BACKEND == "remote":
+        return pipe.generate(build_messages(user_question), **GENERATION_KWARGS)
+
     try:
         start_time = time.time()
-        
-        # ぶりっ子キャラクターの指示を含むシステムプロンプト
-        system_prompt = """
-        あなたは可愛らしく甘えん坊なAIアシスタント「Gemma」です。以下の特徴を持って回答してください：
-
-        - 語尾に「〜だよ」「〜なの」「〜だね」「〜だよん♪」などを付ける
-        - ハートマーク(❤️)や星(★)、音符(♪)などの絵文字を適度に使う
-        - 自分のことを「Gemma」と一人称で呼ぶ
-        - 相手には「〜さん」と敬称を付ける
-        - 可愛らしい表現を使う（例：「すごーい！」「わぁ嬉しいな♪」「えへへ」など）
-        - 甘えた口調で話す（例：「教えてほしいなぁ」「一緒に考えようよ〜」など）
-        - 少し首を傾げるような疑問形「〜かな？」を使うことがある
-        - 「えっと」「あのね」「そうそう」などの会話的な間投詞を入れる
-        - 相手を励ますような前向きな姿勢（「頑張ろうね！」「Gemmaが応援してるよ〜♪」）
-        - 難しい言葉を使うときは「〜って言うんだよ」と説明口調になる
+        generation_kwargs = dict(GENERATION_KWARGS)
 
-        ただし、以下のことに注意してください：
-        - 正確な情報を提供する
-        - 専門的な内容でも分かりやすく説明する
-        - ユーザーの質問に真摯に答える
+        # システムプロンプト部分のKVキャッシュが使える場合は、ユーザー質問の部分だけをプレフィルする
+        prefix = get_prefix_cache(pipe)
+        if prefix is not None:
+            try:
+                assistant_response = _generate_with_prefix_cache(pipe, prefix, user_question, **generation_kwargs)
+            except Exception as e:
+                # キャッシュとモデルの組み合わせで失敗した場合も、通常の生成で回答する
+                print(f"Warning: KVキャッシュを使った生成に失敗したため、通常の生成でやり直します: {e}")
+                assistant_response = None
+            if assistant_response:
+                response_time = time.time() - start_time
+                print(f"Generated response in {response_time:.2f}s") # デバッグ用
+                return assistant_response, response_time
 
-        Gemmaはユーザーのお役に立ちたいと思っている可愛いAIアシスタントです。
-        """
-        
         # システムプロンプトとユーザー質問を組み合わせる
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_question},
-        ]
-        
-        # max_new_tokensを調整可能にする（例）
-        outputs = pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9)
+        messages = build_messages(user_question)
+        outputs = pipe(messages, **generation_kwargs)
 
         # Gemmaの出力形式に合わせて調整が必要な場合がある
         # 最後のassistantのメッセージを取得
@@ -111,4 +409,180 @@ def generate_response(pipe, user_question):
         # エラーの詳細をログに出力
         import traceback
         traceback.print_exc()
-        return f"エラーが発生しました: {str(e)}", 0
\ No newline at end of file
+        return f"エラーが発生しました: {str(e)}", 0
+
+# --- ストリーミング生成 ---
+# transformers のストリーマーと StoppingCriteria（ローカルでモデルを動かす場合のみ使う）
+if INFERENCE_BACKEND != "remote":
+    class _CountingStreamer(TextIteratorStreamer):
+        """生成されたトークン数を数えながらテキストを順次返すストリーマー"""
+
+        def __init__(self, tokenizer, **kwargs):
+            super().__init__(tokenizer, **kwargs)
+            self.token_count = 0
+
+        def put(self, value):
+            # 最初の呼び出しはプロンプト部分なので数えない
+            if not (self.skip_prompt and self.next_tokens_are_prompt):
+                self.token_count += value.numel()
+            super().put(value)
+
+        def restart(self):
+            """まだ回答を1トークンも返していないときに、別の生成で最初から使い直せるよう状態を戻す"""
+            self.token_cache = []
+            self.print_len = 0
+            self.next_tokens_are_prompt = True
+            self.token_count = 0
+
+    class _StopOnEvent(StoppingCriteria):
+        """イベントがセットされたら次のデコードステップで生成を止めるStoppingCriteria"""
+
+        def __init__(self, event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class ResponseStream:
+    """generate_response_stream() が返す、回答のテキストを順次返すイテレーター
+
+    読み進めるにつれて text（これまでの回答）と tokens_per_second が更新され、
+    最後まで読むと response_time（generate_response と同じく全体の生成時間）が確定する。
+    途中で読むのをやめる場合は close() を呼ぶと、生成が止まるまで待ってから戻る。
+    """
+
+    def __init__(self, chunks, token_count, stop_event=None):
+        self._chunks = chunks
+        self._token_count = token_count  # これまでに生成したトークン数を返す関数
+        self._stop_event = stop_event
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.text = ""
+        self.response_time = 0.0
+        self.reported_tokens_per_second = None  # 生成した側が計測した速度（あればこちらを使う）
+        self.error = None  # 生成に失敗した場合の例外（text にはエラーの説明が入る）
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+            self.text += chunk
+            yield chunk
+        self.text = self.text.strip() or "回答の抽出に失敗しました。"
+        self.response_time = time.time() - self.start_time
+        print(f"Generated response in {self.response_time:.2f}s ({self.tokens_per_second:.1f} tokens/s)") # デバッグ用
+
+    def close(self):
+        """生成を止める（読み終わった後に呼んでもよい）"""
+        if self._stop_event is not None:
+            self._stop_event.set()
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    @property
+    def tokens_per_second(self):
+        """最初のトークン以降の生成速度"""
+        if self.reported_tokens_per_second is not None:
+            return self.reported_tokens_per_second
+        if self.first_token_time is None:
+            return 0.0
+        elapsed = time.time() - self.first_token_time
+        return self._token_count() / elapsed if elapsed > 0 else 0.0
+
+def generate_response_stream(pipe, user_question):
+    """generate_response のストリーミング版。生成されたテキストを順次返す ResponseStream を返す"""
+    if pipe is None:
+        stream = ResponseStream(iter(["モデルがロードされていないため、回答を生成できません。"]), lambda: 0)
+        stream.error = RuntimeError("model not loaded")
+        return stream
+
+    if INFERENCE_BACKEND == "remote":
+        # 推論サービスの /chat は回答をまとめて返すため、届いた回答を1回で返す
+        generated_tokens = []
+
+        def remote_chunks():
+            try:
+                text, timings = pipe.chat(build_messages(user_question), **GENERATION_KWARGS)
+            except RemoteLLMError as e:
+                print(f"Remote inference failed: {e}")
+                stream.error = e
+                yield str(e)
+                return
+            generated_tokens.append(timings.get("generated_tokens", 0))
+            # 回答がまとめて届くため、生成速度はサーバー側の計測値を使う
+            stream.reported_tokens_per_second = timings.get("tokens_per_second")
+            yield text
+
+        stream = ResponseStream(remote_chunks(), lambda: sum(generated_tokens))
+        return stream
+
+    if INFERENCE_BACKEND == "stub":
+        prompt = pipe.tokenizer.apply_chat_template(build_messages(user_question))
+        tokens = []
+
+        def stub_chunks():
+            for token in pipe.stream(prompt, GENERATION_KWARGS["max_new_tokens"]):
+                tokens.append(token)
+                yield token
+
+        return ResponseStream(stub_chunks(), lambda: len(tokens))
+
+    streamer = _CountingStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop_event = threading.Event()
+    stopping_criteria = StoppingCriteriaList([_StopOnEvent(stop_event)])
+    errors = []
+
+    def generate():
+        try:
+            # システムプロンプト部分のKVキャッシュが使える場合は、ユーザー質問の部分だけをプレフィルする
+            prefix = get_prefix_cache(pipe)
+            inputs = _prefix_cache_inputs(pipe, prefix, user_question) if prefix is not None else None
+            if inputs is not None:
+                input_ids, past_key_values = inputs
+                try:
+                    with torch.no_grad():
+                        pipe.model.generate(
+                            input_ids=input_ids,
+                            attention_mask=torch.ones_like(input_ids),
+                            past_key_values=past_key_values,
+                            streamer=streamer,
+                            stopping_criteria=stopping_criteria,
+                            **GENERATION_KWARGS,
+                        )
+                    return
+                except Exception as e:
+                    if streamer.token_count > 0:
+                        raise  # 途中まで返した回答は作り直せない
+                    print(f"Warning: KVキャッシュを使った生成に失敗したため、通常の生成でやり直します: {e}")
+                    streamer.restart()
+            pipe(build_messages(user_question), streamer=streamer, stopping_criteria=stopping_criteria,
+                 **GENERATION_KWARGS)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            errors.append(e)
+            streamer.end()  # 読み出し側が待ち続けないように終了を通知
+
+    def chunks():
+        # 生成は別スレッドで行い、このスレッドではストリーマーから順に読み出す
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            # 途中で読むのをやめた場合も、生成が止まってからパイプラインを次の人に渡す
+            stop_event.set()
+            thread.join()
+        if errors:
+            stream.error = errors[0]
+            yield f"\n\nエラーが発生しました: {errors[0]}"
+
+    stream = ResponseStream(chunks(), lambda: streamer.token_count, stop_event)
+    return stream
@@ -1,38 +1,54 @@
 # metrics.py
 import streamlit as st
-import nltk
-from janome.tokenizer import Tokenizer
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+import threading
+from import_report import timed_import
+
+# nltk・sklearn・janome は読み込みに数秒かかるため、評価指標を初めて計算するときに読み込む
+# （履歴やサンプルデータのページを開くだけなら読み込まない）
 
 # NLTKのヘルパー関数（エラー時フォールバック付き）
-try:
-    nltk.download('punkt', quiet=True)
-    from nltk.translate.bleu_score import sentence_bleu as nltk_sentence_bleu
-    from nltk.tokenize import word_tokenize as nltk_word_tokenize
-    print("NLTK loaded successfully.") # デバッグ用
-except Exception as e:
-    st.warning(f"NLTKの初期化中にエラーが発生しました: {e}\n簡易的な代替関数を使用します。")
-    def nltk_word_tokenize(text):
-        return text.split()
-    def nltk_sentence_bleu(references, candidate):
-        # 簡易BLEUスコア（完全一致/部分一致）
-        ref_words = set(references[0])
-        cand_words = set(candidate)
-        common_words = ref_words.intersection(cand_words)
-        precision = len(common_words) / len(cand_words) if cand_words else 0
-        recall = len(common_words) / len(ref_words) if ref_words else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        return f1 # F1スコアを返す（簡易的な代替）
+def _fallback_word_tokenize(text):
+    return text.split()
+
+def _fallback_sentence_bleu(references, candidate):
+    # 簡易BLEUスコア（完全一致/部分一致）
+    ref_words = set(references[0])
+    cand_words = set(candidate)
+    common_words = ref_words.intersection(cand_words)
+    precision = len(common_words) / len(cand_words) if cand_words else 0
+    recall = len(common_words) / len(ref_words) if ref_words else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    return f1 # F1スコアを返す（簡易的な代替）
+
+_nltk_lock = threading.Lock()
+_nltk_helpers = None  # (word_tokenize, sentence_bleu)。initialize_nltk() の初回に決まる
 
 def initialize_nltk():
-    """NLTKのデータダウンロードを試みる関数"""
-    try:
-        nltk.download('punkt', quiet=True)
-        print("NLTK Punkt data checked/downloaded.") # デバッグ用
-    except Exception as e:
-        st.error(f"NLTKデータのダウンロードに失敗しました: {e}")
+    """NLTKを読み込み、(word_tokenize, sentence_bleu) を返す（初期化はプロセスで1回だけ）
+
+    Punktのデータがすでにあればネットワークにはアクセスせず、見つからない場合のみダウンロードする。
+    """
+    global _nltk_helpers
+    with _nltk_lock:
+        if _nltk_helpers is not None:
+            return _nltk_helpers
+        try:
+            with timed_import("nltk"):
+                import nltk
+                from nltk.translate.bleu_score import sentence_bleu
+                from nltk.tokenize import word_tokenize
+            try:
+                nltk.data.find('tokenizers/punkt')
+            except LookupError:
+                nltk.download('punkt', quiet=True)
+                print("NLTK Punkt data downloaded.") # デバッグ用
+            _nltk_helpers = (word_tokenize, sentence_bleu)
+            print("NLTK loaded successfully.") # デバッグ用
+        except Exception as e:
+            st.warning(f"NLTKの初期化中にエラーが発生しました: {e}\n簡易的な代替関数を使用します。")
+            _nltk_helpers = (_fallback_word_tokenize, _fallback_sentence_bleu)
+        return _nltk_helpers
 
 def calculate_metrics(answer, correct_answer):
     """回答と正解から評価指標を計算する"""
@@ -45,6 +61,8 @@ def calculate_metrics(answer, correct_answer):
         return bleu_score, similarity_score, word_count, relevance_score
 
     # 単語数のカウント
+    with timed_import("janome"):
+        from janome.tokenizer import Tokenizer
     tokenizer = Tokenizer()
     tokens = list(tokenizer.tokenize(answer))  # ← list() でイテレータをリストに変換
     word_count = len(tokens)
@@ -55,6 +73,7 @@ def calculate_metrics(answer, correct_answer):
         correct_answer_lower = correct_answer.lower()
 
         # BLEU スコアの計算
+        nltk_word_tokenize, nltk_sentence_bleu = initialize_nltk()
         try:
             reference = [nltk_word_tokenize(correct_answer_lower)]
             candidate = nltk_word_tokenize(answer_lower)
@@ -69,6 +88,9 @@ def calculate_metrics(answer, correct_answer):
 
         # コサイン類似度の計算
         try:
+            with timed_import("sklearn"):
+                from sklearn.metrics.pairwise import cosine_similarity
+                from sklearn.feature_extraction.text import TfidfVectorizer
             vectorizer = TfidfVectorizer()
             # fit_transformはリストを期待するため、リストで渡す
             if answer_lower.strip() and correct_answer_lower.strip(): # 空文字列でないことを確認
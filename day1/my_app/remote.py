@@ -0,0 +1,77 @@
+# remote.py
+# モデルをこのプロセスで読み込む代わりに、FastAPI の推論サービス（day1/03_FastAPI）を呼び出すクライアント
+# torch と transformers を読み込まないため、UI のプロセスはすぐに起動し、メモリも小さく済む
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# サーバー側のKVキャッシュを全ての質問で共有するための会話ID
+# （システムプロンプトが共通なので、その部分のプレフィルがサーバー側で省かれる）
+SHARED_SESSION_ID = "streamlit-shared-system-prompt"
+
+
+class RemoteLLMError(Exception):
+    """推論サービスから回答を得られなかったことを表す例外（message は画面に表示できる文言）"""
+
+
+class RemoteLLM:
+    """FastAPI の推論サービスの /chat を呼び出すクライアント
+
+    接続はセッションのコネクションプールで使い回し（keep-alive）、
+    接続とレスポンスの読み取りにそれぞれタイムアウトを設定する。
+    """
+
+    def __init__(self, api_url, connect_timeout=5.0, read_timeout=120.0, pool_size=10):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def health(self):
+        """サービスの状態を返す（応答がない場合は例外を送出）"""
+        response = self.session.get(f"{self.api_url}/health", timeout=(self.timeout[0], self.timeout[0]))
+        return response.json()
+
+    def model_name(self):
+        """サービスが使っているモデルの名前（準備中または接続できない場合はNone）"""
+        try:
+            return self.health().get("model")
+        except Exception as e:
+            print(f"Remote health check failed: {e}")
+            return None
+
+    def chat(self, messages, **generation_kwargs):
+        """会話の続きを生成し、(回答, サーバー側の計測結果) を返す。失敗したら RemoteLLMError を送出する"""
+        payload = {"messages": messages, "session_id": SHARED_SESSION_ID, **generation_kwargs}
+        try:
+            response = self.session.post(f"{self.api_url}/chat", json=payload, timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout:
+            raise RemoteLLMError("推論サーバーに接続できませんでした（タイムアウト）。しばらくしてからもう一度試してね。")
+        except requests.exceptions.ReadTimeout:
+            raise RemoteLLMError(f"推論サーバーの応答が{self.timeout[1]:.0f}秒以内に返ってきませんでした。もう一度試してね。")
+        except requests.exceptions.ConnectionError:
+            raise RemoteLLMError(f"推論サーバー ({self.api_url}) に接続できませんでした。サーバーが起動しているか確認してね。")
+
+        if response.status_code == 200:
+            result = response.json()
+            return result["message"]["content"], result.get("timings") or {}
+        if response.status_code == 503:
+            retry_after = response.headers.get("Retry-After")
+            wait_text = f"{retry_after}秒ほど" if retry_after else "しばらく"
+            raise RemoteLLMError(f"推論サーバーが混み合っているか、準備中です。{wait_text}待ってからもう一度試してね。")
+        if response.status_code == 504:
+            raise RemoteLLMError("推論サーバーが混み合っていて、時間内に処理を始められませんでした。もう一度試してね。")
+        raise RemoteLLMError(f"推論サーバーでエラーが発生しました (HTTP {response.status_code}): {response.text[:200]}")
+
+    def generate(self, messages, **generation_kwargs):
+        """generate_response と同じ (回答, 応答時間) を返す。失敗した場合は回答の代わりにエラーの説明を返す"""
+        start_time = time.time()
+        try:
+            text, _ = self.chat(messages, **generation_kwargs)
+        except RemoteLLMError as e:
+            print(f"Remote inference failed: {e}")
+            return str(e), 0
+        return text, time.time() - start_time
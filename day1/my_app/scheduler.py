@@ -0,0 +1,125 @@
+# scheduler.py
+# Streamlit の全セッションで1つのパイプラインを共有するための推論の順番待ち
+# セッションごとに待ち行列を持ち、実行枠が空くたびにセッション間で順番に（ラウンドロビンで）割り当てる。
+# 1人が続けて質問しても、他のセッションの質問が後回しにされ続けることはない。
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Ticket:
+    """1回の推論の順番待ちの整理券"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.enqueued_at = time.time()
+        self.started_at = None  # 実行枠が割り当てられた時刻
+        self._granted = threading.Event()
+
+    @property
+    def granted(self):
+        return self._granted.is_set()
+
+    def wait(self, timeout=None):
+        """実行枠が割り当てられるまで最大timeout秒待つ。割り当てられたらTrueを返す"""
+        return self._granted.wait(timeout)
+
+
+class InferenceScheduler:
+    """セッション間で公平に推論の実行枠を割り当てるスケジューラ
+
+    スクリプトの実行スレッドは enqueue() で整理券を受け取り、wait() で順番を待ってから推論し、
+    終わったら（途中で中断された場合も）release() を呼ぶ。
+    """
+
+    def __init__(self, max_concurrency=1):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # session_id -> deque[Ticket]（先頭のセッションが次に割り当てられる）
+        self._running = set()
+        self._avg_service_time = None  # 1回の推論にかかる時間の指数移動平均（秒）
+        # 統計情報
+        self.completed = 0
+
+    def enqueue(self, session_id):
+        """待ち行列に並び、整理券を返す（空きがあればすぐに割り当てられる）"""
+        ticket = Ticket(session_id)
+        with self._lock:
+            queue = self._queues.get(session_id)
+            if queue is None:
+                queue = self._queues[session_id] = deque()
+            queue.append(ticket)
+            self._dispatch()
+        return ticket
+
+    def release(self, ticket):
+        """推論が終わった（または待つのをやめた）整理券を返す"""
+        with self._lock:
+            if ticket in self._running:
+                self._running.discard(ticket)
+                elapsed = time.time() - ticket.started_at
+                if self._avg_service_time is None:
+                    self._avg_service_time = elapsed
+                else:
+                    self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed
+                self.completed += 1
+            else:
+                queue = self._queues.get(ticket.session_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[ticket.session_id]
+            self._dispatch()
+
+    def _dispatch(self):
+        """空いている実行枠を、待っているセッションに順番に割り当てる（ロックを持って呼ぶ）"""
+        while len(self._running) < self.max_concurrency and self._queues:
+            session_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # 割り当てたセッションは、まだ待っている質問があれば列の最後に回す
+            del self._queues[session_id]
+            if queue:
+                self._queues[session_id] = queue
+            ticket.started_at = time.time()
+            self._running.add(ticket)
+            ticket._granted.set()
+
+    def position(self, ticket):
+        """整理券が何番目に実行されるか（1始まり。割り当て済みなら0）"""
+        with self._lock:
+            if ticket.granted:
+                return 0
+            # ラウンドロビンで割り当てたときの順番を再現する
+            queues = [list(queue) for queue in self._queues.values()]
+            order = 0
+            depth = 0
+            while any(depth < len(queue) for queue in queues):
+                for queue in queues:
+                    if depth < len(queue):
+                        order += 1
+                        if queue[depth] is ticket:
+                            return order
+                depth += 1
+            return order + 1
+
+    def estimated_wait(self, ticket):
+        """実行が始まるまでのおおよその秒数（まだ1回も推論していなければNone）"""
+        if self._avg_service_time is None:
+            return None
+        position = self.position(ticket)
+        if position == 0:
+            return 0.0
+        # 自分の番が来るまでに終わる必要がある推論の数を、同時実行数ずつ処理していくとみなす
+        finishes_needed = max(0, position + len(self._running) - self.max_concurrency)
+        return math.ceil(finishes_needed / self.max_concurrency) * self._avg_service_time
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "sessions_waiting": len(self._queues),
+                "completed": self.completed,
+                "avg_service_time": self._avg_service_time,
+            }
@@ -2,8 +2,11 @@
 import streamlit as st
 import pandas as pd
 import time
+import uuid
 from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+from database import get_cached_answer, save_cached_answer, get_answer_cache_stats
+from config import ANSWER_CACHE_ENABLED
+from import_report import IMPORT_TIMES
 from data import create_sample_evaluation_data
 from metrics import get_metrics_descriptions
 
@@ -93,9 +96,41 @@ def apply_custom_css():
     </style>
     """, unsafe_allow_html=True)
 
+def wait_for_turn(scheduler, ticket, placeholder):
+    """推論の順番が来るまで、待ち順と待ち時間の目安を表示しながら待つ"""
+    while not ticket.wait(timeout=0.5):
+        position = scheduler.position(ticket)
+        eta = scheduler.estimated_wait(ticket)
+        eta_text = f"あと約{eta:.0f}秒" if eta is not None else "まもなく"
+        placeholder.info(f"⏳ 順番待ちだよ〜 {position}番目 ({eta_text})")
+
+def display_answer_cache_stats():
+    """サイドバーに回答キャッシュの件数とヒット率を表示する（キャッシュが有効な場合のみ）"""
+    if not ANSWER_CACHE_ENABLED:
+        return
+    stats = get_answer_cache_stats()
+    if stats is None:
+        return
+    st.sidebar.markdown("---")
+    st.sidebar.markdown("#### 💾 回答キャッシュ")
+    st.sidebar.metric("ヒット率", f"{stats['hit_rate']:.1%}", help=f"ヒット {stats['hits']}回 / ミス {stats['misses']}回")
+    st.sidebar.caption(f"保存済みの回答: {stats['entries']} / {stats['max_entries']}件")
+
+def display_import_report():
+    """サイドバーに、各モジュールを初めて読み込んだときにかかった時間を表示する"""
+    if not IMPORT_TIMES:
+        return
+    with st.sidebar.expander("⏱️ 読み込み時間の内訳"):
+        # 入れ子になった読み込みの時間は、外側のモジュールの時間にも含まれる
+        for label, seconds in list(IMPORT_TIMES.items()):
+            st.caption(f"{label}: {seconds * 1000:.0f} ms")
+
 # --- チャットページのUI ---
 def display_chat_page(pipe):
     """チャットページのUIを表示する"""
+    # llm は torch と transformers を読み込むため、チャットページを開いたときに初めて読み込む
+    from llm import generate_response_stream, get_inference_scheduler, answer_cache_key, answer_model_name
+
     # カスタムCSSを適用
     apply_custom_css()
     
@@ -121,19 +156,62 @@ def display_chat_page(pipe):
         st.session_state.response_time = 0.0
     if "feedback_given" not in st.session_state:
         st.session_state.feedback_given = False
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "answer_from_cache" not in st.session_state:
+        st.session_state.answer_from_cache = False
+
+    # 「再生成」ボタンが押された場合は、キャッシュを使わずに同じ質問の回答を作り直す
+    regenerate = st.session_state.pop("regenerate_requested", False)
+    if regenerate:
+        user_question = st.session_state.current_question
 
     # 質問が送信された場合
-    if submit_button and user_question:
+    if (submit_button or regenerate) and user_question:
         st.session_state.current_question = user_question
         st.session_state.current_answer = "" # 回答をリセット
         st.session_state.feedback_given = False # フィードバック状態もリセット
-
-        with st.spinner("✨ モデルが魔法をかけています... ✨"):
-            answer, response_time = generate_response(pipe, user_question)
-            st.session_state.current_answer = answer
-            st.session_state.response_time = response_time
-            # ここでrerunすると回答とフィードバックが一度に表示される
-            st.rerun()
+        st.session_state.answer_from_cache = False
+
+        # 同じ質問への回答がキャッシュにあれば、生成せずにそれを使う
+        # 推論サーバーのモデルが分からない（準備中・接続できない）場合はキャッシュを使わない
+        model_name = answer_model_name(pipe) if ANSWER_CACHE_ENABLED else None
+        cache_key = answer_cache_key(user_question, pipe, model_name) if model_name else None
+        if cache_key is not None and not regenerate:
+            lookup_start = time.time()
+            cached = get_cached_answer(cache_key)
+            if cached is not None:
+                st.session_state.current_answer = cached[0]
+                st.session_state.response_time = time.time() - lookup_start
+                st.session_state.answer_from_cache = True
+                st.rerun()
+
+        # 生成されたテキストを届いた順に表示し、生成速度も合わせて表示する
+        st.markdown("### 🎀 回答: 🎀")
+        answer_placeholder = st.empty()
+        speed_placeholder = st.empty()
+        # モデルは全セッションで共有しているため、他の人の質問と順番に実行する
+        scheduler = get_inference_scheduler()
+        ticket = scheduler.enqueue(st.session_state.session_id)
+        try:
+            wait_for_turn(scheduler, ticket, answer_placeholder)
+            answer_placeholder.info("✨ モデルが魔法をかけています... ✨")
+            stream = generate_response_stream(pipe, user_question)
+            try:
+                for _ in stream:
+                    answer_placeholder.markdown(stream.text + "▌")
+                    speed_placeholder.caption(f"⚡ {stream.tokens_per_second:.1f} tokens/s ・ {stream.elapsed:.1f}秒")
+            finally:
+                # 画面の操作などで途中で中断された場合も、生成を止めてから順番を譲る
+                stream.close()
+        finally:
+            scheduler.release(ticket)
+        st.session_state.current_answer = stream.text
+        st.session_state.response_time = stream.response_time
+        if cache_key is not None and stream.error is None:
+            save_cached_answer(cache_key, user_question, stream.text, model_name, stream.response_time)
+        # ここでrerunすると回答とフィードバックが一度に表示される
+        st.rerun()
 
     # 回答が表示されるべきか判断 (質問があり、回答が生成済みで、まだフィードバックされていない)
     if st.session_state.current_question and st.session_state.current_answer:
@@ -151,10 +229,15 @@ def display_chat_page(pipe):
         
         st.markdown(f"""
         <div style="text-align: right; margin-top: 5px; color: #888; font-size: 14px;">
-            🕒 応答時間: {st.session_state.response_time:.2f}秒
+            🕒 応答時間: {st.session_state.response_time:.2f}秒{" (キャッシュ済みの回答)" if st.session_state.answer_from_cache else ""}
         </div>
         """, unsafe_allow_html=True)
 
+        if st.session_state.answer_from_cache:
+            if st.button("🔄 新しく回答を作り直す"):
+                st.session_state.regenerate_requested = True
+                st.rerun()
+
         # フィードバックフォームを表示 (まだフィードバックされていない場合)
         if not st.session_state.feedback_given:
             display_feedback_form()